@@ -0,0 +1,86 @@
+"""
+Latency of logins, and of a cheap concurrent request, during a burst of logins,
+for different sizes of the password hashing thread pool.
+
+Usage: python benchmarks/login.py [n_threads ...]
+"""
+from __future__ import annotations
+import os
+import logging
+import sys
+import time
+import json
+import threading
+import tempfile
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import make_server
+from circuit_seq_server import create_app
+from circuit_seq_server.model import db, User, hash_password
+
+n_logins = 32
+
+
+def _post_login(url: str) -> float:
+    request = urllib.request.Request(
+        f"{url}/api/login",
+        data=json.dumps({"email": "user@embl.de", "password": "user"}).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    start_time = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.perf_counter() - start_time
+
+
+def _get_remaining(url: str) -> float:
+    start_time = time.perf_counter()
+    with urllib.request.urlopen(f"{url}/api/remaining") as response:
+        response.read()
+    return time.perf_counter() - start_time
+
+
+def _percentile(timings, p: float) -> float:
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(p / 100 * len(timings)))]
+
+
+def main(thread_counts):
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    for n_threads in thread_counts:
+        os.environ["CIRCUITSEQ_PASSWORD_HASHING_THREADS"] = str(n_threads)
+        with tempfile.TemporaryDirectory() as data_path:
+            app = create_app(data_path=data_path)
+            with app.app_context():
+                db.session.add(
+                    User(
+                        email="user@embl.de",
+                        password_hash=hash_password("user"),
+                        activated=True,
+                        is_admin=False,
+                    )
+                )
+                db.session.commit()
+            server = make_server("localhost", 0, app, threaded=True)
+            server_thread = threading.Thread(target=server.serve_forever)
+            server_thread.start()
+            url = f"http://localhost:{server.server_port}"
+            _get_remaining(url)
+            with ThreadPoolExecutor(max_workers=n_logins + 1) as executor:
+                logins = [executor.submit(_post_login, url) for _ in range(n_logins)]
+                time.sleep(0.1)
+                t_remaining = executor.submit(_get_remaining, url).result()
+                t_logins = [login.result() for login in logins]
+            server.shutdown()
+            server_thread.join()
+            with app.app_context():
+                db.engine.dispose()
+        print(
+            f"{n_threads:>4} hashing threads: {n_logins} logins "
+            f"p50 {_percentile(t_logins, 50):.2f}s, p99 {_percentile(t_logins, 99):.2f}s, "
+            f"concurrent /api/remaining {t_remaining:.3f}s"
+        )
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [1, 4, n_logins])
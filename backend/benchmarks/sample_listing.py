@@ -0,0 +1,87 @@
+"""
+Compare the cost of listing samples as ORM objects vs as projected row tuples.
+
+Usage: python benchmarks/sample_listing.py [n_samples ...]
+"""
+from __future__ import annotations
+import sys
+import time
+import datetime
+import tempfile
+import flask
+from circuit_seq_server import create_app
+from circuit_seq_server.model import db, Sample, sample_listing_columns
+
+
+def _add_samples(n_samples: int):
+    start_date = datetime.date(2022, 1, 3)
+    db.session.execute(
+        db.insert(Sample),
+        [
+            {
+                "email": f"user{n % 100}@embl.de",
+                "primary_key": f"key_{n}",
+                "name": f"sample_{n}",
+                "running_option": "dna_r9.4.1_450bps_sup.cfg",
+                "concentration": 200,
+                "reference_sequence_description": f"reference sequence {n}",
+                "date": start_date + datetime.timedelta(days=n // 96),
+                "has_results_fasta": n % 2 == 0,
+                "has_results_gbk": n % 2 == 0,
+                "has_results_zip": n % 2 == 0,
+            }
+            for n in range(n_samples)
+        ],
+    )
+    db.session.commit()
+
+
+def _orm_objects() -> int:
+    samples = (
+        db.session.execute(
+            db.select(Sample).order_by(db.desc(Sample.date), db.desc(Sample.id))
+        )
+        .scalars()
+        .all()
+    )
+    return len(flask.jsonify(samples=samples).data)
+
+
+def _row_tuples() -> int:
+    sample_rows = db.session.execute(
+        db.select(*sample_listing_columns).order_by(
+            db.desc(Sample.date), db.desc(Sample.id)
+        )
+    ).all()
+    return len(
+        flask.jsonify(samples=[sample_row._asdict() for sample_row in sample_rows]).data
+    )
+
+
+def _time(func, repeats: int = 3) -> float:
+    timings = []
+    for _ in range(repeats):
+        db.session.expunge_all()
+        start_time = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+
+def main(sample_counts):
+    for n_samples in sample_counts:
+        with tempfile.TemporaryDirectory() as data_path:
+            app = create_app(data_path=data_path)
+            with app.test_request_context():
+                _add_samples(n_samples)
+                t_orm = _time(_orm_objects)
+                t_rows = _time(_row_tuples)
+                db.engine.dispose()
+        print(
+            f"{n_samples:>8} samples: ORM objects {t_orm:.3f}s, "
+            f"row tuples {t_rows:.3f}s ({t_orm / t_rows:.1f}x faster)"
+        )
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [10000, 100000])
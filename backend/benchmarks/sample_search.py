@@ -0,0 +1,50 @@
+"""
+Time admin sample searches on a database with many samples.
+
+Usage: python benchmarks/sample_search.py [n_samples]
+"""
+from __future__ import annotations
+import sys
+import time
+import datetime
+import tempfile
+from circuit_seq_server import create_app
+from circuit_seq_server.model import db, get_samples_page
+from sample_listing import _add_samples
+
+
+def _time(repeats: int = 5, **kwargs) -> float:
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        get_samples_page(**kwargs)
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+
+def main(n_samples: int):
+    searches = [
+        {},
+        {"email": "user42@embl.de"},
+        {"running_option": "dna_r9.4.1_450bps_sup.cfg"},
+        {
+            "start_date": datetime.date(2023, 1, 2),
+            "end_date": datetime.date(2023, 1, 8),
+        },
+        {"primary_key_prefix": "key_1234"},
+        {"text": "sample_12345"},
+        {"text": "reference sequence 9999"},
+        {"email": "user42@embl.de", "text": "sample_4"},
+        {"has_results": True},
+    ]
+    with tempfile.TemporaryDirectory() as data_path:
+        app = create_app(data_path=data_path)
+        with app.app_context():
+            _add_samples(n_samples)
+            for search in searches:
+                print(f"{_time(**search) * 1000:8.2f}ms: {search}")
+            db.engine.dispose()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 300000)
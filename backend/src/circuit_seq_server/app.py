@@ -1,37 +1,90 @@
 from __future__ import annotations
 from __future__ import annotations
 
+from typing import Optional, Callable, Dict, Tuple
 import os
+import hashlib
+import base64
+import json
 import secrets
 import pathlib
+import time
+import threading
+import zipfile
+import tempfile
+import mimetypes
+import urllib.parse
 import datetime
+import argon2
 import flask
 from flask import Flask
 from flask import jsonify
 from flask import request
 from flask_jwt_extended import create_access_token
+from flask_jwt_extended import create_refresh_token
+from flask_jwt_extended import decode_token
+from flask_jwt_extended import get_jwt
 from flask_jwt_extended import current_user
 from flask_jwt_extended import jwt_required
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
 from circuit_seq_server.logger import get_logger
+from circuit_seq_server import model
 from circuit_seq_server.utils import get_start_of_week
+from circuit_seq_server.utils import get_date_range
+from circuit_seq_server.jobs import ResultJobPool, start_expired_upload_cleanup
+from circuit_seq_server.jobs import SamplesVersionTicker
+from circuit_seq_server.export import write_export, ExportError
+from circuit_seq_server.utils import decode_result_download_token
+from circuit_seq_server.utils import list_zip_members, open_zip_member
+from circuit_seq_server.utils import PoolFullError
 from circuit_seq_server.model import (
     db,
     Sample,
     User,
     add_new_user,
     activate_user,
+    get_user,
+    get_outbox_stats,
+    add_refresh_token,
+    is_refresh_token_revoked,
+    revoke_refresh_token,
+    configure_password_hashing,
+    configure_reference_parsing,
+    resume_reference_parse_jobs,
     add_new_sample,
+    add_new_samples,
+    default_page_size,
+    get_samples_page,
     remaining_samples_this_week,
     get_current_settings,
+    get_current_settings_id,
+    get_max_sample_id,
+    get_samples_version,
+    get_results_available,
     set_current_settings,
-    update_samples_zipfile,
-    process_result,
+    stream_samples_zipfile,
+    ResultJob,
+    create_result_job,
+    Upload,
+    create_upload,
+    get_upload,
+    write_upload_chunk,
+    get_completed_upload_file,
+    delete_upload,
+    create_missing_columns,
+    create_missing_indexes,
+    create_search_index,
 )
 
 
-def create_app(data_path: str = "/circuit_seq_data"):
+def create_app(data_path: str = "/circuit_seq_data", start_workers: bool = False):
+    """
+    Creates the flask app. If `start_workers` is True, result jobs and reference
+    sequence parses that were interrupted when the server stopped are resumed in
+    this process: this should only be set for the server itself, not for other
+    processes such as the email worker that use the same database.
+    """
     logger = get_logger("CircuitSeqServer")
     app = Flask("CircuitSeqServer")
     jwt_secret_key = os.environ.get("JWT_SECRET_KEY")
@@ -46,16 +99,96 @@ def create_app(data_path: str = "/circuit_seq_data"):
         app.config["JWT_SECRET_KEY"] = secrets.token_urlsafe(64)
     # tokens are by default valid for 30mins
     app.config["JWT_ACCESS_TOKEN_EXPIRES"] = datetime.timedelta(minutes=30)
+    # refresh tokens can be used to get a new access token for 30 days
+    app.config["JWT_REFRESH_TOKEN_EXPIRES"] = datetime.timedelta(days=30)
     app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{data_path}/CircuitSeq.db"
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     # limit max file upload size to 384mb
     app.config["MAX_CONTENT_LENGTH"] = 384 * 1024 * 1024
     app.config["CIRCUITSEQ_DATA_PATH"] = data_path
+    # how often the server checks for new events to send to clients in seconds:
+    # this is done once for all the event streams of a server process
+    app.config["CIRCUITSEQ_EVENTS_POLL_INTERVAL"] = 5
+    # how often a comment is sent on an event stream without new events, which
+    # keeps the connection open through proxies
+    app.config["CIRCUITSEQ_EVENTS_KEEPALIVE_INTERVAL"] = 15
+    # each open event stream holds a request thread: by default at most a quarter
+    # of the threads are used for them, so the rest stay free for requests. Once
+    # this limit is reached further clients poll for updates instead.
+    # Each stream is closed after this many seconds, after which the client
+    # reconnects with a new stream token
+    app.config["CIRCUITSEQ_EVENTS_MAX_STREAMS"] = int(
+        os.environ.get("CIRCUITSEQ_EVENTS_MAX_STREAMS")
+        or int(os.environ.get("CIRCUITSEQ_THREADS") or 64) // 4
+    )
+    app.config["CIRCUITSEQ_EVENTS_MAX_LIFETIME"] = 600
+    # requests that need a password hash while too many are already queued get a
+    # 503 response, and are asked to retry after this many seconds
+    app.config["CIRCUITSEQ_PASSWORD_HASHING_RETRY_AFTER"] = 5
+    # single-purpose token used to open an event stream, only valid for this long
+    app.config["CIRCUITSEQ_EVENTS_TOKEN_EXPIRES"] = datetime.timedelta(seconds=60)
+    # max number of uploaded result zip files processed concurrently
+    app.config["CIRCUITSEQ_RESULT_JOB_THREADS"] = 2
+    # max total size of gzipped result email attachments: larger files are
+    # replaced with a download link which is valid for 30 days
+    app.config["CIRCUITSEQ_EMAIL_ATTACHMENT_BUDGET"] = 10 * 1024 * 1024
+    app.config["CIRCUITSEQ_RESULT_DOWNLOAD_LINK_EXPIRES"] = datetime.timedelta(days=30)
+    # uploaded zip files that exceed these limits are rejected without being
+    # extracted, and extraction stops if more than the maximum size is written
+    app.config["CIRCUITSEQ_ZIP_MAX_MEMBERS"] = 1000
+    app.config["CIRCUITSEQ_ZIP_MAX_UNCOMPRESSED_SIZE"] = 2 * 1024 * 1024 * 1024
+    app.config["CIRCUITSEQ_ZIP_MAX_COMPRESSION_RATIO"] = 100
+    # new samples wait this many seconds for their reference sequence to be parsed,
+    # after which they are added with a "pending" reference sequence
+    app.config["CIRCUITSEQ_REFERENCE_PARSE_INLINE_WAIT"] = 2
+    # a pending reference sequence that is not parsed within this many seconds
+    # is marked as "failed"
+    app.config["CIRCUITSEQ_REFERENCE_PARSE_TIMEOUT"] = 300
 
-    CORS(app)  # todo: limit ports / routes
+    # max number of days of samples that can be exported as a zip file at once
+    app.config["CIRCUITSEQ_EXPORT_MAX_DAYS"] = 366
+    # limits on the incomplete or unused resumable uploads of each user, which
+    # are deleted after a week, and how often expired uploads are deleted in seconds
+    app.config["CIRCUITSEQ_MAX_OPEN_UPLOADS"] = 4
+    app.config["CIRCUITSEQ_MAX_OPEN_UPLOAD_BYTES"] = 1024 * 1024 * 1024
+    app.config["CIRCUITSEQ_UPLOAD_CLEANUP_INTERVAL"] = 3600
+
+    # if set, files are served by nginx from this internal location, which maps
+    # onto data_path, instead of being sent by flask
+    app.config["CIRCUITSEQ_X_ACCEL_REDIRECT"] = (
+        os.environ.get("CIRCUITSEQ_X_ACCEL_REDIRECT") or None
+    )
+
+    # unset or empty environment variables use the default values
+    configure_password_hashing(
+        time_cost=int(
+            os.environ.get("CIRCUITSEQ_ARGON2_TIME_COST") or argon2.DEFAULT_TIME_COST
+        ),
+        memory_cost=int(
+            os.environ.get("CIRCUITSEQ_ARGON2_MEMORY_COST")
+            or argon2.DEFAULT_MEMORY_COST
+        ),
+        parallelism=int(
+            os.environ.get("CIRCUITSEQ_ARGON2_PARALLELISM")
+            or argon2.DEFAULT_PARALLELISM
+        ),
+        max_workers=int(os.environ.get("CIRCUITSEQ_PASSWORD_HASHING_THREADS") or 4),
+        max_queued=int(os.environ.get("CIRCUITSEQ_PASSWORD_HASHING_MAX_QUEUED") or 8),
+    )
+    configure_reference_parsing(
+        max_workers=int(os.environ.get("CIRCUITSEQ_REFERENCE_PARSING_PROCESSES") or 2)
+    )
+
+    # todo: limit ports / routes
+    CORS(app, expose_headers=["Upload-Offset", "Upload-Length", "Location"])
 
     jwt = JWTManager(app)
     db.init_app(app)
+    # uploaded results are processed in the background by this pool of threads
+    result_job_pool = ResultJobPool(
+        app, max_workers=app.config["CIRCUITSEQ_RESULT_JOB_THREADS"]
+    )
+    app.extensions["circuitseq_result_job_pool"] = result_job_pool
 
     # https://flask-jwt-extended.readthedocs.io/en/stable/api/#flask_jwt_extended.JWTManager.user_identity_loader
     @jwt.user_identity_loader
@@ -65,10 +198,46 @@ def create_app(data_path: str = "/circuit_seq_data"):
     # https://flask-jwt-extended.readthedocs.io/en/stable/api/#flask_jwt_extended.JWTManager.user_lookup_loader
     @jwt.user_lookup_loader
     def user_lookup_callback(_jwt_header, jwt_data):
-        identity = jwt_data["sub"]
-        return db.session.execute(
-            db.select(User).filter(User.id == identity)
-        ).scalar_one_or_none()
+        return get_user(jwt_data["sub"])
+
+    # https://flask-jwt-extended.readthedocs.io/en/stable/api/#flask_jwt_extended.JWTManager.token_in_blocklist_loader
+    @jwt.token_in_blocklist_loader
+    def check_if_token_revoked(_jwt_header, jwt_data):
+        # event stream tokens can only be used to open an event stream
+        if jwt_data.get("scope") == "events":
+            return True
+        # access tokens are short-lived and not checked, refresh tokens
+        # are only valid while they are stored in the database
+        if jwt_data["type"] != "refresh":
+            return False
+        return is_refresh_token_revoked(jwt_data["jti"])
+
+    def _conditional_response(
+        version: Tuple, cache_control: str, make_response: Callable
+    ) -> flask.Response:
+        """
+        Returns 304 Not Modified if the client already has the response for this
+        version, otherwise calls `make_response` to generate the response.
+        """
+        etag = hashlib.sha256(repr(version).encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = flask.Response(status=304)
+        else:
+            response = flask.make_response(make_response())
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = cache_control
+        return response
+
+    def _password_hashing_busy_response() -> flask.Response:
+        logger.info(f"  -> too many password hashes queued")
+        response = jsonify("Server is busy, please try again in a few seconds")
+        response.status_code = 503
+        response.headers["Retry-After"] = str(
+            app.config["CIRCUITSEQ_PASSWORD_HASHING_RETRY_AFTER"]
+        )
+        return response
 
     @app.route("/api/login", methods=["POST"])
     def login():
@@ -84,19 +253,50 @@ def create_app(data_path: str = "/circuit_seq_data"):
         if not user.activated:
             logger.info(f"  -> user not activated")
             return jsonify("User account is not yet activated"), 401
-        if not user.check_password(password):
+        try:
+            password_ok = user.check_password(password)
+        except PoolFullError:
+            return _password_hashing_busy_response()
+        if not password_ok:
             logger.info(f"  -> wrong password")
             return jsonify("Incorrect password"), 401
-        logger.info(f"  -> returning JWT access token")
+        logger.info(f"  -> returning JWT access and refresh tokens")
         access_token = create_access_token(identity=user)
-        return jsonify(user=user.as_dict(), access_token=access_token)
+        refresh_token = create_refresh_token(identity=user)
+        refresh_jwt = decode_token(refresh_token)
+        add_refresh_token(
+            refresh_jwt["jti"],
+            user.id,
+            datetime.datetime.fromtimestamp(refresh_jwt["exp"]),
+        )
+        return jsonify(
+            user=user.as_dict(), access_token=access_token, refresh_token=refresh_token
+        )
+
+    @app.route("/api/refresh", methods=["POST"])
+    @jwt_required(refresh=True)
+    def refresh():
+        if not current_user.activated:
+            return jsonify("User account is not yet activated"), 401
+        access_token = create_access_token(identity=current_user)
+        return jsonify(user=current_user.as_dict(), access_token=access_token)
+
+    @app.route("/api/logout", methods=["POST"])
+    @jwt_required(refresh=True)
+    def logout():
+        logger.info(f"Logout request from {current_user.email}")
+        revoke_refresh_token(get_jwt()["jti"])
+        return jsonify("Logged out.")
 
     @app.route("/api/signup", methods=["POST"])
     def signup():
         email = request.json.get("email", None)
         password = request.json.get("password", None)
         logger.info(f"Signup request from {email}")
-        message, code = add_new_user(email, password, False)
+        try:
+            message, code = add_new_user(email, password, False)
+        except PoolFullError:
+            return _password_hashing_busy_response()
         return jsonify(message=message), code
 
     @app.route("/api/activate/<token>")
@@ -114,13 +314,25 @@ def create_app(data_path: str = "/circuit_seq_data"):
         if new_password is None:
             return jsonify("New password missing"), 401
         logger.info(f"Password change request from {current_user.email}")
-        if current_user.set_password(current_password, new_password):
+        user = db.session.get(User, current_user.id)
+        try:
+            password_changed = user.set_password(current_password, new_password)
+        except PoolFullError:
+            return _password_hashing_busy_response()
+        if password_changed:
             return jsonify("Password changed.")
         return jsonify("Failed to change password: current password incorrect."), 401
 
     @app.route("/api/remaining", methods=["GET"])
     def remaining():
-        return remaining_samples_this_week()
+        version = (
+            datetime.date.today(),
+            get_current_settings_id(),
+            get_max_sample_id(),
+        )
+        return _conditional_response(
+            version, "public, no-cache", remaining_samples_this_week
+        )
 
     @app.route("/api/running_options", methods=["GET"])
     @jwt_required()
@@ -128,33 +340,186 @@ def create_app(data_path: str = "/circuit_seq_data"):
         settings = get_current_settings()
         return jsonify(running_options=settings["running_options"])
 
+    def _date_arg(arg: str) -> Optional[datetime.date]:
+        value = request.args.get(arg, None)
+        if value is None:
+            return None
+        return datetime.date.fromisoformat(value)
+
+    def _samples_page(email: Optional[str]):
+        version = (
+            current_user.id,
+            request.full_path,
+            get_start_of_week(),
+            get_samples_version(email),
+        )
+        return _conditional_response(
+            version, "private, no-cache", lambda: _make_samples_page(email)
+        )
+
+    def _make_samples_page(email: Optional[str]):
+        try:
+            sample_rows, next_cursor = get_samples_page(
+                email=email,
+                cursor=request.args.get("cursor", None),
+                page_size=int(request.args.get("page_size", default_page_size)),
+                start_date=_date_arg("start_date"),
+                end_date=_date_arg("end_date"),
+            )
+        except ValueError as e:
+            logger.info(f"  -> invalid samples request: {e}")
+            return jsonify("Invalid samples request"), 401
+        start_of_week = get_start_of_week()
+        current_samples = []
+        previous_samples = []
+        for sample_row in sample_rows:
+            if sample_row.date >= start_of_week:
+                current_samples.append(sample_row._asdict())
+            else:
+                previous_samples.append(sample_row._asdict())
+        return jsonify(
+            current_samples=current_samples,
+            previous_samples=previous_samples,
+            next_cursor=next_cursor,
+        )
+
     @app.route("/api/samples", methods=["GET"])
     @jwt_required()
     def samples():
-        start_of_week = get_start_of_week()
-        current_samples = (
-            db.session.execute(
-                db.select(Sample)
-                .filter(Sample.email == current_user.email)
-                .filter(Sample.date >= start_of_week)
-                .order_by(db.desc("date"))
+        return _samples_page(current_user.email)
+
+    def _server_sent_event(event: str, data: Dict) -> str:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    event_streams = threading.BoundedSemaphore(
+        app.config["CIRCUITSEQ_EVENTS_MAX_STREAMS"]
+    )
+    samples_version_ticker = SamplesVersionTicker(app)
+
+    # EventSource can't set headers, so instead of the access token a short-lived
+    # token that can only be used to open an event stream is passed as a query string
+    @app.route("/api/events/token", methods=["POST"])
+    @jwt_required()
+    def events_token():
+        token = create_access_token(
+            identity=current_user,
+            expires_delta=app.config["CIRCUITSEQ_EVENTS_TOKEN_EXPIRES"],
+            additional_claims={"scope": "events"},
+        )
+        return jsonify(token=token)
+
+    @app.route("/api/events", methods=["GET"])
+    def events():
+        try:
+            token = decode_token(request.args.get("token", ""))
+        except Exception as e:
+            logger.info(f"Invalid event stream token: {e}")
+            return jsonify("Invalid event stream token"), 401
+        if token.get("scope") != "events":
+            return jsonify("Invalid event stream token"), 401
+        user = get_user(token["sub"])
+        if user is None or not user.activated:
+            return jsonify("Invalid event stream token"), 401
+        email = user.email
+        keepalive_interval = app.config["CIRCUITSEQ_EVENTS_KEEPALIVE_INTERVAL"]
+        max_lifetime = app.config["CIRCUITSEQ_EVENTS_MAX_LIFETIME"]
+        if not event_streams.acquire(blocking=False):
+            logger.info(f"Event stream refused for {email}: too many open streams")
+            return jsonify("Too many open event streams"), 503
+        logger.info(f"Event stream opened by {email}")
+
+        response = flask.Response(
+            flask.stream_with_context(
+                _generate_events(email, keepalive_interval, max_lifetime)
+            ),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        # called by the server when the stream ends or the client disconnects
+        response.call_on_close(event_streams.release)
+        return response
+
+    def _generate_events(email: str, keepalive_interval: float, max_lifetime: float):
+        end_time = time.monotonic() + max_lifetime
+        state = None
+        results = None
+        # the client reconnects after this many milliseconds if the stream closes
+        yield "retry: 5000\n\n"
+        with samples_version_ticker.listening():
+            while (time_left := end_time - time.monotonic()) > 0:
+                new_state = samples_version_ticker.wait(
+                    state, min(keepalive_interval, time_left)
+                )
+                if new_state == state:
+                    # comment line: keeps the connection open through proxies
+                    yield ": keepalive\n\n"
+                    continue
+                samples_version, remaining = new_state
+                if state is None or remaining != state[1]:
+                    yield _server_sent_event("remaining", remaining)
+                if state is None or samples_version != state[0]:
+                    new_results = get_results_available(email)
+                    # don't hold on to a db connection while idle
+                    db.session.remove()
+                    for primary_key, flags in new_results.items():
+                        if results is not None and results.get(primary_key) != flags:
+                            yield _server_sent_event(
+                                "results",
+                                {
+                                    "primary_key": primary_key,
+                                    "has_results_fasta": flags[0],
+                                    "has_results_gbk": flags[1],
+                                    "has_results_zip": flags[2],
+                                },
+                            )
+                    results = new_results
+                state = new_state
+        logger.info(f"Event stream of {email} reached its maximum lifetime")
+
+    def _send_file_or_gzip_sibling(file: pathlib.Path) -> flask.Response:
+        # fasta and gbk files have a gzip-compressed copy which is sent instead
+        # if the client accepts it
+        gzip_file = file.with_name(f"{file.name}.gz")
+        if (
+            file.suffix in [".fasta", ".gbk"]
+            and request.accept_encodings["gzip"]
+            and gzip_file.is_file()
+            and gzip_file.stat().st_mtime >= file.stat().st_mtime
+        ):
+            sent_file = gzip_file
+            response = flask.send_file(
+                gzip_file, as_attachment=True, download_name=file.name
             )
-            .scalars()
-            .all()
-        )
-        previous_samples = (
-            db.session.execute(
-                db.select(Sample)
-                .filter(Sample.email == current_user.email)
-                .filter(Sample.date < start_of_week)
-                .order_by(db.desc("date"))
+            response.content_encoding = "gzip"
+        else:
+            sent_file = file
+            response = flask.send_file(file, as_attachment=True)
+        response.vary.add("Accept-Encoding")
+        if request.method == "POST":
+            # send_file only handles Range and conditional headers for GET requests,
+            # but authenticated downloads are POST requests that don't modify anything
+            response.make_conditional(
+                {**request.environ, "REQUEST_METHOD": "GET"},
+                accept_ranges=True,
+                complete_length=sent_file.stat().st_size,
             )
-            .scalars()
-            .all()
+        return response
+
+    def _send_data_file(file: pathlib.Path) -> flask.Response:
+        x_accel_redirect = app.config["CIRCUITSEQ_X_ACCEL_REDIRECT"]
+        if not x_accel_redirect:
+            return _send_file_or_gzip_sibling(file)
+        # nginx serves the file from an internal location mapped onto data_path,
+        # so the request thread is free as soon as this response is returned
+        relative_path = file.resolve().relative_to(pathlib.Path(data_path).resolve())
+        response = flask.Response(
+            mimetype=mimetypes.guess_type(file.name)[0] or "application/octet-stream"
         )
-        return jsonify(
-            current_samples=current_samples, previous_samples=previous_samples
+        response.headers["X-Accel-Redirect"] = urllib.parse.quote(
+            f"{x_accel_redirect.rstrip('/')}/{relative_path.as_posix()}"
         )
+        response.headers.set("Content-Disposition", "attachment", filename=file.name)
+        return response
 
     @app.route("/api/reference_sequence", methods=["POST"])
     @jwt_required()
@@ -187,7 +552,7 @@ def create_app(data_path: str = "/circuit_seq_data"):
             logger.info(f"  -> fasta file {file} not found")
             return jsonify("Fasta file not found"), 401
         logger.info(f"Returning fasta file {file}")
-        return flask.send_file(file, as_attachment=True)
+        return _send_data_file(file)
 
     @app.route("/api/result", methods=["POST"])
     @jwt_required()
@@ -200,12 +565,7 @@ def create_app(data_path: str = "/circuit_seq_data"):
         logger.info(
             f"User {current_user.email} requesting {filetype} results for key {primary_key}"
         )
-        filters = {"primary_key": primary_key}
-        if not current_user.is_admin:
-            filters["email"] = current_user.email
-        user_sample = db.session.execute(
-            db.select(Sample).filter_by(**filters)
-        ).scalar_one_or_none()
+        user_sample = _get_user_sample(primary_key)
         if user_sample is None:
             logger.info(f"  -> sample with key {primary_key} not found")
             return jsonify("Sample not found"), 401
@@ -218,14 +578,188 @@ def create_app(data_path: str = "/circuit_seq_data"):
                 f"  -> sample with key {primary_key} found but no {filetype} results available"
             )
             return jsonify(f"No {filetype} results available"), 401
-        year, week, day = user_sample.date.isocalendar()
-        filename = f"{data_path}/{year}/{week}/results/{user_sample.primary_key}_{user_sample.name}.{filetype}"
-        file = pathlib.Path(filename)
+        return _send_result_file(user_sample, filetype)
+
+    def _get_user_sample(primary_key: Optional[str]) -> Optional[Sample]:
+        # admins can access any sample, users only their own samples
+        filters = {"primary_key": primary_key}
+        if not current_user.is_admin:
+            filters["email"] = current_user.email
+        return db.session.execute(
+            db.select(Sample).filter_by(**filters)
+        ).scalar_one_or_none()
+
+    def _get_user_sample_results_zip(
+        primary_key: Optional[str],
+    ) -> Tuple[Optional[pathlib.Path], Optional[str]]:
+        user_sample = _get_user_sample(primary_key)
+        if user_sample is None:
+            logger.info(f"  -> sample with key {primary_key} not found")
+            return None, "Sample not found"
+        if not user_sample.has_results_zip:
+            logger.info(
+                f"  -> sample with key {primary_key} found but no zip results available"
+            )
+            return None, "No zip results available"
+        file = _result_file_path(user_sample, "zip")
+        if not file.is_file():
+            logger.info(f"  -> zip file {file} not found")
+            return None, "Results zip file not found"
+        return file, None
+
+    @app.route("/api/result_zip_members", methods=["POST"])
+    @jwt_required()
+    def result_zip_members():
+        primary_key = request.json.get("primary_key", None)
+        logger.info(
+            f"User {current_user.email} listing zip results for key {primary_key}"
+        )
+        file, error = _get_user_sample_results_zip(primary_key)
+        if file is None:
+            return jsonify(error), 401
+        try:
+            return jsonify(list_zip_members(file))
+        except zipfile.BadZipFile:
+            logger.warning(f"  -> invalid zip file {file}")
+            return jsonify("Invalid results zip file"), 401
+
+    @app.route("/api/result_zip_member", methods=["POST"])
+    @jwt_required()
+    def result_zip_member():
+        primary_key = request.json.get("primary_key", None)
+        member = request.json.get("member", None)
+        logger.info(
+            f"User {current_user.email} requesting {member} from zip results for key {primary_key}"
+        )
+        file, error = _get_user_sample_results_zip(primary_key)
+        if file is None:
+            return jsonify(error), 401
+        try:
+            member_file = open_zip_member(file, str(member))
+        except zipfile.BadZipFile:
+            logger.warning(f"  -> invalid zip file {file}")
+            return jsonify("Invalid results zip file"), 401
+        if member_file is None:
+            logger.info(f"  -> {member} not found in {file}")
+            return jsonify(f"File {member} not found in results zip file"), 401
+        member_stream, member_size = member_file
+        logger.info(f"Returning {member} from zip file {file}")
+        response = flask.send_file(
+            member_stream,
+            as_attachment=True,
+            download_name=pathlib.PurePosixPath(member).name,
+            last_modified=file.stat().st_mtime,
+        )
+        response.content_length = member_size
+        return response
+
+    @app.route("/api/result/<token>", methods=["GET"])
+    def result_download_link(token: str):
+        decoded_token = decode_result_download_token(
+            token,
+            app.config["JWT_SECRET_KEY"],
+            int(app.config["CIRCUITSEQ_RESULT_DOWNLOAD_LINK_EXPIRES"].total_seconds()),
+        )
+        if decoded_token is None:
+            return jsonify("Invalid or expired download link"), 401
+        primary_key, filetype = decoded_token
+        logger.info(f"Download link for {filetype} results for key {primary_key}")
+        sample = db.session.execute(
+            db.select(Sample).filter_by(primary_key=primary_key)
+        ).scalar_one_or_none()
+        if sample is None:
+            logger.info(f"  -> sample with key {primary_key} not found")
+            return jsonify("Sample not found"), 401
+        return _send_result_file(sample, filetype)
+
+    def _result_file_path(sample: Sample, filetype: str) -> pathlib.Path:
+        year, week, day = sample.date.isocalendar()
+        return pathlib.Path(
+            f"{data_path}/{year}/{week}/results/{sample.primary_key}_{sample.name}.{filetype}"
+        )
+
+    def _send_result_file(sample: Sample, filetype: str):
+        file = _result_file_path(sample, filetype)
         if not file.is_file():
             logger.info(f"  -> {filetype} file {file} not found")
             return jsonify(f"Results {filetype} file not found"), 401
         logger.info(f"Returning {filetype} file {file}")
-        return flask.send_file(file, as_attachment=True)
+        return _send_data_file(file)
+
+    def _upload_id_arg() -> Optional[str]:
+        upload_id = request.form.get("upload_id", None)
+        if upload_id is None and request.is_json:
+            upload_id = request.json.get("upload_id", None)
+        return upload_id
+
+    @app.route("/api/uploads", methods=["POST"])
+    @jwt_required()
+    def create_resumable_upload():
+        filename = request.json.get("filename", "")
+        try:
+            length = int(request.json.get("length", 0))
+        except ValueError:
+            return jsonify(message="Invalid upload length"), 401
+        upload, code = create_upload(
+            current_user.email,
+            filename,
+            length,
+            request.json.get("sha256", None),
+            data_path,
+        )
+        if code != 200:
+            return jsonify(message=upload), code
+        response = jsonify(upload_id=upload.id, offset=upload.offset)
+        response.status_code = 201
+        response.headers["Location"] = f"/api/uploads/{upload.id}"
+        return response
+
+    def _upload_response(
+        upload: Upload, status: int = 200, message: str = ""
+    ) -> flask.Response:
+        if status == 204:
+            response = flask.Response(status=204)
+        else:
+            response = jsonify(
+                upload_id=upload.id,
+                filename=upload.filename,
+                length=upload.length,
+                offset=upload.offset,
+                sha256=upload.sha256,
+                message=message,
+            )
+            response.status_code = status
+        response.headers["Upload-Offset"] = str(upload.offset)
+        response.headers["Upload-Length"] = str(upload.length)
+        response.headers["Cache-Control"] = "no-store"
+        return response
+
+    @app.route("/api/uploads/<upload_id>", methods=["GET", "PATCH"])
+    @jwt_required()
+    def resumable_upload(upload_id: str):
+        upload = get_upload(upload_id, current_user.email)
+        if upload is None:
+            return jsonify(message="Upload not found"), 401
+        if request.method != "PATCH":
+            # GET or HEAD
+            return _upload_response(upload)
+        try:
+            offset = int(request.headers["Upload-Offset"])
+            chunk_sha256 = None
+            if "Upload-Checksum" in request.headers:
+                algorithm, checksum = request.headers["Upload-Checksum"].split(" ")
+                if algorithm != "sha256":
+                    return jsonify(message="Unsupported checksum algorithm"), 401
+                chunk_sha256 = base64.b64decode(checksum)
+        except Exception:
+            return jsonify(message="Invalid Upload-Offset or Upload-Checksum"), 401
+        message, code = write_upload_chunk(
+            upload, offset, request.stream, chunk_sha256, data_path
+        )
+        db.session.refresh(upload)
+        if code != 200:
+            return _upload_response(upload, code, message)
+        return _upload_response(upload, 204)
 
     @app.route("/api/sample", methods=["POST"])
     @jwt_required()
@@ -236,6 +770,13 @@ def create_app(data_path: str = "/circuit_seq_data"):
         running_option = form_as_dict.get("running_option", "")
         concentration = int(form_as_dict.get("concentration", "0"))
         reference_sequence_file = request.files.to_dict().get("file", None)
+        upload_id = form_as_dict.get("upload_id", None)
+        if upload_id is not None:
+            upload, reference_sequence_file, message = get_completed_upload_file(
+                upload_id, email, data_path
+            )
+            if upload is None:
+                return jsonify(message=message), 401
         logger.info(f"Adding sample {name} from {email}")
         new_sample, error_message = add_new_sample(
             email,
@@ -247,9 +788,55 @@ def create_app(data_path: str = "/circuit_seq_data"):
         )
         if new_sample is not None:
             logger.info(f"  - > success")
+            if upload_id is not None:
+                delete_upload(upload, data_path)
             return jsonify(sample=new_sample)
         return jsonify(message=error_message), 401
 
+    @app.route("/api/samples/batch", methods=["POST"])
+    @jwt_required()
+    def add_samples():
+        email = current_user.email
+        reference_sequence_files = request.files.to_dict()
+        try:
+            manifest = json.loads(request.form.get("manifest", ""))
+            new_samples = [
+                {
+                    "name": entry.get("name", ""),
+                    "running_option": entry.get("running_option", ""),
+                    "concentration": int(entry.get("concentration", "0")),
+                    "reference_sequence_file": reference_sequence_files[entry["file"]]
+                    if entry.get("file") is not None
+                    else None,
+                }
+                for entry in manifest
+            ]
+        except Exception as e:
+            logger.info(f"Invalid sample manifest from {email}: {e}")
+            return jsonify(message="Invalid sample manifest"), 401
+        logger.info(f"Adding {len(new_samples)} samples from {email}")
+        if len(new_samples) == 0:
+            return jsonify(message="No samples in manifest"), 401
+        # each uploaded file can only be read once
+        file_fields = [
+            entry["file"] for entry in manifest if entry.get("file") is not None
+        ]
+        duplicate_file_fields = sorted(
+            {field for field in file_fields if file_fields.count(field) > 1}
+        )
+        if duplicate_file_fields:
+            return (
+                jsonify(
+                    message=f"Reference sequence file {duplicate_file_fields[0]} is used by more than one sample"
+                ),
+                401,
+            )
+        samples, error_message = add_new_samples(email, new_samples, data_path)
+        if len(samples) > 0:
+            logger.info(f"  - > success")
+            return jsonify(samples=samples)
+        return jsonify(message=error_message), 401
+
     @app.route("/api/admin/settings", methods=["GET", "POST"])
     @jwt_required()
     def admin_settings():
@@ -259,35 +846,50 @@ def create_app(data_path: str = "/circuit_seq_data"):
             message, code = set_current_settings(current_user.email, request.json)
             return jsonify(message=message), code
         else:
-            return get_current_settings()
+            return _conditional_response(
+                (current_user.id, get_current_settings_id()),
+                "private, no-cache",
+                get_current_settings,
+            )
 
     @app.route("/api/admin/samples", methods=["GET"])
     @jwt_required()
     def admin_all_samples():
         if not current_user.is_admin:
             return jsonify("Admin account required"), 401
-        year, week, day = datetime.date.today().isocalendar()
-        start_of_week = datetime.date.fromisocalendar(year, week, 1)
-        current_samples = (
-            db.session.execute(
-                db.select(Sample)
-                .filter(Sample.date >= start_of_week)
-                .order_by(db.desc("date"))
-            )
-            .scalars()
-            .all()
-        )
-        previous_samples = (
-            db.session.execute(
-                db.select(Sample)
-                .filter(Sample.date < start_of_week)
-                .order_by(db.desc("date"))
+        return _samples_page(None)
+
+    def _bool_arg(arg: str) -> Optional[bool]:
+        value = request.args.get(arg, None)
+        if value is None:
+            return None
+        if value.lower() not in ["true", "false"]:
+            raise ValueError(f"Invalid {arg} value {value}")
+        return value.lower() == "true"
+
+    @app.route("/api/admin/samples/search", methods=["GET"])
+    @jwt_required()
+    def admin_search_samples():
+        if not current_user.is_admin:
+            return jsonify("Admin account required"), 401
+        try:
+            sample_rows, next_cursor = get_samples_page(
+                email=request.args.get("email", None),
+                cursor=request.args.get("cursor", None),
+                page_size=int(request.args.get("page_size", default_page_size)),
+                start_date=_date_arg("start_date"),
+                end_date=_date_arg("end_date"),
+                running_option=request.args.get("running_option", None),
+                primary_key_prefix=request.args.get("primary_key", None),
+                text=request.args.get("name", None),
+                has_results=_bool_arg("has_results"),
             )
-            .scalars()
-            .all()
-        )
+        except ValueError as e:
+            logger.info(f"  -> invalid search request: {e}")
+            return jsonify("Invalid search request"), 401
         return jsonify(
-            current_samples=current_samples, previous_samples=previous_samples
+            samples=[sample_row._asdict() for sample_row in sample_rows],
+            next_cursor=next_cursor,
         )
 
     @app.route("/api/admin/zipsamples", methods=["POST"])
@@ -298,8 +900,38 @@ def create_app(data_path: str = "/circuit_seq_data"):
         logger.info(
             f"Request for zipfile of samples from Admin user {current_user.email}"
         )
-        zip_file = update_samples_zipfile(data_path, datetime.date.today())
-        return flask.send_file(zip_file, as_attachment=True)
+        # an ISO year and week, or a start and end date: defaults to this week
+        args = request.get_json(silent=True) or request.form
+        try:
+            start_date, end_date = get_date_range(
+                args.get("year"),
+                args.get("week"),
+                args.get("start_date"),
+                args.get("end_date"),
+            )
+        except ValueError as e:
+            logger.info(f"  -> invalid date range: {e}")
+            return jsonify(f"Invalid date range: {e}"), 401
+        max_days = app.config["CIRCUITSEQ_EXPORT_MAX_DAYS"]
+        if (end_date - start_date).days >= max_days:
+            logger.info(f"  -> date range longer than {max_days} days")
+            return (
+                jsonify(f"Invalid date range: at most {max_days} days can be exported"),
+                401,
+            )
+        logger.info(f"  -> samples from {start_date} to {end_date}")
+        fingerprint, zip_stream = stream_samples_zipfile(
+            data_path, start_date, end_date
+        )
+        # the zip file is generated as it is sent
+        response = flask.Response(zip_stream, mimetype="application/zip")
+        filename = "samples.zip"
+        if start_date != get_start_of_week():
+            filename = f"samples_{start_date}_{end_date}.zip"
+        response.headers.set("Content-Disposition", "attachment", filename=filename)
+        response.set_etag(fingerprint)
+        response.make_conditional({**request.environ, "REQUEST_METHOD": "GET"})
+        return response
 
     @app.route("/api/admin/users", methods=["GET"])
     @jwt_required()
@@ -309,6 +941,16 @@ def create_app(data_path: str = "/circuit_seq_data"):
             return jsonify(users=[user.as_dict() for user in users])
         return jsonify("Admin account required"), 401
 
+    @app.route("/api/admin/metrics", methods=["GET"])
+    @jwt_required()
+    def admin_metrics():
+        if not current_user.is_admin:
+            return jsonify("Admin account required"), 401
+        return jsonify(
+            password_hashing=model.password_hashing_pool.stats(),
+            email_outbox=get_outbox_stats(),
+        )
+
     @app.route("/api/admin/token", methods=["GET"])
     @jwt_required()
     def admin_token():
@@ -319,18 +961,90 @@ def create_app(data_path: str = "/circuit_seq_data"):
             return jsonify(access_token=access_token)
         return jsonify("Admin account required"), 401
 
+    def _queue_result_job(kind: str):
+        if not current_user.is_admin:
+            return jsonify("Admin account required"), 401
+        upload_id = _upload_id_arg()
+        if upload_id is not None:
+            upload, zipfile, message = get_completed_upload_file(
+                upload_id, current_user.email, data_path
+            )
+            if upload is None:
+                return jsonify(message=message), 401
+        else:
+            zipfile = request.files.to_dict().get("file", None)
+            if zipfile is None:
+                return jsonify("No file uploaded"), 401
+        logger.info(f"{kind} {zipfile} uploaded by {current_user.email}")
+        job, code = create_result_job(kind, zipfile, data_path)
+        # keep the upload if the job was rejected before the file was used,
+        # e.g. for an unknown primary key, so it can be submitted again
+        if upload_id is not None and (code == 200 or not zipfile.exists()):
+            delete_upload(upload, data_path)
+        if code != 200:
+            return jsonify(message=job), code
+        result_job_pool.submit(job.id)
+        return (
+            jsonify(message=f"Queued {job.filename} as job {job.id}", job_id=job.id),
+            202,
+        )
+
     @app.route("/api/admin/result", methods=["POST"])
     @jwt_required()
     def admin_upload_result():
+        return _queue_result_job("result")
+
+    @app.route("/api/admin/plate_result", methods=["POST"])
+    @jwt_required()
+    def admin_upload_plate_result():
+        return _queue_result_job("plate_result")
+
+    @app.route("/api/admin/jobs/<int:job_id>", methods=["GET"])
+    @jwt_required()
+    def admin_result_job(job_id: int):
         if not current_user.is_admin:
             return jsonify("Admin account required"), 401
-        email = current_user.email
-        zipfile = request.files.to_dict().get("file", None)
-        logger.info(f"Results uploaded by {email}")
-        message, code = process_result(zipfile, data_path)
-        return jsonify(message=message), code
+        job = db.session.get(ResultJob, job_id)
+        if job is None:
+            return jsonify("Job not found"), 401
+        return jsonify(job)
+
+    @app.route("/api/admin/export/<table>", methods=["GET"])
+    @jwt_required()
+    def admin_export(table: str):
+        if not current_user.is_admin:
+            return jsonify("Admin account required"), 401
+        export_format = request.args.get("format", "parquet")
+        logger.info(
+            f"Request for {export_format} export of {table} from Admin user {current_user.email}"
+        )
+        export_file = tempfile.TemporaryFile()
+        try:
+            write_export(table, export_format, export_file)
+        except ExportError as e:
+            export_file.close()
+            logger.info(f"  -> {e}")
+            return jsonify(str(e)), 401
+        export_file.seek(0)
+        return flask.send_file(
+            export_file,
+            as_attachment=True,
+            download_name=f"{table}.{export_format}",
+            mimetype="application/octet-stream",
+        )
 
     with app.app_context():
         db.create_all()
+        create_missing_columns()
+        create_missing_indexes()
+        create_search_index()
+    if start_workers:
+        # process any jobs that were queued or interrupted when the server stopped,
+        # and periodically delete expired uploads
+        result_job_pool.resume()
+        resume_reference_parse_jobs(app)
+        start_expired_upload_cleanup(
+            app, app.config["CIRCUITSEQ_UPLOAD_CLEANUP_INTERVAL"]
+        )
 
     return app
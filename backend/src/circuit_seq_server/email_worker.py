@@ -0,0 +1,140 @@
+from __future__ import annotations
+from typing import Optional
+import time
+import email
+import email.policy
+import smtplib
+import datetime
+from email.message import EmailMessage
+from circuit_seq_server.logger import get_logger
+from circuit_seq_server.model import db, OutgoingEmail
+
+logger = get_logger("CircuitSeqServer")
+
+
+class EmailWorker:
+    """
+    Sends the emails queued in the outbox by `enqueue_email`.
+
+    A single SMTP connection is re-used for all emails until it has been idle for
+    `idle_timeout` seconds. An email that fails to send is retried with
+    exponential backoff, and after `max_attempts` failed attempts it is left
+    in the outbox marked as failed. Must be used within an app context, and
+    only one worker should be running at a time.
+    """
+
+    def __init__(
+        self,
+        smtp_host: str = "email:587",
+        retry_delay: float = 30,
+        max_retry_delay: float = 3600,
+        max_attempts: int = 12,
+        idle_timeout: float = 60,
+        batch_size: int = 100,
+    ):
+        self.smtp_host = smtp_host
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.idle_timeout = idle_timeout
+        self.batch_size = batch_size
+        self._smtp: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+
+    def _send(self, msg: EmailMessage) -> None:
+        if self._smtp is not None:
+            try:
+                self._smtp.send_message(msg)
+                self._last_used = time.monotonic()
+                return
+            except smtplib.SMTPServerDisconnected:
+                # the server has closed the connection: reconnect and try again
+                logger.info("SMTP connection closed by server, reconnecting")
+                self.close()
+        self._smtp = smtplib.SMTP(self.smtp_host)
+        self._smtp.send_message(msg)
+        self._last_used = time.monotonic()
+
+    def close(self) -> None:
+        """Closes the SMTP connection if there is one"""
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except smtplib.SMTPException:
+            self._smtp.close()
+        self._smtp = None
+
+    def close_if_idle(self) -> None:
+        if time.monotonic() - self._last_used > self.idle_timeout:
+            self.close()
+
+    def _retry_delay(self, attempts: int) -> datetime.timedelta:
+        return datetime.timedelta(
+            seconds=min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+        )
+
+    def send_queued_emails(self) -> int:
+        """
+        Sends emails from the outbox that are due to be sent, returns the number sent.
+
+        Stops at the first email that fails to send, which is rescheduled.
+        """
+        n_sent = 0
+        while True:
+            outgoing_emails = (
+                db.session.execute(
+                    db.select(OutgoingEmail)
+                    .where(OutgoingEmail.next_attempt <= datetime.datetime.now())
+                    .order_by(OutgoingEmail.id)
+                    .limit(self.batch_size)
+                )
+                .scalars()
+                .all()
+            )
+            if len(outgoing_emails) == 0:
+                return n_sent
+            for outgoing_email in outgoing_emails:
+                msg = email.message_from_bytes(
+                    outgoing_email.message, policy=email.policy.default
+                )
+                try:
+                    self._send(msg)
+                except Exception as e:
+                    self.close()
+                    outgoing_email.attempts += 1
+                    outgoing_email.last_error = str(e)
+                    if outgoing_email.attempts >= self.max_attempts:
+                        logger.error(
+                            f"Failed to send email {outgoing_email.id} to "
+                            f"{outgoing_email.recipient}, giving up after "
+                            f"{outgoing_email.attempts} attempts: {e}"
+                        )
+                        outgoing_email.next_attempt = None
+                    else:
+                        delay = self._retry_delay(outgoing_email.attempts)
+                        logger.warning(
+                            f"Failed to send email {outgoing_email.id} to "
+                            f"{outgoing_email.recipient}, retrying in {delay}: {e}"
+                        )
+                        outgoing_email.next_attempt = datetime.datetime.now() + delay
+                    db.session.commit()
+                    return n_sent
+                logger.info(
+                    f"Sent email {outgoing_email.id} to {outgoing_email.recipient}"
+                )
+                db.session.delete(outgoing_email)
+                db.session.commit()
+                n_sent += 1
+
+    def run(self, poll_interval: float = 5) -> None:
+        logger.info(f"Email worker sending queued emails via {self.smtp_host}")
+        while True:
+            try:
+                self.send_queued_emails()
+            except Exception as e:
+                logger.exception(f"Email worker error: {e}")
+                db.session.rollback()
+            self.close_if_idle()
+            db.session.remove()
+            time.sleep(poll_interval)
@@ -0,0 +1,122 @@
+from __future__ import annotations
+from typing import BinaryIO, Dict, Iterator, List, Tuple, Union
+import pathlib
+from circuit_seq_server.logger import get_logger
+from circuit_seq_server.model import db, Sample, User
+
+logger = get_logger("CircuitSeqServer")
+
+export_formats = ["parquet", "feather"]
+
+# the columns of each table that are exported, in order
+export_tables: Dict[str, Tuple[db.Model, List[str]]] = {
+    "samples": (
+        Sample,
+        [
+            "id",
+            "primary_key",
+            "date",
+            "email",
+            "name",
+            "running_option",
+            "concentration",
+            "reference_sequence_description",
+            "has_results_fasta",
+            "has_results_gbk",
+            "has_results_zip",
+        ],
+    ),
+    "users": (User, ["id", "email", "activated", "is_admin"]),
+}
+
+
+class ExportError(ValueError):
+    """An export was requested that cannot be written"""
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ExportError(
+            "Exporting requires pyarrow: pip install circuit_seq_server[export]"
+        ) from e
+    return pyarrow
+
+
+def _arrow_schema(pa, table: str):
+    arrow_types = {
+        db.Integer: pa.int64(),
+        db.String: pa.string(),
+        db.Date: pa.date32(),
+        db.Boolean: pa.bool_(),
+    }
+    model, columns = export_tables[table]
+    fields = []
+    for column in columns:
+        sql_column = model.__table__.columns[column]
+        arrow_type = next(
+            arrow_type
+            for sql_type, arrow_type in arrow_types.items()
+            if isinstance(sql_column.type, sql_type)
+        )
+        fields.append(pa.field(column, arrow_type, nullable=sql_column.nullable))
+    return pa.schema(fields)
+
+
+def _record_batches(pa, table: str, schema, batch_size: int) -> Iterator:
+    model, columns = export_tables[table]
+    # rows are fetched from the database in batches of `batch_size`
+    result = db.session.execute(
+        db.select(*[getattr(model, column) for column in columns])
+        .order_by(model.id)
+        .execution_options(yield_per=batch_size)
+    )
+    for rows in result.partitions():
+        yield pa.RecordBatch.from_arrays(
+            [
+                pa.array(values, type=field.type)
+                for values, field in zip(zip(*rows), schema)
+            ],
+            schema=schema,
+        )
+
+
+def write_export(
+    table: str,
+    export_format: str,
+    output: Union[str, pathlib.Path, BinaryIO],
+    batch_size: int = 10000,
+) -> int:
+    """
+    Writes the `samples` or `users` table to `output` as a Parquet or Feather
+    file, where the rows are read and written in batches.
+
+    Returns the number of rows written. Raises ExportError if the table or
+    format is not supported, or if pyarrow is not installed.
+    """
+    if table not in export_tables:
+        raise ExportError(f"Unknown table {table}")
+    if export_format not in export_formats:
+        raise ExportError(f"Unknown export format {export_format}")
+    pa = _import_pyarrow()
+    schema = _arrow_schema(pa, table)
+    if isinstance(output, pathlib.Path):
+        output = str(output)
+    logger.info(f"Exporting {table} as {export_format}")
+    if export_format == "parquet":
+        writer = pa.parquet.ParquetWriter(output, schema)
+    else:
+        # feather version 2 is the arrow ipc file format
+        writer = pa.ipc.new_file(
+            output, schema, options=pa.ipc.IpcWriteOptions(compression="lz4")
+        )
+    n_rows = 0
+    with writer:
+        for record_batch in _record_batches(pa, table, schema, batch_size):
+            writer.write_batch(record_batch)
+            n_rows += record_batch.num_rows
+    logger.info(f"  -> exported {n_rows} rows")
+    return n_rows
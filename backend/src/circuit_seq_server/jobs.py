@@ -0,0 +1,154 @@
+from __future__ import annotations
+from typing import Dict, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import datetime
+import threading
+import time
+import flask
+from circuit_seq_server.logger import get_logger
+from circuit_seq_server.model import (
+    claim_result_job,
+    run_result_job,
+    requeue_interrupted_result_jobs,
+    delete_expired_uploads,
+    get_current_settings_id,
+    get_max_sample_id,
+    get_samples_version,
+    remaining_samples_this_week,
+)
+
+logger = get_logger("CircuitSeqServer")
+
+
+class ResultJobPool:
+    """
+    Processes queued result jobs on at most `max_workers` threads.
+
+    Jobs are claimed atomically before they are run, so a job submitted more
+    than once is only processed once. `resume` re-queues jobs that were
+    interrupted by a server restart, which assumes a single server process.
+    """
+
+    def __init__(self, app: flask.Flask, max_workers: int):
+        self._app = app
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="result-job"
+        )
+
+    def submit(self, job_id: int) -> None:
+        self._executor.submit(self._run, job_id)
+
+    def _run(self, job_id: int) -> None:
+        with self._app.app_context():
+            try:
+                if claim_result_job(job_id):
+                    run_result_job(job_id, self._app.config["CIRCUITSEQ_DATA_PATH"])
+            except Exception as e:
+                logger.exception(f"Result job {job_id} error: {e}")
+
+    def resume(self) -> None:
+        with self._app.app_context():
+            job_ids = requeue_interrupted_result_jobs()
+        if job_ids:
+            logger.info(f"Resuming {len(job_ids)} queued result jobs")
+        for job_id in job_ids:
+            self.submit(job_id)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+
+def start_expired_upload_cleanup(app: flask.Flask, interval: float) -> threading.Thread:
+    """
+    Deletes expired uploads every `interval` seconds on a daemon thread, so they
+    don't accumulate if no new uploads are created.
+    """
+
+    def _run() -> None:
+        while True:
+            with app.app_context():
+                try:
+                    delete_expired_uploads(app.config["CIRCUITSEQ_DATA_PATH"])
+                except Exception as e:
+                    logger.exception(f"Expired upload cleanup error: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=_run, name="upload-cleanup", daemon=True)
+    thread.start()
+    return thread
+
+
+class SamplesVersionTicker:
+    """
+    Polls the version of the samples every `CIRCUITSEQ_EVENTS_POLL_INTERVAL`
+    seconds on a single daemon thread, which is shared by all the event streams of this process, so the
+    cost of polling doesn't grow with the number of open streams.
+
+    The thread runs while any stream is listening, and the remaining samples
+    this week are only computed when they may have changed.
+    """
+
+    def __init__(self, app: flask.Flask):
+        self._app = app
+        self._condition = threading.Condition()
+        self._n_listeners = 0
+        self._thread: Optional[threading.Thread] = None
+        # (samples version, remaining samples), or None until first polled
+        self._state: Optional[Tuple[Tuple, Dict]] = None
+
+    @contextlib.contextmanager
+    def listening(self):
+        with self._condition:
+            self._n_listeners += 1
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="samples-version", daemon=True
+                )
+                self._thread.start()
+        try:
+            yield self
+        finally:
+            with self._condition:
+                self._n_listeners -= 1
+
+    def wait(
+        self, state: Optional[Tuple[Tuple, Dict]], timeout: float
+    ) -> Optional[Tuple[Tuple, Dict]]:
+        """
+        Waits up to `timeout` seconds for the (samples version, remaining samples)
+        to differ from `state`, and returns them.
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._state is not None and self._state != state, timeout
+            )
+            return self._state
+
+    def _run(self) -> None:
+        remaining_version = None
+        remaining = None
+        while True:
+            with self._condition:
+                if self._n_listeners == 0:
+                    self._thread = None
+                    self._state = None
+                    return
+            with self._app.app_context():
+                try:
+                    new_remaining_version = (
+                        datetime.date.today(),
+                        get_current_settings_id(),
+                        get_max_sample_id(),
+                    )
+                    if new_remaining_version != remaining_version:
+                        remaining = remaining_samples_this_week()
+                        remaining_version = new_remaining_version
+                    state = (get_samples_version(), remaining)
+                    with self._condition:
+                        if state != self._state:
+                            self._state = state
+                            self._condition.notify_all()
+                except Exception as e:
+                    logger.exception(f"Samples version poll error: {e}")
+            time.sleep(self._app.config["CIRCUITSEQ_EVENTS_POLL_INTERVAL"])
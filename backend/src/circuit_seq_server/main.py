@@ -1,15 +1,61 @@
 from __future__ import annotations
+from typing import Optional
 import click
 from circuit_seq_server import create_app
+from circuit_seq_server.email_worker import EmailWorker
+from circuit_seq_server.export import export_formats, export_tables
+from circuit_seq_server.export import write_export, ExportError
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option("--host", default="localhost", show_default=True)
 @click.option("--port", default=8080, show_default=True)
 @click.option("--data-path", default=".", show_default=True)
-def main(host: str, port: int, data_path: str):
+@click.pass_context
+def main(ctx: click.Context, host: str, port: int, data_path: str):
+    if ctx.invoked_subcommand is None:
+        app = create_app(data_path=data_path, start_workers=True)
+        app.run(host=host, port=port)
+
+
+@main.command()
+@click.option("--data-path", default=".", show_default=True)
+@click.option("--smtp-host", default="email:587", show_default=True)
+@click.option("--poll-interval", default=5.0, show_default=True)
+def email_worker(data_path: str, smtp_host: str, poll_interval: float):
+    """Send the queued emails"""
+    app = create_app(data_path=data_path)
+    with app.app_context():
+        EmailWorker(smtp_host=smtp_host).run(poll_interval=poll_interval)
+
+
+@main.command()
+@click.option("--data-path", default=".", show_default=True)
+@click.option(
+    "--table",
+    type=click.Choice(list(export_tables)),
+    default="samples",
+    show_default=True,
+)
+@click.option(
+    "--format",
+    "export_format",
+    type=click.Choice(export_formats),
+    default="parquet",
+    show_default=True,
+)
+@click.option("--output", default=None, help="Output file  [default: TABLE.FORMAT]")
+def export(data_path: str, table: str, export_format: str, output: Optional[str]):
+    """Export the samples or users table as a Parquet or Feather file"""
+    if output is None:
+        output = f"{table}.{export_format}"
     app = create_app(data_path=data_path)
-    app.run(host=host, port=port)
+    with app.app_context():
+        try:
+            n_rows = write_export(table, export_format, output)
+        except ExportError as e:
+            raise click.ClickException(str(e))
+    click.echo(f"Exported {n_rows} {table} to {output}")
 
 
 if __name__ == "__main__":
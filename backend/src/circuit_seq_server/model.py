@@ -1,6 +1,15 @@
 from __future__ import annotations
-from typing import Optional, Dict, Tuple, List
-import smtplib
+from typing import Optional, Dict, Tuple, List, Union, Callable, BinaryIO, Set
+from typing import Iterator
+import copy
+import hashlib
+import io
+import json
+import secrets
+import os
+import threading
+import time
+import multiprocessing
 from email.message import EmailMessage
 import re
 import flask
@@ -10,18 +19,38 @@ import argon2
 import tempfile
 import pathlib
 import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, wait
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.engine import Row
 from werkzeug.datastructures import FileStorage
 from dataclasses import dataclass
 from circuit_seq_server.logger import get_logger
 from circuit_seq_server.utils import get_primary_key
 from circuit_seq_server.utils import get_start_of_week
-from circuit_seq_server.utils import parse_seq_to_fasta
+from circuit_seq_server.utils import gzip_file
+from circuit_seq_server.utils import write_gzip_sibling
+from circuit_seq_server.utils import parse_seq_to_fasta_and_gzip_process
+from circuit_seq_server.utils import stream_zip
+from circuit_seq_server.utils import encode_result_download_token
 import csv
 from circuit_seq_server.utils import encode_activation_token, decode_activation_token
+from circuit_seq_server.utils import TTLCache
+from circuit_seq_server.utils import MeteredThreadPool
+from circuit_seq_server.utils import ZipLimits, ZipLimitError, ByteBudget
+from circuit_seq_server.utils import check_zip_limits, extract_zip_member
 
 db = SQLAlchemy()
 ph = argon2.PasswordHasher()
+# argon2 hashing is cpu and memory intensive: limit how many run concurrently,
+# and how many request threads can be waiting for one
+password_hashing_pool = MeteredThreadPool(max_workers=4, max_queued=8)
+# each reference sequence file is parsed in a separate process, started by
+# one of the threads of this pool, which limits how many run concurrently
+reference_parsing_processes = 2
+reference_parsing_pool = ThreadPoolExecutor(
+    max_workers=reference_parsing_processes, thread_name_prefix="reference-parse"
+)
 logger = get_logger("CircuitSeqServer")
 
 
@@ -42,26 +71,39 @@ def default_settings_dict() -> Dict:
     }
 
 
+# most recent settings for each database, stored with the id of the Settings row
+# they were loaded from, so that only a cheap max(id) query is needed per call
+_settings_cache: Dict[str, Tuple[int, Dict]] = {}
+
+
+def get_current_settings_id() -> Optional[int]:
+    return db.session.execute(db.select(db.func.max(Settings.id))).scalar_one()
+
+
 def get_current_settings() -> Dict:
-    settings_tuple = db.session.execute(
-        db.select(Settings).order_by(db.desc(Settings.id))
-    ).first()
-    if settings_tuple is not None:
-        settings_dict = settings_tuple[0].settings_dict
-        for key, value in default_settings_dict().items():
-            # use default values for any missing keys
-            if key not in settings_dict:
-                settings_dict[key] = value
-        return settings_dict
-    # no settings in db: create default settings and add to db
-    settings = Settings(
-        datetime=datetime.datetime.today(),
-        email="default",
-        settings_dict=default_settings_dict(),
-    )
-    db.session.add(settings)
-    db.session.commit()
-    return settings.settings_dict
+    cache_key = str(db.engine.url)
+    settings_id = get_current_settings_id()
+    if settings_id is None:
+        # no settings in db: create default settings and add to db
+        settings = Settings(
+            datetime=datetime.datetime.today(),
+            email="default",
+            settings_dict=default_settings_dict(),
+        )
+        db.session.add(settings)
+        db.session.commit()
+        settings_id = settings.id
+        _settings_cache[cache_key] = (settings_id, default_settings_dict())
+    cached_settings = _settings_cache.get(cache_key)
+    if cached_settings is None or cached_settings[0] != settings_id:
+        # settings were changed, either by this process or by another worker
+        settings_dict = default_settings_dict()
+        # use default values for any missing keys
+        settings_dict.update(db.session.get(Settings, settings_id).settings_dict)
+        cached_settings = (settings_id, settings_dict)
+        _settings_cache[cache_key] = cached_settings
+    # return a copy so that callers can safely modify it
+    return copy.deepcopy(cached_settings[1])
 
 
 def set_current_settings(email: str, settings_dict: Dict) -> Tuple[str, int]:
@@ -76,6 +118,7 @@ def set_current_settings(email: str, settings_dict: Dict) -> Tuple[str, int]:
     )
     db.session.add(settings)
     db.session.commit()
+    _settings_cache.pop(str(db.engine.url), None)
     return f"Settings updated by {settings.email} at {settings.datetime}", 200
 
 
@@ -94,19 +137,114 @@ class Sample(db.Model):
     has_results_fasta: bool = db.Column(db.Boolean, nullable=False)
     has_results_gbk: bool = db.Column(db.Boolean, nullable=False)
     has_results_zip: bool = db.Column(db.Boolean, nullable=False)
+    # "pending" while the reference sequence is being parsed, "failed" if parsing
+    # failed or timed out, otherwise None
+    reference_sequence_status: Optional[str] = db.Column(db.String(16), nullable=True)
+
+    __table_args__ = (
+        # sqlite implicitly appends the id to each index, so they also provide
+        # the (date, id) ordering used for keyset pagination
+        db.Index("ix_sample_date", "date"),
+        db.Index("ix_sample_email_date", "email", "date"),
+        db.Index("ix_sample_running_option_date", "running_option", "date"),
+    )
+
+
+def create_missing_columns():
+    # add any nullable columns that were added after the tables were created
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing_columns = {
+            column["name"] for column in inspector.get_columns(table.name)
+        }
+        for column in table.columns:
+            if column.name not in existing_columns and column.nullable:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                with db.engine.begin() as connection:
+                    connection.execute(
+                        db.text(
+                            f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                        )
+                    )
 
 
-def _samples_this_week(current_date: datetime.date):
+def create_missing_indexes():
+    # create any indexes that were added after the tables were created
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+def _count_samples_this_week(current_date: datetime.date) -> int:
     start_of_week = get_start_of_week(current_date)
     return db.session.execute(
-        db.select(Sample)
+        db.select(db.func.count(Sample.id))
         .filter(Sample.date >= start_of_week)
         .filter(Sample.date < start_of_week + datetime.timedelta(weeks=1))
-    ).all()
+    ).scalar_one()
 
 
-def _count_samples_this_week(current_date: datetime.date) -> int:
-    return len(_samples_this_week(current_date))
+@dataclass
+class WeeklySampleCount(db.Model):
+    # number of primary keys that have been allocated in each week
+    start_of_week: datetime.date = db.Column(db.Date, primary_key=True)
+    count: int = db.Column(db.Integer, nullable=False)
+
+
+def _allocate_primary_keys(
+    current_date: datetime.date, n_samples: int, settings: Dict
+) -> List[str]:
+    """
+    Atomically allocate `n_samples` consecutive primary keys for this week.
+
+    This starts a write transaction, which should be committed by the caller once
+    the new samples have been added. Returns an empty list if there are not enough
+    samples left this week.
+    """
+    year, week, day = current_date.isocalendar()
+    start_of_week = get_start_of_week(current_date)
+    max_samples = settings["plate_n_rows"] * settings["plate_n_cols"]
+    # create the counter for this week if it doesn't exist yet, initialised with the
+    # number of samples this week. Being a write, this also locks the database until
+    # the transaction is committed or rolled back, so no other worker can allocate
+    # the same keys in the meantime
+    db.session.execute(
+        db.insert(WeeklySampleCount)
+        .prefix_with("OR IGNORE")
+        .from_select(
+            ["start_of_week", "count"],
+            db.select(
+                db.literal(start_of_week, db.Date), db.func.count(Sample.id)
+            ).filter(
+                Sample.date >= start_of_week,
+                Sample.date < start_of_week + datetime.timedelta(weeks=1),
+            ),
+        )
+    )
+    result = db.session.execute(
+        db.update(WeeklySampleCount)
+        .where(WeeklySampleCount.start_of_week == start_of_week)
+        .where(WeeklySampleCount.count + n_samples <= max_samples)
+        .values(count=WeeklySampleCount.count + n_samples)
+    )
+    if result.rowcount != 1:
+        db.session.rollback()
+        return []
+    count = db.session.execute(
+        db.select(WeeklySampleCount.count).filter(
+            WeeklySampleCount.start_of_week == start_of_week
+        )
+    ).scalar_one()
+    return [
+        get_primary_key(
+            year=year,
+            week=week,
+            current_count=current_count,
+            n_rows=settings["plate_n_rows"],
+            n_cols=settings["plate_n_cols"],
+        )
+        for current_count in range(count - n_samples, count)
+    ]
 
 
 def remaining_samples_this_week(
@@ -127,50 +265,399 @@ def remaining_samples_this_week(
     return {"remaining": remaining, "message": message}
 
 
-def _write_samples_as_tsv_this_week(
-    data_path: str, current_date: Optional[datetime.date] = None
-) -> str:
-    current_samples = _samples_this_week(current_date)
-    logger.info(current_samples)
-    if current_date is None:
-        current_date = datetime.date.today()
-    year, week, day = current_date.isocalendar()
-    filename = f"{data_path}/{year}/{week}/inputs/samples.tsv"
-    logger.info(f"Updating {filename}...")
-    with open(filename, "w", newline="") as tsv_file:
-        writer = csv.writer(tsv_file, delimiter="\t", lineterminator="\n")
-        columns = [
-            "date",
-            "primary_key",
-            "email",
-            "name",
-            "running_option",
-            "concentration",
-        ]
-        writer.writerow(columns)
-        for sample_tuple in current_samples:
-            sample = sample_tuple[0]
-            logger.info(f"  - {sample.primary_key}")
+def get_max_sample_id() -> int:
+    """
+    Returns the largest sample id, which changes whenever a sample is added.
+
+    This is answered from the primary key index without scanning the samples.
+    """
+    return db.session.execute(
+        db.select(db.func.coalesce(db.func.max(Sample.id), 0))
+    ).scalar_one()
+
+
+def get_samples_version(
+    email: Optional[str] = None,
+) -> Tuple[int, int, int, int, int]:
+    """
+    Returns (max sample id, number of samples with fasta results, with gbk results,
+    with zip results, number of samples with a pending reference sequence) for all
+    samples, or only samples from `email` if it is not None.
+
+    This changes whenever a sample is added, new results are available,
+    or a reference sequence has been parsed.
+    """
+    selection = db.select(
+        db.func.coalesce(db.func.max(Sample.id), 0),
+        db.func.count(Sample.id).filter(Sample.has_results_fasta),
+        db.func.count(Sample.id).filter(Sample.has_results_gbk),
+        db.func.count(Sample.id).filter(Sample.has_results_zip),
+        db.func.count(Sample.id).filter(Sample.reference_sequence_status == "pending"),
+    )
+    if email is not None:
+        selection = selection.filter(Sample.email == email)
+    return tuple(db.session.execute(selection).one())
+
+
+def get_results_available(email: str) -> Dict[str, Tuple[bool, bool, bool]]:
+    """
+    Returns (has_results_fasta, has_results_gbk, has_results_zip) for each primary
+    key of the samples from `email` that have any results available.
+    """
+    return {
+        primary_key: (has_results_fasta, has_results_gbk, has_results_zip)
+        for primary_key, has_results_fasta, has_results_gbk, has_results_zip in db.session.execute(
+            db.select(
+                Sample.primary_key,
+                Sample.has_results_fasta,
+                Sample.has_results_gbk,
+                Sample.has_results_zip,
+            )
+            .filter(Sample.email == email)
+            .filter(
+                db.or_(
+                    Sample.has_results_fasta,
+                    Sample.has_results_gbk,
+                    Sample.has_results_zip,
+                )
+            )
+        )
+    }
+
+
+default_page_size = 100
+max_page_size = 1000
+
+
+# sample columns included in sample listings
+sample_listing_columns = (
+    Sample.id,
+    Sample.primary_key,
+    Sample.name,
+    Sample.running_option,
+    Sample.concentration,
+    Sample.reference_sequence_description,
+    Sample.date,
+    Sample.has_results_fasta,
+    Sample.has_results_gbk,
+    Sample.has_results_zip,
+    Sample.reference_sequence_status,
+)
+
+
+def _encode_samples_cursor(sample_row: Row) -> str:
+    return f"{sample_row.date.isoformat()}_{sample_row.id}"
+
+
+def _decode_samples_cursor(cursor: str) -> Tuple[datetime.date, int]:
+    date, id = cursor.split("_")
+    return datetime.date.fromisoformat(date), int(id)
+
+
+def get_samples_page(
+    email: Optional[str] = None,
+    cursor: Optional[str] = None,
+    page_size: int = default_page_size,
+    start_date: Optional[datetime.date] = None,
+    end_date: Optional[datetime.date] = None,
+    running_option: Optional[str] = None,
+    primary_key_prefix: Optional[str] = None,
+    text: Optional[str] = None,
+    has_results: Optional[bool] = None,
+) -> Tuple[List[Row], Optional[str]]:
+    """
+    Get a page of samples ordered by date and id, newest first.
+
+    Only samples matching all of the filters which are not None are included:
+    `email`, `running_option`, dates between `start_date` and `end_date` (inclusive),
+    a primary key starting with `primary_key_prefix`, a name or reference sequence
+    description containing `text`, and whether any results are available.
+    Each sample is returned as a row tuple of the `sample_listing_columns`,
+    with the email column included if `email` is None.
+    To get the next page, pass the returned cursor, which is None if this is
+    the last page. Raises ValueError if the cursor is invalid.
+    """
+    page_size = max(1, min(page_size, max_page_size))
+    if email is None:
+        selection = db.select(*sample_listing_columns, Sample.email)
+    else:
+        selection = db.select(*sample_listing_columns).filter(Sample.email == email)
+    if start_date is not None:
+        selection = selection.filter(Sample.date >= start_date)
+    if end_date is not None:
+        selection = selection.filter(Sample.date <= end_date)
+    if running_option is not None:
+        selection = selection.filter(Sample.running_option == running_option)
+    if primary_key_prefix is not None:
+        # range instead of LIKE so that the unique primary_key index can be used
+        selection = selection.filter(
+            Sample.primary_key >= primary_key_prefix,
+            Sample.primary_key < primary_key_prefix + "\U0010ffff",
+        )
+    if text is not None:
+        selection = selection.filter(_sample_text_filter(text))
+    if has_results is not None:
+        any_results = db.or_(
+            Sample.has_results_fasta, Sample.has_results_gbk, Sample.has_results_zip
+        )
+        selection = selection.filter(any_results if has_results else ~any_results)
+    if cursor is not None:
+        cursor_date, cursor_id = _decode_samples_cursor(cursor)
+        selection = selection.filter(
+            db.or_(
+                Sample.date < cursor_date,
+                db.and_(Sample.date == cursor_date, Sample.id < cursor_id),
+            )
+        )
+    sample_rows = db.session.execute(
+        selection.order_by(db.desc(Sample.date), db.desc(Sample.id)).limit(
+            page_size + 1
+        )
+    ).all()
+    if len(sample_rows) <= page_size:
+        return sample_rows, None
+    sample_rows = sample_rows[:page_size]
+    return sample_rows, _encode_samples_cursor(sample_rows[-1])
+
+
+def create_search_index():
+    """
+    Create the full text search index of sample names and reference descriptions.
+
+    This is an sqlite fts5 table with a trigram tokenizer to allow substring
+    searches, which is kept up to date with the sample table by triggers.
+    """
+    index_exists = (
+        db.session.execute(
+            db.text(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name='sample_fts'"
+            )
+        ).first()
+        is not None
+    )
+    if index_exists:
+        return
+    logger.info("Creating sample search index")
+    for statement in [
+        """CREATE VIRTUAL TABLE sample_fts USING fts5(
+            name, reference_sequence_description,
+            content='sample', content_rowid='id', tokenize='trigram'
+        )""",
+        """CREATE TRIGGER sample_fts_insert AFTER INSERT ON sample BEGIN
+            INSERT INTO sample_fts(rowid, name, reference_sequence_description)
+            VALUES (new.id, new.name, new.reference_sequence_description);
+        END""",
+        """CREATE TRIGGER sample_fts_delete AFTER DELETE ON sample BEGIN
+            INSERT INTO sample_fts(sample_fts, rowid, name, reference_sequence_description)
+            VALUES ('delete', old.id, old.name, old.reference_sequence_description);
+        END""",
+        """CREATE TRIGGER sample_fts_update
+        AFTER UPDATE OF name, reference_sequence_description ON sample BEGIN
+            INSERT INTO sample_fts(sample_fts, rowid, name, reference_sequence_description)
+            VALUES ('delete', old.id, old.name, old.reference_sequence_description);
+            INSERT INTO sample_fts(rowid, name, reference_sequence_description)
+            VALUES (new.id, new.name, new.reference_sequence_description);
+        END""",
+        # index any existing samples
+        "INSERT INTO sample_fts(sample_fts) VALUES ('rebuild')",
+    ]:
+        db.session.execute(db.text(statement))
+    db.session.commit()
+
+
+def _sample_text_filter(text: str):
+    if len(text) < 3:
+        # trigram index can only match strings of at least 3 characters
+        return db.or_(
+            Sample.name.contains(text, autoescape=True),
+            Sample.reference_sequence_description.contains(text, autoescape=True),
+        )
+    # quote text as an fts5 string so it matches as a literal substring
+    fts_query = '"' + text.replace('"', '""') + '"'
+    return Sample.id.in_(
+        db.text("SELECT rowid FROM sample_fts WHERE sample_fts MATCH :fts_query")
+        .bindparams(fts_query=fts_query)
+        .columns(db.column("rowid"))
+    )
+
+
+def _export_week(
+    app: flask.Flask, data_path: str, start_date: datetime.date, end_date: datetime.date
+) -> Tuple[bytes, List[pathlib.Path]]:
+    """
+    Returns samples.tsv and the reference sequence files for the samples from
+    `start_date` to `end_date`, which must be in the same week.
+    Runs in its own app context, as it is called while the zip file is streamed.
+    """
+    year, week, day = start_date.isocalendar()
+    references_path = pathlib.Path(f"{data_path}/{year}/{week}/inputs/references")
+    tsv_file = io.StringIO(newline="")
+    writer = csv.writer(tsv_file, delimiter="\t", lineterminator="\n")
+    columns = [
+        "date",
+        "primary_key",
+        "email",
+        "name",
+        "running_option",
+        "concentration",
+    ]
+    writer.writerow(columns)
+    reference_files = []
+    with app.app_context():
+        # rows are fetched in batches from the date index
+        samples = db.session.execute(
+            db.select(Sample)
+            .where(Sample.date >= start_date, Sample.date <= end_date)
+            .order_by(Sample.date, Sample.id)
+            .execution_options(yield_per=500)
+        ).scalars()
+        for sample in samples:
             writer.writerow([getattr(sample, column) for column in columns])
-    return filename
-
-
-def update_samples_zipfile(
-    data_path: str, current_date: Optional[datetime.date] = None
-) -> str:
-    year, week, day = datetime.date.today().isocalendar()
-    base_path = pathlib.Path(f"{data_path}/{year}/{week}")
-    pathlib.Path(f"{base_path}/inputs").mkdir(parents=True, exist_ok=True)
-    tsv_file = _write_samples_as_tsv_this_week(data_path, current_date)
-    logger.info(f"  -> {tsv_file}")
-    logger.info(f"Creating zip file of {base_path}/inputs..")
-    zip_filename = shutil.make_archive(
-        base_name=str(base_path / "samples"),
-        format="zip",
-        root_dir=f"{base_path}/inputs",
+            if sample.reference_sequence_description is not None:
+                reference_file = (
+                    references_path / f"{sample.primary_key}_{sample.name}.fasta"
+                )
+                if reference_file.is_file():
+                    reference_files.append(reference_file)
+    return tsv_file.getvalue().encode(), sorted(reference_files)
+
+
+# number of weeks of a samples zip file that are exported ahead of the week
+# that is being sent
+samples_zip_weeks_ahead = 1
+
+
+def _samples_zip_members(
+    app: flask.Flask,
+    data_path: str,
+    week_date_ranges: List[Tuple[datetime.date, datetime.date]],
+) -> Iterator[Tuple[str, Union[bytes, pathlib.Path], int]]:
+    # the following weeks are exported concurrently while each week is sent, so
+    # at most `samples_zip_weeks_ahead + 1` weeks are held in memory at once
+    futures: List[Optional[Future]] = []
+    with ThreadPoolExecutor(
+        max_workers=samples_zip_weeks_ahead + 1, thread_name_prefix="samples-zip"
+    ) as executor:
+        try:
+            for n, (week_start_date, week_end_date) in enumerate(week_date_ranges):
+                while len(futures) < min(
+                    n + samples_zip_weeks_ahead + 1, len(week_date_ranges)
+                ):
+                    futures.append(
+                        executor.submit(
+                            _export_week,
+                            app,
+                            data_path,
+                            *week_date_ranges[len(futures)],
+                        )
+                    )
+                tsv, reference_files = futures[n].result()
+                futures[n] = None
+                prefix = ""
+                if len(week_date_ranges) > 1:
+                    year, week, day = week_start_date.isocalendar()
+                    prefix = f"{year}_{week:02d}/"
+                yield f"{prefix}references/", b"", zipfile.ZIP_STORED
+                for f in reference_files:
+                    yield f"{prefix}references/{f.name}", f, zipfile.ZIP_STORED
+                yield f"{prefix}samples.tsv", tsv, zipfile.ZIP_DEFLATED
+        finally:
+            # if the download is interrupted, don't export any more weeks
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+
+
+def stream_samples_zipfile(
+    data_path: str, start_date: datetime.date, end_date: datetime.date
+) -> Tuple[str, Iterator[bytes]]:
+    """
+    Returns a fingerprint of the samples from `start_date` to `end_date`
+    inclusive, and a generator of a zip file containing their samples.tsv and
+    reference sequences. Each week is read from the database and each reference
+    sequence from disk as the zip file is consumed, with the next week being read
+    concurrently while the current one is sent. Reference sequences are stored
+    uncompressed as they are small.
+
+    If the dates span more than one week, the files for each week are in a
+    `{year}_{week}` directory in the zip file.
+    """
+    week_date_ranges = []
+    start_of_week = get_start_of_week(start_date)
+    while start_of_week <= end_date:
+        week_date_ranges.append(
+            (
+                max(start_of_week, start_date),
+                min(start_of_week + datetime.timedelta(days=6), end_date),
+            )
+        )
+        start_of_week += datetime.timedelta(weeks=1)
+    # samples are not modified once added, except that a pending reference
+    # sequence is added once it has been parsed
+    n_samples, max_id, n_references = db.session.execute(
+        db.select(
+            db.func.count(Sample.id),
+            db.func.max(Sample.id),
+            db.func.count(Sample.reference_sequence_description),
+        ).where(Sample.date >= start_date, Sample.date <= end_date)
+    ).one()
+    fingerprint = hashlib.sha256(
+        json.dumps(
+            [str(start_date), str(end_date), n_samples, max_id, n_references]
+        ).encode()
+    )
+    app = flask.current_app._get_current_object()
+    return fingerprint.hexdigest(), stream_zip(
+        _samples_zip_members(app, data_path, week_date_ranges)
+    )
+
+
+@dataclass
+class OutgoingEmail(db.Model):
+    # emails waiting to be sent by the email worker, see `email_worker.py`
+    id: int = db.Column(db.Integer, primary_key=True)
+    recipient: str = db.Column(db.Text, nullable=False)
+    message: bytes = db.Column(db.LargeBinary, nullable=False)
+    created: datetime.datetime = db.Column(db.DateTime, nullable=False)
+    attempts: int = db.Column(db.Integer, nullable=False, default=0)
+    # None if the email could not be sent after the maximum number of attempts
+    next_attempt: Optional[datetime.datetime] = db.Column(db.DateTime, index=True)
+    last_error: Optional[str] = db.Column(db.Text)
+
+
+def enqueue_email(msg: EmailMessage) -> None:
+    """
+    Adds the email to the outbox in the current session: it is sent by the email
+    worker once the session is committed.
+    """
+    now = datetime.datetime.now()
+    db.session.add(
+        OutgoingEmail(
+            recipient=msg["To"],
+            message=msg.as_bytes(),
+            created=now,
+            attempts=0,
+            next_attempt=now,
+        )
     )
-    logger.info(f"  -> created zip file {zip_filename}")
-    return zip_filename
+
+
+def get_outbox_stats() -> Dict:
+    queued, oldest = db.session.execute(
+        db.select(db.func.count(), db.func.min(OutgoingEmail.created)).where(
+            OutgoingEmail.next_attempt.is_not(None)
+        )
+    ).one()
+    failed = db.session.execute(
+        db.select(db.func.count()).where(OutgoingEmail.next_attempt.is_(None))
+    ).scalar_one()
+    return {
+        "queued": queued,
+        "failed": failed,
+        "oldest_queued_age": 0
+        if oldest is None
+        else (datetime.datetime.now() - oldest).total_seconds(),
+    }
 
 
 def _results_dir_and_key_from_filename(
@@ -185,15 +672,47 @@ def _results_dir_and_key_from_filename(
     return f"{data_path}/20{yy}/{ww}/results", f"{yy}_{ww}_{nn}"
 
 
-def _send_result_email(sample: Sample, result_files: List[str]):
+def _queue_result_email(sample: Sample, result_files: List[str]):
     try:
-        logger.info(f"Sending {sample.primary_key} result email to {sample.email}")
-        msg = EmailMessage()
-        msg.set_content(
+        logger.info(f"Queuing {sample.primary_key} result email to {sample.email}")
+        config = flask.current_app.config
+        # maximum total size of the (compressed) attachments in bytes
+        budget = config["CIRCUITSEQ_EMAIL_ATTACHMENT_BUDGET"]
+        attachments = []
+        download_links = []
+        for result_file in result_files:
+            filename = result_file.split("/")[-1]
+            data = gzip_file(result_file, max_size=budget)
+            if data is None:
+                logger.info(f"  --> {filename} too large, sending download link")
+                token = encode_result_download_token(
+                    sample.primary_key,
+                    filename.split(".")[-1],
+                    config["JWT_SECRET_KEY"],
+                )
+                download_links.append(
+                    f"{filename}: https://circuitseq.iwr.uni-heidelberg.de/api/result/{token}"
+                )
+            else:
+                budget -= len(data)
+                attachments.append((f"{filename}.gz", data))
+        content = (
             f"Dear {sample.email},\n\n"
             f"Your sample {sample.primary_key}_{sample.name} has been processed "
             f"and the results are attached to this email.\n\n"
-            f"You can also download the full analysis data by "
+        )
+        if download_links:
+            link_days = config["CIRCUITSEQ_RESULT_DOWNLOAD_LINK_EXPIRES"].days
+            content += (
+                f"Some result files were too large to attach to this email, "
+                f"they can be downloaded from the following links "
+                f"(valid for {link_days} days):\n\n"
+                + "\n".join(download_links)
+                + "\n\n"
+            )
+        msg = EmailMessage()
+        msg.set_content(
+            content + f"You can also download the full analysis data by "
             f"logging in to your account at https://circuitseq.iwr.uni-heidelberg.de\n\n"
             f"Best wishes,\n\n"
             f"CircuitSEQ Team."
@@ -203,19 +722,69 @@ def _send_result_email(sample: Sample, result_files: List[str]):
         ] = f"CircuitSEQ results for sample {sample.primary_key}_{sample.name}"
         msg["From"] = "no-reply@circuitseq.iwr.uni-heidelberg.de"
         msg["To"] = sample.email
-        for result_file in result_files:
-            with open(result_file, "rb") as fp:
-                result_file_data = fp.read()
+        for filename, data in attachments:
             msg.add_attachment(
-                result_file_data,
+                data,
                 maintype="application",
-                subtype="octet-stream",
-                filename=result_file.split("/")[-1],
+                subtype="gzip",
+                filename=filename,
             )
-        with smtplib.SMTP("email:587") as s:
-            s.send_message(msg)
+        enqueue_email(msg)
     except Exception as e:
-        logger.warning(f"  --> failed to send result email: {e}")
+        logger.warning(f"  --> failed to queue result email: {e}")
+
+
+def _extract_result_files(
+    results_file: pathlib.Path,
+    results_dir: str,
+    basename: str,
+    limits: ZipLimits,
+    budget: ByteBudget,
+) -> Dict[str, str]:
+    """
+    Extracts the fasta and gbk results for sample `basename` from a result zip file.
+
+    Returns the extracted files, keyed by filetype. Raises ZipLimitError if the
+    zip file exceeds the limits, or if the extracted files exceed the budget.
+
+    Files are extracted to a temporary directory and only replace any existing
+    results once they have been extracted, so a rejected zip file leaves the
+    existing results unchanged.
+    """
+    staged_files = {}
+    staging_dir = pathlib.Path(tempfile.mkdtemp(prefix=".extract-", dir=results_dir))
+    try:
+        try:
+            with zipfile.ZipFile(results_file) as zip_file:
+                check_zip_limits(zip_file, limits)
+                for zip_info in zip_file.infolist():
+                    if not zip_info.is_dir():
+                        # remove any leading directories from filename in zip file
+                        filename = pathlib.Path(zip_info.filename).name
+                        staged_file = str(staging_dir / filename)
+                        for filetype in ["fasta", "gbk"]:
+                            if filename == f"{basename}.{filetype}":
+                                extract_zip_member(
+                                    zip_file, zip_info, staged_file, budget
+                                )
+                                write_gzip_sibling(staged_file)
+                                staged_files[filetype] = filename
+        except ZipLimitError:
+            raise
+        except Exception as e:
+            logger.warning(f"Failed to process zip file: {e}")
+        extracted_files = {}
+        for filetype, filename in staged_files.items():
+            result_file = f"{results_dir}/{filename}"
+            for suffix in ["", ".gz"]:
+                os.replace(
+                    staging_dir / f"{filename}{suffix}", f"{result_file}{suffix}"
+                )
+            logger.info(f"  --> {result_file}")
+            extracted_files[filetype] = result_file
+        return extracted_files
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
 
 def process_result(result_zip_file: FileStorage, data_path: str) -> Tuple[str, int]:
@@ -235,32 +804,664 @@ def process_result(result_zip_file: FileStorage, data_path: str) -> Tuple[str, i
     pathlib.Path(results_dir).mkdir(parents=True, exist_ok=True)
     basename = f"{key}_{sample.name}"
     results_file = pathlib.Path(results_dir) / f"{basename}.zip"
-    result_zip_file.save(results_file)
+    # saved to a temporary file which only replaces any existing results zip file
+    # once the results have been extracted
+    upload_file = results_file.with_name(f".{secrets.token_hex(8)}.{basename}.zip")
+    result_zip_file.save(upload_file)
+    limits = ZipLimits.from_config(flask.current_app.config)
+    try:
+        extracted_files = _extract_result_files(
+            upload_file,
+            results_dir,
+            basename,
+            limits,
+            ByteBudget(limits.max_uncompressed_size),
+        )
+    except ZipLimitError as e:
+        logger.warning(f" --> Rejected zip file: {e}")
+        upload_file.unlink()
+        return f"Rejected zip file {result_zip_file.filename}: {e}", 401
+    os.replace(upload_file, results_file)
     logger.info(f"  --> {results_file}")
     sample.has_results_zip = True
-    files_to_email = []
+    if "fasta" in extracted_files:
+        sample.has_results_fasta = True
+    if "gbk" in extracted_files:
+        sample.has_results_gbk = True
+    _queue_result_email(sample, list(extracted_files.values()))
+    db.session.commit()
+    return str(results_file), 200
+
+
+def _process_plate_sample_results(
+    plate_zip_path: str,
+    members: List[str],
+    results_dir: str,
+    basename: str,
+    limits: ZipLimits,
+    budget: ByteBudget,
+) -> Tuple[Dict[str, str], List[str]]:
+    """
+    Writes the `{basename}.zip`, `.fasta` and `.gbk` members of the plate zip file
+    to `results_dir`, and extracts the fasta and gbk files from `{basename}.zip`.
+    All files written count towards the byte budget for the plate.
+
+    Files are written to a temporary directory and only replace any existing
+    results once all of them have been written, so if this fails the existing
+    results are left unchanged.
+
+    Returns the files written, keyed by filetype, and the members that were ignored.
+    """
+    staged_files = {}
+    ignored = []
+    pathlib.Path(results_dir).mkdir(parents=True, exist_ok=True)
+    staging_dir = pathlib.Path(tempfile.mkdtemp(prefix=".extract-", dir=results_dir))
+    try:
+        # each thread opens its own ZipFile to read members concurrently
+        with zipfile.ZipFile(plate_zip_path) as plate_zip_file:
+            for member in members:
+                filename = pathlib.Path(member).name
+                filetype = filename[len(basename) + 1 :]
+                if not filename.startswith(f"{basename}.") or filetype not in [
+                    "zip",
+                    "fasta",
+                    "gbk",
+                ]:
+                    ignored.append(member)
+                    continue
+                staged_file = str(staging_dir / filename)
+                extract_zip_member(plate_zip_file, member, staged_file, budget)
+                if filetype != "zip":
+                    write_gzip_sibling(staged_file)
+                staged_files[filetype] = filename
+                if filetype == "zip":
+                    extracted_files = _extract_result_files(
+                        pathlib.Path(staged_file),
+                        str(staging_dir),
+                        basename,
+                        limits,
+                        budget,
+                    )
+                    staged_files = {
+                        **{
+                            filetype: pathlib.Path(extracted_file).name
+                            for filetype, extracted_file in extracted_files.items()
+                        },
+                        **staged_files,
+                    }
+        written_files = {}
+        for filetype, filename in staged_files.items():
+            result_file = f"{results_dir}/{filename}"
+            for suffix in [""] if filetype == "zip" else ["", ".gz"]:
+                os.replace(
+                    staging_dir / f"{filename}{suffix}", f"{result_file}{suffix}"
+                )
+            logger.info(f"  --> {result_file}")
+            written_files[filetype] = result_file
+        return written_files, ignored
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def process_plate_result(
+    plate_zip_file: FileStorage,
+    data_path: str,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> Tuple[Union[List[Dict], str], int]:
+    """
+    Processes a zip file containing the result zip, fasta and gbk files for
+    a plate of samples, where each sample's results are extracted concurrently.
+    If provided, `progress(n_done, n_total)` is called as each sample is extracted.
+
+    Returns a report for each primary key found in the zip file.
+    """
+    logger.info(f"Processing plate zip file {plate_zip_file}")
+    limits = ZipLimits.from_config(flask.current_app.config)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        plate_zip_path = f"{tmp_dir}/plate.zip"
+        plate_zip_file.save(plate_zip_path)
+        try:
+            with zipfile.ZipFile(plate_zip_path) as plate_zip:
+                check_zip_limits(plate_zip, limits)
+                members = [
+                    zip_info.filename
+                    for zip_info in plate_zip.infolist()
+                    if not zip_info.is_dir()
+                ]
+        except zipfile.BadZipFile:
+            logger.warning(f" --> Invalid zip file")
+            return f"Invalid zip file {plate_zip_file.filename}", 401
+        except ZipLimitError as e:
+            logger.warning(f" --> Rejected zip file: {e}")
+            return f"Rejected zip file {plate_zip_file.filename}: {e}", 401
+        # the total size extracted from the plate, including nested zip files
+        budget = ByteBudget(limits.max_uncompressed_size)
+        report = []
+        members_by_key: Dict[str, List[str]] = {}
+        for member in members:
+            results_dir, key = _results_dir_and_key_from_filename(member, data_path)
+            if results_dir == "":
+                report.append(
+                    {
+                        "primary_key": None,
+                        "files": [],
+                        "ignored": [member],
+                        "error": f"Invalid filename {member}",
+                    }
+                )
+            else:
+                members_by_key.setdefault(key, []).append(member)
+        samples = {
+            sample.primary_key: sample
+            for sample in db.session.execute(
+                db.select(Sample).where(
+                    Sample.primary_key.in_(list(members_by_key.keys()))
+                )
+            ).scalars()
+        }
+        futures = {}
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for key, key_members in members_by_key.items():
+                if key in samples:
+                    results_dir, _ = _results_dir_and_key_from_filename(
+                        key_members[0], data_path
+                    )
+                    futures[key] = executor.submit(
+                        _process_plate_sample_results,
+                        plate_zip_path,
+                        key_members,
+                        results_dir,
+                        f"{key}_{samples[key].name}",
+                        limits,
+                        budget,
+                    )
+            if progress is not None:
+                progress(0, len(futures))
+                for n_done, _ in enumerate(as_completed(futures.values()), start=1):
+                    progress(n_done, len(futures))
+        for key, key_members in members_by_key.items():
+            if key not in samples:
+                logger.warning(f" --> Unknown primary key {key}")
+                report.append(
+                    {
+                        "primary_key": key,
+                        "files": [],
+                        "ignored": key_members,
+                        "error": f"Unknown primary key {key}",
+                    }
+                )
+                continue
+            sample = samples[key]
+            try:
+                written_files, ignored = futures[key].result()
+            except Exception as e:
+                logger.warning(f" --> Failed to process results for {key}: {e}")
+                report.append(
+                    {
+                        "primary_key": key,
+                        "files": [],
+                        "ignored": key_members,
+                        "error": f"Failed to process results: {e}",
+                    }
+                )
+                continue
+            if "zip" in written_files:
+                sample.has_results_zip = True
+            if "fasta" in written_files:
+                sample.has_results_fasta = True
+            if "gbk" in written_files:
+                sample.has_results_gbk = True
+            email_files = [
+                written_files[filetype]
+                for filetype in ["fasta", "gbk"]
+                if filetype in written_files
+            ]
+            if email_files:
+                _queue_result_email(sample, email_files)
+            report.append(
+                {
+                    "primary_key": key,
+                    "files": sorted(
+                        pathlib.Path(f).name for f in written_files.values()
+                    ),
+                    "ignored": ignored,
+                    "error": None,
+                }
+            )
+    db.session.commit()
+    return report, 200
+
+
+@dataclass
+class ResultJob(db.Model):
+    # an uploaded result or plate result zip file to be processed
+    id: int = db.Column(db.Integer, primary_key=True)
+    # "result" or "plate_result"
+    kind: str = db.Column(db.Text, nullable=False)
+    filename: str = db.Column(db.Text, nullable=False)
+    # "queued", "running", "done" or "failed"
+    status: str = db.Column(db.Text, nullable=False, index=True)
+    processed: int = db.Column(db.Integer, nullable=False, default=0)
+    total: int = db.Column(db.Integer, nullable=False, default=0)
+    message: Optional[str] = db.Column(db.Text)
+    report: Optional[List[Dict]] = db.Column(db.JSON)
+    created: datetime.datetime = db.Column(db.DateTime, nullable=False)
+    started: Optional[datetime.datetime] = db.Column(db.DateTime)
+    finished: Optional[datetime.datetime] = db.Column(db.DateTime)
+
+
+def _result_job_upload_path(data_path: str, job: ResultJob) -> pathlib.Path:
+    return pathlib.Path(data_path) / "jobs" / f"{job.id}" / job.filename
+
+
+def create_result_job(
+    kind: str, zip_file: Union[FileStorage, pathlib.Path], data_path: str
+) -> Tuple[Union[ResultJob, str], int]:
+    """
+    Saves the uploaded zip file, or moves the file from a completed resumable
+    upload, and queues it for processing by `run_result_job`.
+    A result zip filename is checked before it is queued.
+    """
+    if isinstance(zip_file, pathlib.Path):
+        filename = zip_file.name
+    else:
+        filename = pathlib.Path(zip_file.filename or "").name
+    if kind == "result":
+        results_dir, key = _results_dir_and_key_from_filename(filename, data_path)
+        if results_dir == "":
+            logger.warning(f" --> Invalid filename")
+            return f"Invalid filename {filename}", 401
+        sample = db.session.execute(
+            db.select(Sample.id).filter_by(primary_key=key)
+        ).scalar_one_or_none()
+        if sample is None:
+            logger.warning(f" --> Unknown primary key {key}")
+            return f"Unknown primary key {key}", 401
+    job = ResultJob(
+        kind=kind,
+        filename=filename or "upload.zip",
+        status="queued",
+        processed=0,
+        total=1 if kind == "result" else 0,
+        created=datetime.datetime.now(),
+    )
+    db.session.add(job)
+    db.session.flush()
+    upload_path = _result_job_upload_path(data_path, job)
+    upload_path.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(zip_file, pathlib.Path):
+        shutil.move(str(zip_file), str(upload_path))
+    else:
+        zip_file.save(upload_path)
+    if kind == "plate_result" and not zipfile.is_zipfile(upload_path):
+        logger.warning(f" --> Invalid zip file")
+        db.session.rollback()
+        shutil.rmtree(upload_path.parent, ignore_errors=True)
+        return f"Invalid zip file {filename}", 401
+    if zipfile.is_zipfile(upload_path):
+        # reject zip files that exceed the limits before queuing them
+        try:
+            with zipfile.ZipFile(upload_path) as zip_file_to_check:
+                check_zip_limits(
+                    zip_file_to_check, ZipLimits.from_config(flask.current_app.config)
+                )
+        except ZipLimitError as e:
+            logger.warning(f" --> Rejected zip file: {e}")
+            db.session.rollback()
+            shutil.rmtree(upload_path.parent, ignore_errors=True)
+            return f"Rejected zip file {filename}: {e}", 401
+    db.session.commit()
+    logger.info(f"  -> queued {kind} job {job.id} for {upload_path}")
+    return job, 200
+
+
+def claim_result_job(job_id: int) -> bool:
+    """Atomically marks a queued job as running, returns False if it was not queued"""
+    result = db.session.execute(
+        db.update(ResultJob)
+        .where(ResultJob.id == job_id, ResultJob.status == "queued")
+        .values(status="running", started=datetime.datetime.now())
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def requeue_interrupted_result_jobs() -> List[int]:
+    """
+    Marks jobs that were running when the server stopped as queued again,
+    and returns the ids of all queued jobs.
+    """
+    db.session.execute(
+        db.update(ResultJob)
+        .where(ResultJob.status == "running")
+        .values(status="queued", started=None, processed=0)
+    )
+    db.session.commit()
+    return list(
+        db.session.execute(
+            db.select(ResultJob.id)
+            .where(ResultJob.status == "queued")
+            .order_by(ResultJob.id)
+        ).scalars()
+    )
+
+
+def _update_result_job_progress(job_id: int, processed: int, total: int) -> None:
+    # separate connection: doesn't commit any pending changes in the session
+    with db.engine.begin() as connection:
+        connection.execute(
+            db.update(ResultJob)
+            .where(ResultJob.id == job_id)
+            .values(processed=processed, total=total)
+        )
+
+
+def run_result_job(job_id: int, data_path: str) -> None:
+    """Processes a result job which has been claimed using `claim_result_job`"""
+    job = db.session.get(ResultJob, job_id)
+    logger.info(f"Running {job.kind} job {job.id} for {job.filename}")
+    upload_path = _result_job_upload_path(data_path, job)
     try:
-        zip_file = zipfile.ZipFile(results_file)
-        for zip_info in zip_file.infolist():
-            if not zip_info.is_dir():
-                # remove any leading directories from filename in zip file
-                zip_info.filename = pathlib.Path(zip_info.filename).name
-                result_file = f"{results_dir}/{zip_info.filename}"
-                if zip_info.filename == f"{basename}.fasta":
-                    zip_file.extract(zip_info, results_dir)
-                    logger.info(f"  --> {result_file}")
-                    sample.has_results_fasta = True
-                    files_to_email.append(result_file)
-                elif zip_info.filename == f"{basename}.gbk":
-                    zip_file.extract(zip_info, results_dir)
-                    logger.info(f"  --> {result_file}")
-                    sample.has_results_gbk = True
-                    files_to_email.append(result_file)
+        with open(upload_path, "rb") as f:
+            zip_file = FileStorage(f, filename=job.filename)
+            if job.kind == "plate_result":
+                message_or_report, code = process_plate_result(
+                    zip_file,
+                    data_path,
+                    lambda processed, total: _update_result_job_progress(
+                        job_id, processed, total
+                    ),
+                )
+            else:
+                message_or_report, code = process_result(zip_file, data_path)
     except Exception as e:
-        logger.warning(f"Failed to process zip file: {e}")
-    _send_result_email(sample, files_to_email)
+        db.session.rollback()
+        logger.exception(f"  -> job {job_id} failed: {e}")
+        message_or_report, code = f"Failed to process {job.filename}: {e}", 500
+    job = db.session.get(ResultJob, job_id)
+    db.session.refresh(job)
+    job.finished = datetime.datetime.now()
+    if code == 200:
+        job.status = "done"
+        if isinstance(message_or_report, list):
+            job.report = message_or_report
+            job.message = f"Processed results for {len(message_or_report)} samples"
+        else:
+            job.processed = job.total
+            job.message = message_or_report
+        shutil.rmtree(upload_path.parent, ignore_errors=True)
+    else:
+        job.status = "failed"
+        job.message = message_or_report
     db.session.commit()
-    return str(results_file), 200
+    logger.info(f"  -> job {job_id} {job.status}: {job.message}")
+
+
+@dataclass
+class Upload(db.Model):
+    # a resumable upload, whose data is written to `_upload_file(data_path, upload)`
+    id: str = db.Column(db.Text, primary_key=True)
+    email: str = db.Column(db.Text, nullable=False)
+    filename: str = db.Column(db.Text, nullable=False)
+    length: int = db.Column(db.Integer, nullable=False)
+    offset: int = db.Column(db.Integer, nullable=False)
+    # sha256 hex digest of the complete file: if provided when the upload is
+    # created it is checked, otherwise it is set when the upload is complete
+    sha256: Optional[str] = db.Column(db.Text)
+    created: datetime.datetime = db.Column(db.DateTime, nullable=False)
+
+
+# incomplete uploads are deleted after this time
+upload_expires = datetime.timedelta(days=7)
+
+# sha256 of the data received so far for each upload, keyed by upload id, as
+# (offset, hash). If missing, e.g. after a restart, it is computed from the file.
+_upload_hashes: Dict[str, Tuple[int, "hashlib._Hash"]] = {}
+# ids of the uploads which currently have a chunk being written to them
+_uploads_being_written: Set[str] = set()
+_upload_hashes_lock = threading.Lock()
+
+
+def _upload_file(data_path: str, upload: Upload) -> pathlib.Path:
+    return pathlib.Path(data_path) / "uploads" / upload.id / upload.filename
+
+
+def delete_upload(upload: Upload, data_path: str) -> None:
+    shutil.rmtree(_upload_file(data_path, upload).parent, ignore_errors=True)
+    with _upload_hashes_lock:
+        _upload_hashes.pop(upload.id, None)
+    db.session.delete(upload)
+    db.session.commit()
+
+
+def delete_expired_uploads(data_path: str) -> int:
+    """Deletes uploads that were created more than `upload_expires` ago"""
+    expired_uploads = (
+        db.session.execute(
+            db.select(Upload).where(
+                Upload.created < datetime.datetime.now() - upload_expires
+            )
+        )
+        .scalars()
+        .all()
+    )
+    for expired_upload in expired_uploads:
+        logger.info(f"Deleting expired upload {expired_upload.id}")
+        delete_upload(expired_upload, data_path)
+    return len(expired_uploads)
+
+
+def create_upload(
+    email: str, filename: str, length: int, sha256: Optional[str], data_path: str
+) -> Tuple[Union[Upload, str], int]:
+    filename = pathlib.Path(filename or "").name
+    if filename in ["", ".", ".."]:
+        return "Invalid filename", 401
+    max_length = flask.current_app.config["MAX_CONTENT_LENGTH"]
+    if length <= 0 or length > max_length:
+        return f"Upload length must be between 1 and {max_length} bytes", 401
+    delete_expired_uploads(data_path)
+    n_open_uploads, open_upload_bytes = db.session.execute(
+        db.select(
+            db.func.count(Upload.id), db.func.coalesce(db.func.sum(Upload.length), 0)
+        ).where(Upload.email == email)
+    ).one()
+    max_open_uploads = flask.current_app.config["CIRCUITSEQ_MAX_OPEN_UPLOADS"]
+    if n_open_uploads >= max_open_uploads:
+        return f"Too many open uploads: at most {max_open_uploads} are allowed", 401
+    max_open_upload_bytes = flask.current_app.config["CIRCUITSEQ_MAX_OPEN_UPLOAD_BYTES"]
+    if open_upload_bytes + length > max_open_upload_bytes:
+        return (
+            f"Open uploads would exceed the maximum of {max_open_upload_bytes} bytes",
+            401,
+        )
+    upload = Upload(
+        id=secrets.token_urlsafe(16),
+        email=email,
+        filename=filename,
+        length=length,
+        offset=0,
+        sha256=sha256.lower() if sha256 else None,
+        created=datetime.datetime.now(),
+    )
+    upload_file = _upload_file(data_path, upload)
+    upload_file.parent.mkdir(parents=True)
+    upload_file.touch()
+    db.session.add(upload)
+    db.session.commit()
+    logger.info(f"Created upload {upload.id} of {length} bytes for {email}")
+    return upload, 200
+
+
+def get_upload(upload_id: str, email: str) -> Optional[Upload]:
+    return db.session.execute(
+        db.select(Upload).filter_by(id=upload_id, email=email)
+    ).scalar_one_or_none()
+
+
+def _sha256_of_file(filename: pathlib.Path, length: int) -> "hashlib._Hash":
+    file_hash = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while length > 0 and (data := f.read(min(length, 1024 * 1024))):
+            file_hash.update(data)
+            length -= len(data)
+    return file_hash
+
+
+def write_upload_chunk(
+    upload: Upload,
+    offset: int,
+    stream: BinaryIO,
+    chunk_sha256: Optional[bytes],
+    data_path: str,
+) -> Tuple[str, int]:
+    """
+    Writes the data from `stream` to the upload file at `offset`, which must be
+    the number of bytes received so far. The data is written directly to the
+    upload file, and both the sha256 of the chunk (if `chunk_sha256` is given) and
+    the sha256 of the complete file are updated as it is written.
+    Only one chunk of an upload is written at a time: a request to write another
+    chunk in the meantime is rejected.
+    """
+    with _upload_hashes_lock:
+        if upload.id in _uploads_being_written:
+            return "Upload is being written by another request", 409
+        _uploads_being_written.add(upload.id)
+    try:
+        # the offset may have been changed by a request that just finished
+        db.session.refresh(upload)
+        if offset != upload.offset:
+            return f"Upload offset is {upload.offset}", 409
+        return _write_upload_chunk(upload, offset, stream, chunk_sha256, data_path)
+    finally:
+        with _upload_hashes_lock:
+            _uploads_being_written.discard(upload.id)
+
+
+def _write_upload_chunk(
+    upload: Upload,
+    offset: int,
+    stream: BinaryIO,
+    chunk_sha256: Optional[bytes],
+    data_path: str,
+) -> Tuple[str, int]:
+    upload_file = _upload_file(data_path, upload)
+    with _upload_hashes_lock:
+        offset_and_hash = _upload_hashes.pop(upload.id, None)
+    if offset_and_hash is None or offset_and_hash[0] != offset:
+        file_hash = _sha256_of_file(upload_file, offset)
+    else:
+        file_hash = offset_and_hash[1]
+    new_file_hash = file_hash.copy()
+    chunk_hash = hashlib.sha256()
+    new_offset = offset
+    max_offset = upload.length
+    with open(upload_file, "r+b") as f:
+        f.seek(offset)
+        while data := stream.read(1024 * 1024):
+            new_offset += len(data)
+            if new_offset > max_offset:
+                break
+            f.write(data)
+            chunk_hash.update(data)
+            new_file_hash.update(data)
+        error_message = ""
+        if new_offset > max_offset:
+            error_message = "Chunk is larger than the remaining upload length"
+        elif chunk_sha256 is not None and chunk_hash.digest() != chunk_sha256:
+            error_message = "Chunk checksum mismatch"
+        elif new_offset == upload.length and upload.sha256 not in [
+            None,
+            new_file_hash.hexdigest(),
+        ]:
+            # start again from the beginning
+            error_message = "Upload checksum mismatch"
+            offset = 0
+            file_hash = hashlib.sha256()
+            db.session.execute(
+                db.update(Upload).where(Upload.id == upload.id).values(offset=0)
+            )
+            db.session.commit()
+        if error_message:
+            f.truncate(offset)
+            with _upload_hashes_lock:
+                _upload_hashes[upload.id] = (offset, file_hash)
+            logger.info(
+                f"Upload {upload.id} chunk at {offset} rejected: {error_message}"
+            )
+            return error_message, 401
+    values = {"offset": new_offset}
+    if new_offset == upload.length:
+        values["sha256"] = new_file_hash.hexdigest()
+    # only update the offset if no other chunk has been written in the meantime
+    result = db.session.execute(
+        db.update(Upload)
+        .where(Upload.id == upload.id, Upload.offset == offset)
+        .values(**values)
+    )
+    db.session.commit()
+    if result.rowcount != 1:
+        return "Upload was modified by another request", 409
+    if new_offset < upload.length:
+        with _upload_hashes_lock:
+            _upload_hashes[upload.id] = (new_offset, new_file_hash)
+    else:
+        logger.info(f"Upload {upload.id} complete")
+    return "", 200
+
+
+def get_completed_upload_file(
+    upload_id: str, email: str, data_path: str
+) -> Tuple[Optional[Upload], Optional[pathlib.Path], str]:
+    """
+    Returns the upload and the path to its file if the upload is complete,
+    otherwise an error message.
+    """
+    upload = get_upload(upload_id, email)
+    if upload is None:
+        return None, None, "Upload not found"
+    if upload.offset != upload.length:
+        return None, None, "Upload is not complete"
+    return upload, _upload_file(data_path, upload), ""
+
+
+def configure_password_hashing(
+    time_cost: int,
+    memory_cost: int,
+    parallelism: int,
+    max_workers: int,
+    max_queued: int,
+) -> None:
+    global ph, password_hashing_pool
+    logger.info(
+        f"Password hashing: argon2 time_cost={time_cost}, memory_cost={memory_cost}, "
+        f"parallelism={parallelism} using {max_workers} threads "
+        f"with at most {max_queued} queued"
+    )
+    ph = argon2.PasswordHasher(
+        time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism
+    )
+    if (
+        max_workers != password_hashing_pool.max_workers
+        or max_queued != password_hashing_pool.max_queued
+    ):
+        password_hashing_pool.shutdown()
+        password_hashing_pool = MeteredThreadPool(
+            max_workers=max_workers, max_queued=max_queued
+        )
+
+
+def hash_password(password: str) -> str:
+    """Raises PoolFullError if too many passwords are already waiting to be hashed"""
+    return password_hashing_pool.run(ph.hash, password)
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    """Raises PoolFullError if too many passwords are already waiting to be hashed"""
+    try:
+        return password_hashing_pool.run(ph.verify, password_hash, password)
+    except argon2.exceptions.VerificationError:
+        return False
 
 
 @dataclass
@@ -273,18 +1474,21 @@ class User(db.Model):
 
     def set_password(self, current_password: str, new_password: str) -> bool:
         if self.check_password(current_password):
-            self.password_hash = ph.hash(new_password)
+            self.password_hash = hash_password(new_password)
+            # log out any other sessions of this user
+            db.session.execute(
+                db.delete(RefreshToken).where(RefreshToken.user_id == self.id)
+            )
             db.session.commit()
+            _invalidate_cached_user(self.id)
             return True
         return False
 
     def check_password(self, password: str) -> bool:
-        try:
-            ph.verify(self.password_hash, password)
-        except argon2.exceptions.VerificationError:
+        if not verify_password(self.password_hash, password):
             return False
         if ph.check_needs_rehash(self.password_hash):
-            self.password_hash = ph.hash(password)
+            self.password_hash = hash_password(password)
             db.session.commit()
         return True
 
@@ -297,6 +1501,59 @@ class User(db.Model):
         }
 
 
+# recently used users, keyed by database and user id. These are detached copies
+# without the password hash, which are only used to identify the current user:
+# a change to a user in the db should be followed by `_invalidate_cached_user`.
+# Changes made directly in the db (or by another worker) are seen after the ttl.
+_user_cache = TTLCache(maxsize=1024, ttl=60)
+
+
+def _invalidate_cached_user(user_id: int) -> None:
+    _user_cache.pop((str(db.engine.url), user_id))
+
+
+def get_user(user_id: int) -> Optional[User]:
+    cache_key = (str(db.engine.url), user_id)
+    user = _user_cache.get(cache_key)
+    if user is None:
+        db_user = db.session.get(User, user_id)
+        if db_user is None:
+            return None
+        user = User(
+            id=db_user.id,
+            email=db_user.email,
+            activated=db_user.activated,
+            is_admin=db_user.is_admin,
+        )
+        _user_cache.set(cache_key, user)
+    return user
+
+
+@dataclass
+class RefreshToken(db.Model):
+    # refresh tokens that have been issued and not yet revoked or expired
+    jti: str = db.Column(db.Text, primary_key=True)
+    user_id: int = db.Column(db.Integer, nullable=False, index=True)
+    expires: datetime.datetime = db.Column(db.DateTime, nullable=False)
+
+
+def add_refresh_token(jti: str, user_id: int, expires: datetime.datetime) -> None:
+    db.session.execute(
+        db.delete(RefreshToken).where(RefreshToken.expires < datetime.datetime.now())
+    )
+    db.session.add(RefreshToken(jti=jti, user_id=user_id, expires=expires))
+    db.session.commit()
+
+
+def is_refresh_token_revoked(jti: str) -> bool:
+    return db.session.get(RefreshToken, jti) is None
+
+
+def revoke_refresh_token(jti: str) -> None:
+    db.session.execute(db.delete(RefreshToken).where(RefreshToken.jti == jti))
+    db.session.commit()
+
+
 def is_valid_email(email: str) -> bool:
     return re.match(r"\S+@((\S*heidelberg)|embl|dkfz)\.de$", email) is not None
 
@@ -305,7 +1562,7 @@ def is_valid_password(password: str) -> bool:
     return re.match(r"^(?=.*[A-Z])(?=.*[a-z])(?=.*[0-9]).{8,}$", password) is not None
 
 
-def _send_activation_email(email: str):
+def _queue_activation_email(email: str):
     secret_key = flask.current_app.config["JWT_SECRET_KEY"]
     token = encode_activation_token(email, secret_key)
     url = f"https://circuitseq.iwr.uni-heidelberg.de/activate/{token}"
@@ -317,11 +1574,11 @@ def _send_activation_email(email: str):
     msg["Subject"] = "CircuitSEQ account activation"
     msg["From"] = "no-reply@circuitseq.iwr.uni-heidelberg.de"
     msg["To"] = email
-    with smtplib.SMTP("email:587") as s:
-        s.send_message(msg)
+    enqueue_email(msg)
 
 
 def add_new_user(email: str, password: str, is_admin: bool) -> Tuple[str, int]:
+    """Raises PoolFullError if too many passwords are already waiting to be hashed"""
     if not is_valid_email(email):
         return "Please use a uni-heidelberg, dkfz or embl email address.", 401
     if not is_valid_password(password):
@@ -339,23 +1596,21 @@ def add_new_user(email: str, password: str, is_admin: bool) -> Tuple[str, int]:
             "This email address is already in use",
             401,
         )
-    try:
-        _send_activation_email(email)
-    except Exception as e:
-        logger.warning(f"Send activation email failed: {e}")
-        return "Failed to send activation email", 401
+    password_hash = hash_password(password)
     try:
         db.session.add(
             User(
                 email=email,
-                password_hash=ph.hash(password),
+                password_hash=password_hash,
                 activated=False,
                 is_admin=is_admin,
             )
         )
+        _queue_activation_email(email)
         db.session.commit()
     except Exception as e:
         logger.warning(f"Error adding user to db: {e}")
+        db.session.rollback()
         return "Failed to create new user", 401
     return (
         f"Successful signup for {email}. To activate your account, please click on the link in the activation email from no-reply@circuitseq.iwr.uni-heidelberg.de sent to this email address",
@@ -381,61 +1636,403 @@ def activate_user(token: str) -> Tuple[str, int]:
         return f"Account for {email} is already activated", 401
     user.activated = True
     db.session.commit()
+    _invalidate_cached_user(user.id)
     return f"Account {email} activated", 200
 
 
-def add_new_sample(
-    email: str,
-    name: str,
-    running_option: str,
-    concentration: int,
-    reference_sequence_file: Optional[FileStorage],
+@dataclass
+class ReferenceParseJob(db.Model):
+    # a reference sequence file of a "pending" sample that is still being parsed
+    sample_id: int = db.Column(db.Integer, primary_key=True)
+    # directory in data_path/reference_parsing containing the input file
+    directory: str = db.Column(db.Text, nullable=False)
+    original_filename: str = db.Column(db.Text, nullable=False)
+    created: datetime.datetime = db.Column(db.DateTime, nullable=False)
+
+
+_reference_parse_lock = threading.Lock()
+# parsing processes are forked from a server process which has already imported
+# the parsing code, rather than from this process which has threads and open
+# db connections
+_reference_parse_context = multiprocessing.get_context("forkserver")
+_reference_parse_context.set_forkserver_preload(["circuit_seq_server.utils"])
+# pending parses are finished on this thread, which writes to the database and
+# moves the parsed files, so this doesn't hold up the parsing threads
+_reference_parse_finisher = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="reference-parse-finish"
+)
+
+
+def configure_reference_parsing(max_workers: int) -> None:
+    global reference_parsing_pool, reference_parsing_processes
+    logger.info(f"Reference sequence parsing using {max_workers} processes")
+    with _reference_parse_lock:
+        if max_workers != reference_parsing_processes:
+            # parses already submitted are completed by the old pool
+            reference_parsing_pool.shutdown(wait=False)
+            reference_parsing_pool = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="reference-parse"
+            )
+            reference_parsing_processes = max_workers
+
+
+def _reference_parse_dir(data_path: str, directory: str) -> pathlib.Path:
+    return pathlib.Path(data_path) / "reference_parsing" / directory
+
+
+def _save_reference_sequence_file(
+    reference_sequence_file: Union[FileStorage, pathlib.Path], data_path: str
+) -> Tuple[pathlib.Path, str]:
+    """
+    Saves a reference sequence file as `input` in a new directory, or links the
+    file if it is the path to a completed resumable upload.
+
+    Returns the directory and the original filename.
+    """
+    parse_dir = _reference_parse_dir(data_path, secrets.token_urlsafe(16))
+    parse_dir.mkdir(parents=True)
+    if isinstance(reference_sequence_file, pathlib.Path):
+        try:
+            os.link(reference_sequence_file, parse_dir / "input")
+        except OSError:
+            shutil.copyfile(reference_sequence_file, parse_dir / "input")
+        return parse_dir, reference_sequence_file.name
+    logger.info(f"Saving {reference_sequence_file.filename} to {parse_dir}")
+    reference_sequence_file.save(parse_dir / "input")
+    return parse_dir, reference_sequence_file.filename
+
+
+def _parse_reference_sequence_in_process(
+    parse_dir: pathlib.Path,
+    original_filename: str,
+    timeout: float,
+    stop: Optional[threading.Event] = None,
+) -> Optional[str]:
+    """
+    Parses `parse_dir/input` to `parse_dir/reference.fasta` and
+    `parse_dir/reference.fasta.gz` in a new process, which is killed if it
+    hasn't finished after `timeout` seconds, or once `stop` is set.
+
+    Returns the reference sequence description, which is None if the file
+    could not be parsed. Raises TimeoutError if the parse timed out.
+    """
+    receiver, sender = _reference_parse_context.Pipe(duplex=False)
+    process = _reference_parse_context.Process(
+        target=parse_seq_to_fasta_and_gzip_process,
+        args=(
+            sender,
+            parse_dir / "input",
+            str(parse_dir / "reference.fasta"),
+            original_filename,
+        ),
+        daemon=True,
+    )
+    process.start()
+    sender.close()
+    end_time = time.monotonic() + timeout
+    try:
+        while not receiver.poll(min(max(end_time - time.monotonic(), 0), 0.1)):
+            if stop is not None and stop.is_set():
+                raise RuntimeError("parsing was stopped")
+            if time.monotonic() >= end_time:
+                raise TimeoutError(f"not parsed within {timeout} seconds")
+        reference_sequence_description, error = receiver.recv()
+    except EOFError:
+        raise RuntimeError("parsing process exited without a result")
+    finally:
+        if process.is_alive():
+            process.kill()
+        process.join()
+        receiver.close()
+    if error:
+        raise RuntimeError(error)
+    return reference_sequence_description
+
+
+def _submit_reference_parse(
+    parse_dir: pathlib.Path,
+    original_filename: str,
+    stop: Optional[threading.Event] = None,
+) -> Future:
+    """
+    Parses a reference sequence file using the reference sequence parsing pool.
+    If `stop` is set, a parse that has started is stopped.
+    """
+    with _reference_parse_lock:
+        return reference_parsing_pool.submit(
+            _parse_reference_sequence_in_process,
+            parse_dir,
+            original_filename,
+            flask.current_app.config["CIRCUITSEQ_REFERENCE_PARSE_TIMEOUT"],
+            stop,
+        )
+
+
+def _reference_parse_result(future: Future) -> Tuple[Optional[str], str]:
+    """Returns the reference sequence description, or None and the reason it failed"""
+    if future.cancelled():
+        return None, "cancelled"
+    error = future.exception()
+    if error is not None:
+        return None, f"{error!r}"
+    reference_sequence_description = future.result()
+    if reference_sequence_description is None:
+        return None, "invalid file"
+    return reference_sequence_description, ""
+
+
+def _move_parsed_reference_sequence(
+    parse_dir: pathlib.Path, ref_seq_dir: pathlib.Path, key: str, name: str
+) -> None:
+    for suffix in [".fasta", ".fasta.gz"]:
+        shutil.move(
+            str(parse_dir / f"reference{suffix}"),
+            str(ref_seq_dir / f"{key}_{name}{suffix}"),
+        )
+
+
+def _finish_reference_parse(
+    sample_id: int,
     data_path: str,
-) -> Tuple[Optional[Sample], str]:
+    reference_sequence_description: Optional[str],
+    error: str,
+) -> None:
+    """
+    Stores the parsed reference sequence of a pending sample, or marks it as
+    failed if `reference_sequence_description` is None.
+    Does nothing if the parse was already finished.
+    """
+    job = db.session.get(ReferenceParseJob, sample_id)
+    if job is None:
+        return
+    parse_dir = _reference_parse_dir(data_path, job.directory)
+    sample = db.session.get(Sample, sample_id)
+    if sample is not None and sample.reference_sequence_status == "pending":
+        if reference_sequence_description is None:
+            logger.warning(
+                f"Failed to parse reference sequence of sample {sample.primary_key}: {error}"
+            )
+            sample.reference_sequence_status = "failed"
+        else:
+            logger.info(f"Parsed reference sequence of sample {sample.primary_key}")
+            year, week, day = sample.date.isocalendar()
+            ref_seq_dir = pathlib.Path(f"{data_path}/{year}/{week}/inputs/references")
+            ref_seq_dir.mkdir(parents=True, exist_ok=True)
+            _move_parsed_reference_sequence(
+                parse_dir, ref_seq_dir, sample.primary_key, sample.name
+            )
+            sample.reference_sequence_description = reference_sequence_description
+            sample.reference_sequence_status = None
+    db.session.delete(job)
+    db.session.commit()
+    shutil.rmtree(parse_dir, ignore_errors=True)
+
+
+def _reference_parse_done(app: flask.Flask, sample_id: int, future: Future) -> None:
+    with app.app_context():
+        try:
+            _finish_reference_parse(
+                sample_id,
+                app.config["CIRCUITSEQ_DATA_PATH"],
+                *_reference_parse_result(future),
+            )
+        except Exception as e:
+            logger.exception(f"Reference sequence parse of sample {sample_id}: {e}")
+            db.session.rollback()
+
+
+def _watch_reference_parse(app: flask.Flask, sample_id: int, future: Future) -> None:
+    """Finishes the pending parse of `sample_id` when it completes or times out"""
+    future.add_done_callback(
+        lambda completed_future: _reference_parse_finisher.submit(
+            _reference_parse_done, app, sample_id, completed_future
+        )
+    )
+
+
+def resume_reference_parse_jobs(app: flask.Flask) -> None:
+    """Re-submits reference sequences that were pending when the server stopped"""
+    with app.app_context():
+        data_path = app.config["CIRCUITSEQ_DATA_PATH"]
+        jobs = db.session.execute(db.select(ReferenceParseJob)).scalars().all()
+        if jobs:
+            logger.info(f"Resuming {len(jobs)} pending reference sequence parses")
+        futures = []
+        for job in jobs:
+            parse_dir = _reference_parse_dir(data_path, job.directory)
+            if not (parse_dir / "input").is_file():
+                _finish_reference_parse(
+                    job.sample_id, data_path, None, "missing input file"
+                )
+                continue
+            futures.append(
+                (
+                    job.sample_id,
+                    _submit_reference_parse(parse_dir, job.original_filename),
+                )
+            )
+    for sample_id, future in futures:
+        _watch_reference_parse(app, sample_id, future)
+
+
+def add_new_samples(
+    email: str, new_samples: List[Dict], data_path: str
+) -> Tuple[List[Sample], str]:
+    """
+    Add new samples, each a dict with keys `name`, `running_option`, `concentration`
+    and `reference_sequence_file`, with a contiguous block of primary keys.
+
+    Reference sequence files are parsed in the reference sequence parsing pool.
+    If they are all parsed within CIRCUITSEQ_REFERENCE_PARSE_INLINE_WAIT seconds,
+    either all of the samples are added, or if there is an error none are.
+    Otherwise the samples are added with the reference sequences that are
+    still being parsed marked as "pending", and each one is stored or marked
+    as "failed" when it has been parsed or times out.
+    """
     today = datetime.date.today()
     year, week, day = today.isocalendar()
-    count = _count_samples_this_week(today)
     settings = get_current_settings()
-    remaining_samples = remaining_samples_this_week()
+    remaining_samples = remaining_samples_this_week(today)
     if remaining_samples["remaining"] == 0:
-        return None, remaining_samples["message"]
-    key = get_primary_key(
-        year=year,
-        week=week,
-        current_count=count,
-        n_rows=settings["plate_n_rows"],
-        n_cols=settings["plate_n_cols"],
-    )
-    if key is None:
-        return None, "No more samples left this week."
-    reference_sequence_description: Optional[str] = None
+        return [], remaining_samples["message"]
+    if len(new_samples) > remaining_samples["remaining"]:
+        return (
+            [],
+            f"Only {remaining_samples['remaining']} samples left this week.",
+        )
     ref_seq_dir = pathlib.Path(f"{data_path}/{year}/{week}/inputs/references")
     ref_seq_dir.mkdir(parents=True, exist_ok=True)
-    if reference_sequence_file is not None:
-        ref_seq_filename = str(ref_seq_dir / f"{key}_{name}.fasta")
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            temp_file = pathlib.Path(tmp_dir) / "temp.txt"
+    parse_jobs: Dict[int, Tuple[pathlib.Path, str, Future]] = {}
+    stop_parses = threading.Event()
+    # (primary key, name) of the parsed reference sequences moved to ref_seq_dir
+    moved_reference_sequences: List[Tuple[str, str]] = []
+
+    def _remove_parse_jobs():
+        # parses that are still running are stopped before their files are removed
+        stop_parses.set()
+        for _, _, future in parse_jobs.values():
+            future.cancel()
+        wait([future for _, _, future in parse_jobs.values()])
+        for parse_dir, _, _ in parse_jobs.values():
+            shutil.rmtree(parse_dir, ignore_errors=True)
+
+    try:
+        # parse reference sequences before allocating primary keys, to keep the
+        # time the database is locked for to a minimum
+        for n, new_sample in enumerate(new_samples):
+            if new_sample["reference_sequence_file"] is not None:
+                parse_dir, original_filename = _save_reference_sequence_file(
+                    new_sample["reference_sequence_file"], data_path
+                )
+                parse_jobs[n] = (
+                    parse_dir,
+                    original_filename,
+                    _submit_reference_parse(parse_dir, original_filename, stop_parses),
+                )
+        wait(
+            [future for _, _, future in parse_jobs.values()],
+            timeout=flask.current_app.config["CIRCUITSEQ_REFERENCE_PARSE_INLINE_WAIT"],
+        )
+        reference_sequence_descriptions: Dict[int, str] = {}
+        for n, (parse_dir, original_filename, future) in parse_jobs.items():
+            if not future.done():
+                continue
+            reference_sequence_description, error = _reference_parse_result(future)
+            if reference_sequence_description is None:
+                logger.info(f"Failed to parse {original_filename}: {error}")
+                _remove_parse_jobs()
+                if len(new_samples) == 1:
+                    return [], "Failed to parse reference sequence file."
+                return (
+                    [],
+                    f"Failed to parse reference sequence file for sample {new_samples[n]['name']}.",
+                )
+            reference_sequence_descriptions[n] = reference_sequence_description
+        keys = _allocate_primary_keys(today, len(new_samples), settings)
+        if len(keys) == 0:
+            _remove_parse_jobs()
+            return [], "No more samples left this week."
+        samples = []
+        for n, (new_sample, key) in enumerate(zip(new_samples, keys)):
+            if n in reference_sequence_descriptions:
+                moved_reference_sequences.append((key, new_sample["name"]))
+                _move_parsed_reference_sequence(
+                    parse_jobs[n][0], ref_seq_dir, key, new_sample["name"]
+                )
+            samples.append(
+                Sample(
+                    email=email,
+                    primary_key=key,
+                    name=new_sample["name"],
+                    running_option=new_sample["running_option"],
+                    concentration=new_sample["concentration"],
+                    reference_sequence_description=reference_sequence_descriptions.get(
+                        n
+                    ),
+                    reference_sequence_status="pending"
+                    if n in parse_jobs and n not in reference_sequence_descriptions
+                    else None,
+                    date=today,
+                    has_results_zip=False,
+                    has_results_fasta=False,
+                    has_results_gbk=False,
+                )
+            )
+        db.session.add_all(samples)
+        db.session.flush()
+        pending = {}
+        for n, (parse_dir, original_filename, future) in parse_jobs.items():
+            if n in reference_sequence_descriptions:
+                continue
             logger.info(
-                f"Saving {reference_sequence_file.filename} to temporary file {temp_file}"
+                f"  -> reference sequence of {samples[n].primary_key} is pending"
             )
-            reference_sequence_file.save(temp_file)
-            reference_sequence_description = parse_seq_to_fasta(
-                temp_file, ref_seq_filename, reference_sequence_file.filename
+            db.session.add(
+                ReferenceParseJob(
+                    sample_id=samples[n].id,
+                    directory=parse_dir.name,
+                    original_filename=original_filename,
+                    created=datetime.datetime.now(),
+                )
             )
-            if reference_sequence_description is None:
-                return None, "Failed to parse reference sequence file."
-    new_sample = Sample(
-        email=email,
-        primary_key=key,
-        name=name,
-        running_option=running_option,
-        concentration=concentration,
-        reference_sequence_description=reference_sequence_description,
-        date=today,
-        has_results_zip=False,
-        has_results_fasta=False,
-        has_results_gbk=False,
+            pending[samples[n].id] = future
+        db.session.commit()
+    except Exception:
+        # nothing is left behind by a request that fails part way through
+        db.session.rollback()
+        _remove_parse_jobs()
+        for key, name in moved_reference_sequences:
+            for suffix in [".fasta", ".fasta.gz"]:
+                (ref_seq_dir / f"{key}_{name}{suffix}").unlink(missing_ok=True)
+        raise
+    for n in reference_sequence_descriptions:
+        shutil.rmtree(parse_jobs[n][0], ignore_errors=True)
+    app = flask.current_app._get_current_object()
+    for sample_id, future in pending.items():
+        _watch_reference_parse(app, sample_id, future)
+    return samples, ""
+
+
+def add_new_sample(
+    email: str,
+    name: str,
+    running_option: str,
+    concentration: int,
+    reference_sequence_file: Optional[Union[FileStorage, pathlib.Path]],
+    data_path: str,
+) -> Tuple[Optional[Sample], str]:
+    samples, message = add_new_samples(
+        email,
+        [
+            {
+                "name": name,
+                "running_option": running_option,
+                "concentration": concentration,
+                "reference_sequence_file": reference_sequence_file,
+            }
+        ],
+        data_path,
     )
-    db.session.add(new_sample)
-    db.session.commit()
-    return new_sample, ""
+    if len(samples) == 0:
+        return None, message
+    return samples[0], message
@@ -1,17 +1,334 @@
 from __future__ import annotations
-from typing import Optional
+from typing import Optional, Any, Callable, Dict, Hashable, Tuple, Union
+from typing import List, BinaryIO, Iterable, Iterator
 import datetime
+import gzip
+import io
+import os
+import secrets
+import zipfile
+from dataclasses import dataclass
 import pathlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection
 from circuit_seq_server.logger import get_logger
 import string
 import math
 from Bio import SeqIO
 import snapgene_reader
-from itsdangerous.url_safe import URLSafeSerializer
+from itsdangerous.url_safe import URLSafeSerializer, URLSafeTimedSerializer
 
 logger = get_logger("CircuitSeqServer")
 
 
+class TTLCache:
+    """
+    Thread-safe least-recently-used cache with at most `maxsize` entries,
+    where each entry expires `ttl` seconds after it was added.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expiry_time, value = entry
+            if time.monotonic() > expiry_time:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class PoolFullError(RuntimeError):
+    """A thread pool already has the maximum number of calls waiting in its queue"""
+
+
+class MeteredThreadPool:
+    """
+    Runs functions on a pool of at most `max_workers` threads, where additional
+    calls wait in a queue, and keeps statistics on how long they waited.
+    If `max_queued` is set, calls made while that many are already waiting
+    raise PoolFullError instead of being queued.
+    """
+
+    def __init__(self, max_workers: int, max_queued: Optional[int] = None):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def run(self, func: Callable, *args) -> Any:
+        """Call func(*args) on the pool, blocking until it returns"""
+        submit_time = time.monotonic()
+        with self._lock:
+            # calls wait in the queue until a thread is free
+            n_waiting = self._queued + self._active - self.max_workers
+            if self.max_queued is not None and n_waiting >= self.max_queued:
+                self._rejected += 1
+                raise PoolFullError(f"{n_waiting} calls already queued")
+            self._queued += 1
+
+        def metered_func():
+            wait_time = time.monotonic() - submit_time
+            with self._lock:
+                self._queued -= 1
+                self._active += 1
+                self._total_wait_time += wait_time
+                self._max_wait_time = max(self._max_wait_time, wait_time)
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._completed += 1
+
+        return self._executor.submit(metered_func).result()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            n_started = self._completed + self._active
+            return {
+                "max_workers": self.max_workers,
+                "max_queued": self.max_queued,
+                "queued": self._queued,
+                "active": self._active,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "mean_wait_time": self._total_wait_time / max(n_started, 1),
+                "max_wait_time": self._max_wait_time,
+            }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+class ZipLimitError(ValueError):
+    """A zip file exceeds the limits on its size or number of members"""
+
+
+@dataclass
+class ZipLimits:
+    max_members: int
+    max_uncompressed_size: int
+    max_compression_ratio: float
+
+    @classmethod
+    def from_config(cls, config: Dict) -> ZipLimits:
+        return cls(
+            max_members=config["CIRCUITSEQ_ZIP_MAX_MEMBERS"],
+            max_uncompressed_size=config["CIRCUITSEQ_ZIP_MAX_UNCOMPRESSED_SIZE"],
+            max_compression_ratio=config["CIRCUITSEQ_ZIP_MAX_COMPRESSION_RATIO"],
+        )
+
+
+# members smaller than this are not checked for their compression ratio
+_min_ratio_checked_size = 1024 * 1024
+
+
+def check_zip_limits(zip_file: zipfile.ZipFile, limits: ZipLimits) -> None:
+    """
+    Checks the central directory of the zip file against the limits before
+    anything is extracted, raises ZipLimitError if a limit is exceeded.
+    """
+    zip_infos = zip_file.infolist()
+    if len(zip_infos) > limits.max_members:
+        raise ZipLimitError(
+            f"{len(zip_infos)} members, the maximum is {limits.max_members}"
+        )
+    total_size = sum(zip_info.file_size for zip_info in zip_infos)
+    if total_size > limits.max_uncompressed_size:
+        raise ZipLimitError(
+            f"uncompressed size {total_size} bytes, "
+            f"the maximum is {limits.max_uncompressed_size} bytes"
+        )
+    for zip_info in zip_infos:
+        if zip_info.file_size < _min_ratio_checked_size:
+            continue
+        ratio = zip_info.file_size / max(zip_info.compress_size, 1)
+        if ratio > limits.max_compression_ratio:
+            raise ZipLimitError(
+                f"{zip_info.filename} has compression ratio {ratio:.0f}, "
+                f"the maximum is {limits.max_compression_ratio}"
+            )
+
+
+class ByteBudget:
+    """
+    Thread-safe running total of the bytes extracted from a zip file, which
+    raises ZipLimitError if more than `max_bytes` are extracted.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def consume(self, n_bytes: int) -> None:
+        with self._lock:
+            self._used += n_bytes
+            if self._used > self.max_bytes:
+                raise ZipLimitError(
+                    f"more than the maximum of {self.max_bytes} bytes extracted"
+                )
+
+
+def extract_zip_member(
+    zip_file: zipfile.ZipFile,
+    member: Union[str, zipfile.ZipInfo],
+    output_file: str,
+    budget: ByteBudget,
+    chunk_size: int = 1024 * 1024,
+) -> None:
+    """
+    Streams a member of the zip file to `output_file`, counting the bytes
+    actually written against `budget` rather than trusting the size in the
+    zip file. If the budget is exceeded the partial output file is removed.
+    """
+    try:
+        with zip_file.open(member) as src, open(output_file, "wb") as dst:
+            while chunk := src.read(chunk_size):
+                budget.consume(len(chunk))
+                dst.write(chunk)
+    except ZipLimitError:
+        pathlib.Path(output_file).unlink(missing_ok=True)
+        raise
+
+
+class _ZipStreamBuffer(io.RawIOBase):
+    """
+    Unseekable file that stores what is written to it until it is popped,
+    so that zipfile writes a zip file that can be streamed.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def pop(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(
+    members: Iterable[Tuple[str, Union[bytes, pathlib.Path], int]],
+    chunk_size: int = 64 * 1024,
+) -> Iterator[bytes]:
+    """
+    Generates a zip file without writing it to disk, where each member is
+    the filename in the zip file, the data or file to add, and the compression
+    method. Files are read and compressed in chunks as the zip file is consumed.
+    """
+    buffer = _ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        for filename, data, compress_type in members:
+            if isinstance(data, bytes):
+                zip_file.writestr(
+                    zipfile.ZipInfo(filename, date_time=time.localtime()[:6]),
+                    data,
+                    compress_type=compress_type,
+                )
+            else:
+                zip_info = zipfile.ZipInfo.from_file(data, filename)
+                zip_info.compress_type = compress_type
+                with open(data, "rb") as src, zip_file.open(zip_info, "w") as dst:
+                    while chunk := src.read(chunk_size):
+                        dst.write(chunk)
+                        yield buffer.pop()
+            yield buffer.pop()
+    yield buffer.pop()
+
+
+# zip file members, keyed by filename and stored with the mtime and size of the
+# zip file they were read from, so a modified zip file is read again
+_zip_members_cache = TTLCache(maxsize=1024, ttl=3600)
+
+
+def list_zip_members(filename: Union[str, pathlib.Path]) -> List[Dict]:
+    """
+    Returns the name, size and compressed size of each file in a zip file,
+    read from the central directory without decompressing anything.
+    """
+    stat = os.stat(filename)
+    cache_key = str(filename)
+    cached = _zip_members_cache.get(cache_key)
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+    with zipfile.ZipFile(filename) as zip_file:
+        members = [
+            {
+                "name": zip_info.filename,
+                "size": zip_info.file_size,
+                "compressed_size": zip_info.compress_size,
+            }
+            for zip_info in zip_file.infolist()
+            if not zip_info.is_dir()
+        ]
+    _zip_members_cache.set(cache_key, ((stat.st_mtime_ns, stat.st_size), members))
+    return members
+
+
+def open_zip_member(
+    filename: Union[str, pathlib.Path], member: str
+) -> Optional[Tuple[BinaryIO, int]]:
+    """
+    Opens a single file in a zip file for streaming, without extracting the
+    other files. Returns the open file and its uncompressed size, or None if
+    there is no such file in the zip file. The zip file is closed when the
+    returned file is closed.
+    """
+    with zipfile.ZipFile(filename) as zip_file:
+        try:
+            zip_info = zip_file.getinfo(member)
+        except KeyError:
+            return None
+        if zip_info.is_dir():
+            return None
+        # the underlying file stays open until the member file is closed
+        return zip_file.open(zip_info), zip_info.file_size
+
+
 def encode_activation_token(email: str, secret_key: str) -> str:
     ss = URLSafeSerializer(secret_key, salt="activate")
     return ss.dumps(email)
@@ -28,6 +345,110 @@ def decode_activation_token(token: str, secret_key: str) -> Optional[str]:
     return email
 
 
+def encode_result_download_token(
+    primary_key: str, filetype: str, secret_key: str
+) -> str:
+    ss = URLSafeTimedSerializer(secret_key, salt="result-download")
+    return ss.dumps([primary_key, filetype])
+
+
+def decode_result_download_token(
+    token: str, secret_key: str, max_age: int
+) -> Optional[Tuple[str, str]]:
+    ss = URLSafeTimedSerializer(secret_key, salt="result-download")
+    try:
+        primary_key, filetype = ss.loads(token, max_age=max_age)
+    except Exception as e:
+        logger.warning(f"Invalid or expired result download token: {e}")
+        return None
+    return primary_key, filetype
+
+
+def gzip_file(
+    filename: str, max_size: int, chunk_size: int = 1024 * 1024
+) -> Optional[bytes]:
+    """
+    Returns the gzip-compressed contents of the file, or None if this would be
+    larger than `max_size` bytes. The file is read in chunks, and compression
+    stops as soon as the compressed data exceeds `max_size`.
+    """
+    compressed = io.BytesIO()
+    with open(filename, "rb") as f, gzip.GzipFile(
+        fileobj=compressed, mode="wb", mtime=0
+    ) as gz:
+        while chunk := f.read(chunk_size):
+            gz.write(chunk)
+            if compressed.tell() > max_size:
+                return None
+    if compressed.tell() > max_size:
+        return None
+    return compressed.getvalue()
+
+
+def write_gzip_sibling(
+    filename: Union[str, pathlib.Path], chunk_size: int = 1024 * 1024
+) -> pathlib.Path:
+    """
+    Writes a gzip-compressed copy of the file to `{filename}.gz`, which can be
+    sent instead of the file to clients that accept gzip encoding.
+    The copy is written to a uniquely named temporary file and then renamed, so
+    an incomplete copy is never sent, and concurrent copies of the same file
+    don't write to the same temporary file.
+    """
+    gzip_filename = pathlib.Path(f"{filename}.gz")
+    tmp_filename = gzip_filename.with_name(
+        f".{secrets.token_hex(8)}.{gzip_filename.name}.tmp"
+    )
+    try:
+        with open(filename, "rb") as f, open(tmp_filename, "wb") as f_gz, gzip.GzipFile(
+            filename=pathlib.Path(filename).name, fileobj=f_gz, mode="wb", mtime=0
+        ) as gz:
+            while chunk := f.read(chunk_size):
+                gz.write(chunk)
+        os.replace(tmp_filename, gzip_filename)
+    except BaseException:
+        tmp_filename.unlink(missing_ok=True)
+        raise
+    return gzip_filename
+
+
+def parse_seq_to_fasta_and_gzip(
+    input_file: pathlib.Path, output_file: str, original_filename: str
+) -> Optional[str]:
+    """
+    Parses a reference sequence file to a fasta file with a gzip-compressed copy.
+    """
+    reference_sequence_description = parse_seq_to_fasta(
+        input_file, output_file, original_filename
+    )
+    if reference_sequence_description is not None:
+        write_gzip_sibling(output_file)
+    return reference_sequence_description
+
+
+def parse_seq_to_fasta_and_gzip_process(
+    connection: Connection,
+    input_file: pathlib.Path,
+    output_file: str,
+    original_filename: str,
+) -> None:
+    """
+    Target of a reference sequence parsing process: sends the reference sequence
+    description and an error message, if any, to `connection`.
+    """
+    try:
+        connection.send(
+            (
+                parse_seq_to_fasta_and_gzip(input_file, output_file, original_filename),
+                "",
+            )
+        )
+    except Exception as e:
+        connection.send((None, f"{e!r}"))
+    finally:
+        connection.close()
+
+
 def get_start_of_week(current_date: Optional[datetime.date] = None) -> datetime.date:
     if current_date is None:
         current_date = datetime.date.today()
@@ -35,6 +456,30 @@ def get_start_of_week(current_date: Optional[datetime.date] = None) -> datetime.
     return datetime.date.fromisocalendar(year, week, 1)
 
 
+def get_date_range(
+    year: Optional[str] = None,
+    week: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+) -> Tuple[datetime.date, datetime.date]:
+    """
+    Returns the first and last date of an ISO `year` and `week`, or of the
+    ISO format `start_date` and `end_date`, or if neither are given of the
+    current week. Raises ValueError if the arguments are invalid.
+    """
+    if year or week:
+        start = datetime.date.fromisocalendar(int(year or 0), int(week or 0), 1)
+        return start, start + datetime.timedelta(days=6)
+    if start_date or end_date:
+        start = datetime.date.fromisoformat(start_date or "")
+        end = datetime.date.fromisoformat(end_date or "")
+        if end < start:
+            raise ValueError(f"end date {end} is before start date {start}")
+        return start, end
+    start = get_start_of_week()
+    return start, start + datetime.timedelta(days=6)
+
+
 def get_primary_key(
     year: int, week: int, current_count: int, n_rows: int, n_cols: int
 ) -> Optional[str]:
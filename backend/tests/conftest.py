@@ -1,7 +1,9 @@
 from __future__ import annotations
 import pytest
 from circuit_seq_server import create_app
-from typing import List
+from typing import List, Tuple
+from concurrent.futures import Future
+import circuit_seq_server.model as model
 import flask
 import io
 import os
@@ -32,6 +34,8 @@ def app(monkeypatch, tmp_path):
     )
     temp_data_path = str(tmp_path)
     app = create_app(data_path=temp_data_path)
+    # starting the reference sequence parsing processes can be slow
+    app.config["CIRCUITSEQ_REFERENCE_PARSE_INLINE_WAIT"] = 60
     ftu.add_test_users(app)
     ftu.add_test_samples(app)
     yield app
@@ -42,6 +46,25 @@ def client(app):
     return app.test_client()
 
 
+@pytest.fixture()
+def held_reference_parses(app, monkeypatch) -> List[Tuple[Future, Future]]:
+    # reference sequences are parsed as usual, but the results are held back
+    # until they are released by ftu.release_reference_parses
+    app.config["CIRCUITSEQ_REFERENCE_PARSE_INLINE_WAIT"] = 0
+    held = []
+    submit_reference_parse = model._submit_reference_parse
+
+    def _submit(parse_dir, original_filename, stop=None):
+        held_future = Future()
+        held.append(
+            (submit_reference_parse(parse_dir, original_filename, stop), held_future)
+        )
+        return held_future
+
+    monkeypatch.setattr(model, "_submit_reference_parse", _submit)
+    return held
+
+
 @pytest.fixture()
 def result_zipfiles() -> List[pathlib.Path]:
     results_path = (
@@ -2,6 +2,8 @@ from flask_sqlalchemy import SQLAlchemy
 import argon2
 from circuit_seq_server.model import User, Sample
 import datetime
+from typing import List, Tuple
+from concurrent.futures import Future
 
 
 def add_test_users(app):
@@ -51,3 +53,15 @@ def add_test_samples(app):
             )
             db.session.add(new_sample)
             db.session.commit()
+
+
+def release_reference_parses(held: List[Tuple[Future, Future]]) -> None:
+    # passes on the results of the reference sequence parses held back by the
+    # held_reference_parses fixture
+    for future, held_future in held:
+        if held_future.cancelled():
+            continue
+        if future.exception(timeout=60) is not None:
+            held_future.set_exception(future.exception())
+        else:
+            held_future.set_result(future.result())
@@ -1,10 +1,24 @@
 from __future__ import annotations
 from typing import Dict
 import io
+import gzip
+import json
+import base64
+import hashlib
+import time
+import re
+import datetime
 import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
 from freezegun import freeze_time
 import pathlib
+import sqlalchemy
+import argon2
 import circuit_seq_server
+from werkzeug.datastructures import FileStorage
+from circuit_seq_server.email_worker import EmailWorker
 import flask_test_utils as ftu
 
 
@@ -20,6 +34,40 @@ def test_remaining_sat(client):
     assert response.json["remaining"] == 0
 
 
+@freeze_time("2022-11-21")
+def test_remaining_etag(client):
+    # first request creates the default settings
+    client.get("/api/remaining")
+    response = client.get("/api/remaining")
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "public, no-cache"
+    etag = response.headers["ETag"]
+    with client.application.app_context():
+        engine = circuit_seq_server.model.db.engine
+    queries = []
+
+    def record_query(conn, cursor, statement, *args):
+        queries.append(statement)
+
+    sqlalchemy.event.listen(engine, "before_cursor_execute", record_query)
+    response = client.get("/api/remaining", headers={"If-None-Match": etag})
+    sqlalchemy.event.remove(engine, "before_cursor_execute", record_query)
+    assert response.status_code == 304
+    assert response.data == b""
+    # checking the etag doesn't count the samples
+    assert not any("count(" in query or "sum(" in query for query in queries)
+    # adding a sample changes the etag
+    client.post(
+        "/api/sample",
+        data={"name": "abc", "running_option": "r", "concentration": 97},
+        headers=_get_auth_headers(client),
+    )
+    response = client.get("/api/remaining", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json["remaining"] == 95
+    assert response.headers["ETag"] != etag
+
+
 def _get_auth_headers(
     client, email: str = "user@embl.de", password: str = "user"
 ) -> Dict:
@@ -48,10 +96,77 @@ def test_login_valid(client):
     response = client.post("/api/login", json={"email": email, "password": password})
     assert response.status_code == 200
     assert "access_token" in response.json
+    assert "refresh_token" in response.json
     assert response.json["user"]["email"] == email
     assert response.json["user"]["is_admin"] is False
 
 
+def test_refresh_invalid(client):
+    # no auth header
+    response = client.post("/api/refresh")
+    assert response.status_code == 401
+    # access token instead of refresh token
+    headers = _get_auth_headers(client)
+    response = client.post("/api/refresh", headers=headers)
+    assert response.status_code == 422
+    # refresh token can't be used as an access token
+    response = client.post(
+        "/api/login", json={"email": "user@embl.de", "password": "user"}
+    )
+    refresh_headers = {"Authorization": f"Bearer {response.json['refresh_token']}"}
+    response = client.get("/api/samples", headers=refresh_headers)
+    assert response.status_code == 422
+
+
+def test_access_token_expired(client):
+    headers = _get_auth_headers(client)
+    with freeze_time(datetime.datetime.now() + datetime.timedelta(minutes=31)):
+        response = client.get("/api/samples", headers=headers)
+    # the frontend only refreshes the access token for this response, other
+    # 401 responses are application errors
+    assert response.status_code == 401
+    assert response.json == {"msg": "Token has expired"}
+
+
+def test_refresh_valid(client):
+    response = client.post(
+        "/api/login", json={"email": "user@embl.de", "password": "user"}
+    )
+    refresh_headers = {"Authorization": f"Bearer {response.json['refresh_token']}"}
+    response = client.post("/api/refresh", headers=refresh_headers)
+    assert response.status_code == 200
+    assert response.json["user"]["email"] == "user@embl.de"
+    assert "refresh_token" not in response.json
+    headers = {"Authorization": f"Bearer {response.json['access_token']}"}
+    assert client.get("/api/samples", headers=headers).status_code == 200
+    # refresh token can be used more than once
+    response = client.post("/api/refresh", headers=refresh_headers)
+    assert response.status_code == 200
+
+
+def test_logout(client):
+    response = client.post(
+        "/api/login", json={"email": "user@embl.de", "password": "user"}
+    )
+    refresh_headers = {"Authorization": f"Bearer {response.json['refresh_token']}"}
+    response = client.post(
+        "/api/login", json={"email": "user@embl.de", "password": "user"}
+    )
+    other_refresh_headers = {
+        "Authorization": f"Bearer {response.json['refresh_token']}"
+    }
+    response = client.post("/api/logout", headers=refresh_headers)
+    assert response.status_code == 200
+    # refresh token has been revoked
+    response = client.post("/api/refresh", headers=refresh_headers)
+    assert response.status_code == 401
+    response = client.post("/api/logout", headers=refresh_headers)
+    assert response.status_code == 401
+    # refresh token from another login is still valid
+    response = client.post("/api/refresh", headers=other_refresh_headers)
+    assert response.status_code == 200
+
+
 def test_change_password_invalid(client):
     headers = _get_auth_headers(client)
     response = client.post(
@@ -83,6 +198,8 @@ def test_change_password_valid(client):
         "/api/login", json={"email": "user@embl.de", "password": "user"}
     )
     assert response.status_code == 200
+    refresh_headers = {"Authorization": f"Bearer {response.json['refresh_token']}"}
+    assert client.post("/api/refresh", headers=refresh_headers).status_code == 200
     response = client.post(
         "/api/change_password",
         headers=headers,
@@ -90,6 +207,8 @@ def test_change_password_valid(client):
     )
     assert response.status_code == 200
     assert "Password changed" in response.json
+    # existing refresh tokens are revoked by a password change
+    assert client.post("/api/refresh", headers=refresh_headers).status_code == 401
     response = client.post(
         "/api/login", json={"email": "user@embl.de", "password": "user"}
     )
@@ -100,6 +219,89 @@ def test_change_password_valid(client):
     assert response.status_code == 200
 
 
+def test_cached_user_no_db_queries(client):
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    assert client.get("/api/admin/token", headers=headers).status_code == 200
+    with client.application.app_context():
+        engine = circuit_seq_server.model.db.engine
+    queries = []
+
+    def count_query(*args):
+        queries.append(args)
+
+    sqlalchemy.event.listen(engine, "before_cursor_execute", count_query)
+    assert client.get("/api/admin/token", headers=headers).status_code == 200
+    sqlalchemy.event.remove(engine, "before_cursor_execute", count_query)
+    assert len(queries) == 0
+
+
+def test_argon2_parameters_from_env(tmp_path, monkeypatch):
+    monkeypatch.setenv("JWT_SECRET_KEY", "0123456789abcdefghijklmnopqrstuvwxyz")
+    monkeypatch.setenv("CIRCUITSEQ_ARGON2_TIME_COST", "1")
+    monkeypatch.setenv("CIRCUITSEQ_ARGON2_MEMORY_COST", "1024")
+    monkeypatch.setenv("CIRCUITSEQ_ARGON2_PARALLELISM", "1")
+    monkeypatch.setenv("CIRCUITSEQ_PASSWORD_HASHING_THREADS", "2")
+    app = circuit_seq_server.create_app(data_path=str(tmp_path))
+    ftu.add_test_users(app)
+    assert circuit_seq_server.model.ph.time_cost == 1
+    assert circuit_seq_server.model.ph.memory_cost == 1024
+    assert circuit_seq_server.model.ph.parallelism == 1
+    assert circuit_seq_server.model.password_hashing_pool.max_workers == 2
+    client = app.test_client()
+    # existing password hash with default parameters is rehashed on login
+    _get_auth_headers(client)
+    with app.app_context():
+        user = circuit_seq_server.model.db.session.execute(
+            circuit_seq_server.model.db.select(circuit_seq_server.model.User).filter(
+                circuit_seq_server.model.User.email == "user@embl.de"
+            )
+        ).scalar_one()
+        assert "m=1024,t=1,p=1" in user.password_hash
+    assert client.post(
+        "/api/login", json={"email": "user@embl.de", "password": "user"}
+    ).json["access_token"]
+    monkeypatch.undo()
+    monkeypatch.setenv("JWT_SECRET_KEY", "0123456789abcdefghijklmnopqrstuvwxyz")
+    circuit_seq_server.create_app(data_path=str(tmp_path))
+    assert circuit_seq_server.model.ph.time_cost == argon2.DEFAULT_TIME_COST
+    assert circuit_seq_server.model.password_hashing_pool.max_workers == 4
+
+
+def test_password_hashing_busy(client, monkeypatch):
+    headers = _get_auth_headers(client)
+    pool = circuit_seq_server.model.MeteredThreadPool(max_workers=1, max_queued=0)
+    monkeypatch.setattr(circuit_seq_server.model, "password_hashing_pool", pool)
+    release = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # the only hashing thread is busy, and no calls can be queued
+        future = executor.submit(pool.run, release.wait)
+        while pool.stats()["active"] < 1:
+            time.sleep(0.01)
+        for url, json, request_headers in [
+            ("/api/login", {"email": "user@embl.de", "password": "user"}, None),
+            (
+                "/api/change_password",
+                {"current_password": "user", "new_password": "User1234"},
+                headers,
+            ),
+            ("/api/signup", {"email": "new@embl.de", "password": "User1234"}, None),
+        ]:
+            response = client.post(url, json=json, headers=request_headers)
+            assert response.status_code == 503
+            assert response.headers["Retry-After"] == "5"
+        release.set()
+        assert future.result() is True
+    assert pool.stats()["rejected"] == 3
+    # password unchanged and login works again
+    assert (
+        client.post(
+            "/api/login", json={"email": "user@embl.de", "password": "user"}
+        ).status_code
+        == 200
+    )
+    pool.shutdown()
+
+
 def test_jwt_same_secret_persists_valid_tokens(tmp_path, monkeypatch):
     monkeypatch.setenv("JWT_SECRET_KEY", "0123456789abcdefghijklmnopqrstuvwxyz")
     app1 = circuit_seq_server.create_app(data_path=str(tmp_path))
@@ -143,6 +345,189 @@ def test_samples_valid(client):
     assert "previous_samples" in response.json
 
 
+def test_samples_pagination(client):
+    headers = _get_auth_headers(client)
+    keys = []
+    cursor = None
+    for n in range(4):
+        query = {"page_size": 1}
+        if cursor is not None:
+            query["cursor"] = cursor
+        response = client.get("/api/samples", headers=headers, query_string=query)
+        assert response.status_code == 200
+        assert response.json["current_samples"] == []
+        assert len(response.json["previous_samples"]) == 1
+        sample = response.json["previous_samples"][0]
+        assert "email" not in sample
+        keys.append(sample["primary_key"])
+        cursor = response.json["next_cursor"]
+    assert cursor is None
+    assert keys == ["22_46_A4", "22_46_A3", "22_46_A2", "22_46_A1"]
+    response = client.get(
+        "/api/samples",
+        headers=headers,
+        query_string={"start_date": "2022-11-15", "end_date": "2022-11-16"},
+    )
+    assert response.status_code == 200
+    assert [s["primary_key"] for s in response.json["previous_samples"]] == [
+        "22_46_A3",
+        "22_46_A2",
+    ]
+    assert response.json["next_cursor"] is None
+    for query in [{"cursor": "abc"}, {"start_date": "x"}, {"page_size": "y"}]:
+        response = client.get("/api/samples", headers=headers, query_string=query)
+        assert response.status_code == 401
+
+
+def test_samples_etag(client, result_zipfiles):
+    headers = _get_auth_headers(client)
+    response = client.get("/api/samples", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "private, no-cache"
+    etag = response.headers["ETag"]
+    response = client.get("/api/samples", headers={"If-None-Match": etag, **headers})
+    assert response.status_code == 304
+    # different query parameters have a different etag
+    response = client.get(
+        "/api/samples",
+        headers={"If-None-Match": etag, **headers},
+        query_string={"page_size": 2},
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    # new results change the etag
+    _upload_result(client, result_zipfiles[0])
+    response = client.get("/api/samples", headers={"If-None-Match": etag, **headers})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json["previous_samples"][2]["has_results_zip"] is True
+
+
+def _get_events_token(client) -> str:
+    response = client.post("/api/events/token", headers=_get_auth_headers(client))
+    assert response.status_code == 200
+    return response.json["token"]
+
+
+def test_events_invalid(client):
+    # no token
+    response = client.get("/api/events")
+    assert response.status_code == 401
+    # no auth header
+    response = client.post("/api/events/token")
+    assert response.status_code == 401
+    # an access token can't be used to open an event stream
+    token = _get_auth_headers(client)["Authorization"].split(" ")[1]
+    response = client.get("/api/events", query_string={"token": token})
+    assert response.status_code == 401
+    # the event stream token can't be used as an access token
+    token = _get_events_token(client)
+    response = client.get("/api/samples", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 401
+    # the event stream token expires
+    with freeze_time(datetime.datetime.now() + datetime.timedelta(minutes=2)):
+        response = client.get("/api/events", query_string={"token": token})
+    assert response.status_code == 401
+
+
+def test_events_max_streams(client):
+    client.application.config["CIRCUITSEQ_EVENTS_MAX_LIFETIME"] = 0
+
+    def _open_event_stream():
+        return client.get(
+            "/api/events",
+            query_string={"token": _get_events_token(client)},
+            buffered=False,
+        )
+
+    responses = [_open_event_stream() for _ in range(17)]
+    # at most 16 streams are open at once
+    assert [response.status_code for response in responses] == [200] * 16 + [503]
+    for response in reversed(responses):
+        response.close()
+    # closed streams no longer count towards the limit
+    response = _open_event_stream()
+    assert response.status_code == 200
+    # the stream ends after its maximum lifetime
+    assert list(response.response) == [b"retry: 5000\n\n"]
+    response.close()
+
+
+def _next_event(events) -> bytes:
+    # skips keepalive comments
+    while (event := next(events)) == b": keepalive\n\n":
+        pass
+    return event
+
+
+@freeze_time("2022-11-21")
+def test_events_valid(client, result_zipfiles):
+    client.application.config["CIRCUITSEQ_EVENTS_POLL_INTERVAL"] = 0.05
+    client.application.config["CIRCUITSEQ_EVENTS_KEEPALIVE_INTERVAL"] = 0.1
+    token = _get_events_token(client)
+    response = client.get("/api/events", query_string={"token": token}, buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    events = response.response
+    assert next(events) == b"retry: 5000\n\n"
+    # initial remaining capacity
+    assert next(events) == (
+        b'event: remaining\ndata: {"remaining": 96, "message": ""}\n\n'
+    )
+    # no new events
+    assert next(events) == b": keepalive\n\n"
+    # results uploaded for one of the user's samples
+    _upload_result(client, result_zipfiles[0])
+    assert _next_event(events) == (
+        b'event: results\ndata: {"primary_key": "22_46_A2", "has_results_fasta": true,'
+        b' "has_results_gbk": true, "has_results_zip": true}\n\n'
+    )
+    # a sample is added
+    client.post(
+        "/api/sample",
+        data={"name": "abc", "running_option": "r", "concentration": 97},
+        headers=_get_auth_headers(client, "admin@embl.de", "admin"),
+    )
+    assert _next_event(events) == (
+        b'event: remaining\ndata: {"remaining": 95, "message": ""}\n\n'
+    )
+    response.close()
+
+
+def test_events_shared_poll(client, monkeypatch):
+    client.application.config["CIRCUITSEQ_EVENTS_KEEPALIVE_INTERVAL"] = 0.1
+    n_polls = 0
+    get_samples_version = circuit_seq_server.jobs.get_samples_version
+
+    def counted_get_samples_version(*args):
+        nonlocal n_polls
+        n_polls += 1
+        return get_samples_version(*args)
+
+    monkeypatch.setattr(
+        circuit_seq_server.jobs, "get_samples_version", counted_get_samples_version
+    )
+    responses = [
+        client.get(
+            "/api/events",
+            query_string={"token": _get_events_token(client)},
+            buffered=False,
+        )
+        for _ in range(4)
+    ]
+    for response in responses:
+        assert next(response.response) == b"retry: 5000\n\n"
+        assert next(response.response).startswith(b"event: remaining")
+    for _ in range(3):
+        for response in responses:
+            assert next(response.response) == b": keepalive\n\n"
+    # all the streams share the same polling of the samples version, which
+    # happens every poll interval
+    assert 1 <= n_polls <= 2
+    for response in reversed(responses):
+        response.close()
+
+
 def test_running_options_invalid(client):
     # no auth header
     response = client.get("/api/running_options")
@@ -182,6 +567,17 @@ def test_sample_mon_fasta(client, ref_seq_fasta):
     assert fasta_path.is_file()
     with fasta_path.open() as f:
         assert new_sample["reference_sequence_description"] in f.readline()
+    # a gzip-compressed copy is sent to clients that accept it
+    gzip_fasta_path = fasta_path.with_name(f"{fasta_path.name}.gz")
+    assert gzip.decompress(gzip_fasta_path.read_bytes()) == fasta_path.read_bytes()
+    response = client.post(
+        "/api/reference_sequence",
+        json={"primary_key": "22_47_A1"},
+        headers={**headers, "Accept-Encoding": "gzip"},
+    )
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.data == gzip_fasta_path.read_bytes()
 
 
 @freeze_time("2022-11-21")
@@ -317,6 +713,154 @@ def test_sample_mon_snapgene_noid(client, ref_seq_snapgene_noid):
         assert new_sample["reference_sequence_description"] in f.readline()
 
 
+@freeze_time("2022-11-21")
+def test_samples_batch_valid(client, ref_seq_fasta, ref_seq_genbank):
+    headers = _get_auth_headers(client)
+    manifest = [
+        {"name": "s1", "running_option": "r1", "concentration": 100, "file": "f1"},
+        {"name": "s2", "running_option": "r2", "concentration": 200},
+        {"name": "s3", "running_option": "r3", "concentration": 300, "file": "f3"},
+    ]
+    response = client.post(
+        "/api/samples/batch",
+        data={
+            "manifest": json.dumps(manifest),
+            "f1": (ref_seq_fasta, "test.fa"),
+            "f3": (ref_seq_genbank, "test.gbk"),
+        },
+        headers=headers,
+    )
+    assert response.status_code == 200
+    new_samples = response.json["samples"]
+    assert [s["primary_key"] for s in new_samples] == [
+        "22_47_A1",
+        "22_47_A2",
+        "22_47_A3",
+    ]
+    assert [s["name"] for s in new_samples] == ["s1", "s2", "s3"]
+    assert [s["concentration"] for s in new_samples] == [100, 200, 300]
+    assert [s["reference_sequence_description"] for s in new_samples] == [
+        "seq0",
+        None,
+        "Z78533.1",
+    ]
+    assert [s["reference_sequence_status"] for s in new_samples] == [None] * 3
+    data_path = pathlib.Path(client.application.config.get("CIRCUITSEQ_DATA_PATH"))
+    ref_dir = data_path / "2022/47/inputs/references"
+    assert (ref_dir / "22_47_A1_s1.fasta").is_file()
+    assert not (ref_dir / "22_47_A2_s2.fasta").is_file()
+    assert (ref_dir / "22_47_A3_s3.fasta").is_file()
+    assert client.get("/api/remaining").json["remaining"] == 93
+
+
+@freeze_time("2022-11-21")
+def test_samples_batch_pending(client, ref_seq_fasta, held_reference_parses):
+    headers = _get_auth_headers(client)
+    manifest = [
+        {"name": "s1", "running_option": "r1", "concentration": 100, "file": "f1"},
+        {"name": "s2", "running_option": "r2", "concentration": 200, "file": "f2"},
+    ]
+    response = client.post(
+        "/api/samples/batch",
+        data={
+            "manifest": json.dumps(manifest),
+            "f1": (ref_seq_fasta, "test.fa"),
+            "f2": (io.BytesIO(b"invalid_fasta_contents"), "test.fa"),
+        },
+        headers=headers,
+    )
+    # samples are added without waiting for the invalid reference sequence
+    assert response.status_code == 200
+    assert [s["primary_key"] for s in response.json["samples"]] == [
+        "22_47_A1",
+        "22_47_A2",
+    ]
+    assert [s["reference_sequence_status"] for s in response.json["samples"]] == [
+        "pending",
+        "pending",
+    ]
+    response = client.get("/api/samples", headers=headers)
+    etag = response.headers["ETag"]
+    ftu.release_reference_parses(held_reference_parses)
+    for _ in range(600):
+        samples = client.get("/api/samples", headers=headers).json["current_samples"]
+        if all(s["reference_sequence_status"] != "pending" for s in samples):
+            break
+        time.sleep(0.1)
+    # newest samples are listed first
+    assert [s["primary_key"] for s in samples] == ["22_47_A2", "22_47_A1"]
+    assert [s["reference_sequence_status"] for s in samples] == ["failed", None]
+    assert [s["reference_sequence_description"] for s in samples] == [None, "seq0"]
+    # parsed reference sequences change the etag
+    response = client.get("/api/samples", headers={"If-None-Match": etag, **headers})
+    assert response.status_code == 200
+    data_path = pathlib.Path(client.application.config.get("CIRCUITSEQ_DATA_PATH"))
+    ref_dir = data_path / "2022/47/inputs/references"
+    assert (ref_dir / "22_47_A1_s1.fasta").is_file()
+    assert not (ref_dir / "22_47_A2_s2.fasta").is_file()
+
+
+@freeze_time("2022-11-21")
+def test_samples_batch_invalid(client, ref_seq_fasta):
+    headers = _get_auth_headers(client)
+    # no auth header
+    response = client.post("/api/samples/batch", data={"manifest": "[]"})
+    assert response.status_code == 401
+    for manifest in ["", "[]", "{", '[{"name": "s1", "file": "missing"}]']:
+        response = client.post(
+            "/api/samples/batch", data={"manifest": manifest}, headers=headers
+        )
+        assert response.status_code == 401
+    # the same reference sequence file used for two samples
+    manifest = [
+        {"name": "s1", "running_option": "r1", "concentration": 100, "file": "f1"},
+        {"name": "s2", "running_option": "r2", "concentration": 200, "file": "f1"},
+    ]
+    response = client.post(
+        "/api/samples/batch",
+        data={
+            "manifest": json.dumps(manifest),
+            "f1": (io.BytesIO(ref_seq_fasta.getvalue()), "test.fa"),
+        },
+        headers=headers,
+    )
+    assert response.status_code == 401
+    assert response.json["message"] == (
+        "Reference sequence file f1 is used by more than one sample"
+    )
+    assert client.get("/api/remaining").json["remaining"] == 96
+    # one invalid reference sequence: no samples are added
+    manifest = [
+        {"name": "s1", "running_option": "r1", "concentration": 100, "file": "f1"},
+        {"name": "s2", "running_option": "r2", "concentration": 200, "file": "f2"},
+    ]
+    response = client.post(
+        "/api/samples/batch",
+        data={
+            "manifest": json.dumps(manifest),
+            "f1": (ref_seq_fasta, "test.fa"),
+            "f2": (io.BytesIO(b"invalid_fasta_contents"), "test.fa"),
+        },
+        headers=headers,
+    )
+    assert response.status_code == 401
+    assert "s2" in response.json["message"]
+    assert client.get("/api/remaining").json["remaining"] == 96
+    # more samples than remaining wells: no samples are added
+    manifest = [
+        {"name": f"s{n}", "running_option": "r", "concentration": 100}
+        for n in range(97)
+    ]
+    response = client.post(
+        "/api/samples/batch",
+        data={"manifest": json.dumps(manifest)},
+        headers=headers,
+    )
+    assert response.status_code == 401
+    assert "Only 96 samples left" in response.json["message"]
+    assert client.get("/api/remaining").json["remaining"] == 96
+
+
 def test_result_invalid(client):
     response = client.post(
         "/api/result", json={"primary_key": "XYZ", "filetype": "zip"}
@@ -347,6 +891,16 @@ def test_result_invalid(client):
         assert f"No {filetype} results available" in response.json
 
 
+def _wait_for_job(client, job_id: int) -> Dict:
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    for _ in range(1000):
+        job = client.get(f"/api/admin/jobs/{job_id}", headers=headers).json
+        if job["status"] in ["done", "failed"]:
+            return job
+        time.sleep(0.01)
+    assert False, f"Job {job_id} did not finish"
+
+
 def _upload_result(client, result_zipfile):
     headers = _get_auth_headers(client, "admin@embl.de", "admin")
     with open(result_zipfile, "rb") as f:
@@ -357,6 +911,9 @@ def _upload_result(client, result_zipfile):
             },
             headers=headers,
         )
+    if response.status_code == 202:
+        # wait for the result to be processed
+        _wait_for_job(client, response.json["job_id"])
     return response
 
 
@@ -374,6 +931,176 @@ def test_result_valid(client, result_zipfiles):
         assert len(response.data) > 1
 
 
+def test_result_gzip_and_range(client, result_zipfiles):
+    headers = _get_auth_headers(client, "user@embl.de", "user")
+    _upload_result(client, result_zipfiles[0])
+    for filetype in ["fasta", "gbk"]:
+        json = {"primary_key": "22_46_A2", "filetype": filetype}
+        data = client.post("/api/result", json=json, headers=headers).data
+        response = client.post(
+            "/api/result",
+            json=json,
+            headers={**headers, "Accept-Encoding": "gzip, deflate"},
+        )
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in response.headers["Vary"]
+        assert len(response.data) < len(data) / 2
+        assert gzip.decompress(response.data) == data
+        # resume an interrupted download
+        response = client.post(
+            "/api/result",
+            json=json,
+            headers={**headers, "Range": "bytes=100-"},
+        )
+        assert response.status_code == 206
+        assert "Content-Encoding" not in response.headers
+        assert response.data == data[100:]
+        gzip_data = client.post(
+            "/api/result",
+            json=json,
+            headers={**headers, "Accept-Encoding": "gzip"},
+        ).data
+        response = client.post(
+            "/api/result",
+            json=json,
+            headers={**headers, "Accept-Encoding": "gzip", "Range": "bytes=0-99"},
+        )
+        assert response.status_code == 206
+        assert response.data == gzip_data[:100]
+    # zip files are not compressed again
+    response = client.post(
+        "/api/result",
+        json={"primary_key": "22_46_A2", "filetype": "zip"},
+        headers={**headers, "Accept-Encoding": "gzip"},
+    )
+    assert response.status_code == 200
+    assert "Content-Encoding" not in response.headers
+
+
+def test_result_x_accel_redirect(client, result_zipfiles):
+    client.application.config["CIRCUITSEQ_X_ACCEL_REDIRECT"] = "/internal/data/"
+    headers = _get_auth_headers(client, "user@embl.de", "user")
+    result_zipfile = result_zipfiles[0]
+    _upload_result(client, result_zipfile)
+    for filetype, mimetype in [
+        ("fasta", "application/octet-stream"),
+        ("gbk", "application/octet-stream"),
+        ("zip", "application/zip"),
+    ]:
+        response = client.post(
+            "/api/result",
+            json={"primary_key": "22_46_A2", "filetype": filetype},
+            headers=headers,
+        )
+        assert response.status_code == 200
+        # the file itself is sent by nginx
+        assert response.data == b""
+        filename = f"{result_zipfile.stem}.{filetype}"
+        assert (
+            response.headers["X-Accel-Redirect"]
+            == f"/internal/data/2022/46/results/{filename}"
+        )
+        assert (
+            response.headers["Content-Disposition"]
+            == f"attachment; filename={filename}"
+        )
+        assert response.mimetype == mimetype
+
+
+def test_result_zip_members(client, result_zipfiles):
+    for endpoint in ["/api/result_zip_members", "/api/result_zip_member"]:
+        # no auth header
+        response = client.post(endpoint, json={"primary_key": "22_46_A2"})
+        assert response.status_code == 401
+    headers = _get_auth_headers(client, "user@embl.de", "user")
+    response = client.post(
+        "/api/result_zip_members", json={"primary_key": "XYZ"}, headers=headers
+    )
+    assert response.status_code == 401
+    assert response.json == "Sample not found"
+    response = client.post(
+        "/api/result_zip_members", json={"primary_key": "22_46_A2"}, headers=headers
+    )
+    assert response.status_code == 401
+    assert response.json == "No zip results available"
+    result_zipfile = result_zipfiles[0]
+    _upload_result(client, result_zipfile)
+    response = client.post(
+        "/api/result_zip_members", json={"primary_key": "22_46_A2"}, headers=headers
+    )
+    assert response.status_code == 200
+    with zipfile.ZipFile(result_zipfile) as zip_file:
+        assert response.json == [
+            {
+                "name": zip_info.filename,
+                "size": zip_info.file_size,
+                "compressed_size": zip_info.compress_size,
+            }
+            for zip_info in zip_file.infolist()
+            if not zip_info.is_dir()
+        ]
+        for member in response.json:
+            response = client.post(
+                "/api/result_zip_member",
+                json={"primary_key": "22_46_A2", "member": member["name"]},
+                headers=headers,
+            )
+            assert response.status_code == 200
+            assert response.content_length == member["size"]
+            assert response.data == zip_file.read(member["name"])
+            assert pathlib.PurePosixPath(member["name"]).name in (
+                response.headers["Content-Disposition"]
+            )
+    for member in [None, "missing.txt", f"{result_zipfile.stem}/"]:
+        response = client.post(
+            "/api/result_zip_member",
+            json={"primary_key": "22_46_A2", "member": member},
+            headers=headers,
+        )
+        assert response.status_code == 401
+        assert "not found in results zip file" in response.json
+    # admins can access the results of any sample
+    response = client.post(
+        "/api/result_zip_members",
+        json={"primary_key": "22_46_A2"},
+        headers=_get_auth_headers(client, "admin@embl.de", "admin"),
+    )
+    assert response.status_code == 200
+
+
+def test_result_download_link(client, result_zipfiles):
+    client.application.config["CIRCUITSEQ_EMAIL_ATTACHMENT_BUDGET"] = 0
+    _upload_result(client, result_zipfiles[0])
+    with client.application.app_context():
+        assert EmailWorker().send_queued_emails() == 1
+    email_msg = client.application.config["TESTING_ONLY_LAST_SMTP_MESSAGE"]
+    urls = re.findall(
+        r"https://circuitseq.iwr.uni-heidelberg.de(/api/result/\S+)",
+        email_msg.get_body().get_content(),
+    )
+    assert len(urls) == 2
+    # no auth header required
+    for url, filetype in zip(urls, ["fasta", "gbk"]):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert (
+            response.data
+            == client.post(
+                "/api/result",
+                json={"primary_key": "22_46_A2", "filetype": filetype},
+                headers=_get_auth_headers(client),
+            ).data
+        )
+    response = client.get(f"{urls[0][:-2]}")
+    assert response.status_code == 401
+    assert response.json == "Invalid or expired download link"
+    # link expires after 30 days
+    with freeze_time(datetime.datetime.now() + datetime.timedelta(days=31)):
+        response = client.get(urls[0])
+        assert response.status_code == 401
+
+
 def test_admin_settings_invalid(client):
     # no auth header
     response = client.get("/api/admin/settings")
@@ -408,6 +1135,11 @@ def test_admin_settings_valid(client):
     assert response.json["plate_n_cols"] == 18
     assert response.json["running_options"] == ["o1", "o2", "o3"]
     assert response.json["last_submission_day"] == 4
+    etag = response.headers["ETag"]
+    response = client.get(
+        "/api/admin/settings", headers={"If-None-Match": etag, **headers}
+    )
+    assert response.status_code == 304
 
 
 def test_admin_samples_invalid(client):
@@ -428,6 +1160,124 @@ def test_admin_samples_valid(client):
     assert "previous_samples" in response.json
 
 
+def test_admin_samples_pagination(client):
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.get(
+        "/api/admin/samples", headers=headers, query_string={"page_size": 3}
+    )
+    assert response.status_code == 200
+    assert len(response.json["previous_samples"]) == 3
+    cursor = response.json["next_cursor"]
+    response = client.get(
+        "/api/admin/samples",
+        headers=headers,
+        query_string={"page_size": 3, "cursor": cursor},
+    )
+    assert response.status_code == 200
+    assert len(response.json["previous_samples"]) == 1
+    assert response.json["previous_samples"][0]["primary_key"] == "22_46_A1"
+    assert response.json["previous_samples"][0]["email"] == "user@embl.de"
+    assert response.json["next_cursor"] is None
+
+
+def test_admin_search_samples_invalid(client):
+    # no auth header
+    response = client.get("/api/admin/samples/search")
+    assert response.status_code == 401
+    # valid non-admin user auth header
+    headers = _get_auth_headers(client)
+    response = client.get("/api/admin/samples/search", headers=headers)
+    assert response.status_code == 401
+    # invalid query parameters
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    for query in [{"has_results": "maybe"}, {"start_date": "monday"}]:
+        response = client.get(
+            "/api/admin/samples/search", headers=headers, query_string=query
+        )
+        assert response.status_code == 401
+
+
+@freeze_time("2022-11-21")
+def test_admin_search_samples_valid(client, result_zipfiles, ref_seq_genbank):
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    _upload_result(client, result_zipfiles[0])
+    client.post(
+        "/api/sample",
+        data={
+            "name": "abc_pCW",
+            "running_option": "r2",
+            "concentration": 97,
+            "file": (ref_seq_genbank, "test.gbk"),
+        },
+        headers=headers,
+    )
+
+    def search(**kwargs):
+        response = client.get(
+            "/api/admin/samples/search", headers=headers, query_string=kwargs
+        )
+        assert response.status_code == 200
+        return [sample["primary_key"] for sample in response.json["samples"]]
+
+    all_keys = ["22_47_A1", "22_46_A4", "22_46_A3", "22_46_A2", "22_46_A1"]
+    assert search() == all_keys
+    assert search(email="user@embl.de") == all_keys[1:]
+    assert search(email="admin@embl.de") == ["22_47_A1"]
+    assert search(email="unknown@embl.de") == []
+    assert search(running_option="r2") == ["22_47_A1"]
+    assert search(start_date="2022-11-15", end_date="2022-11-16") == [
+        "22_46_A3",
+        "22_46_A2",
+    ]
+    assert search(primary_key="22_46") == all_keys[1:]
+    assert search(primary_key="22_46_A") == all_keys[1:]
+    assert search(primary_key="22_46_A3") == ["22_46_A3"]
+    assert search(primary_key="23") == []
+    assert search(has_results="true") == ["22_46_A2"]
+    assert search(has_results="false") == [
+        "22_47_A1",
+        "22_46_A4",
+        "22_46_A3",
+        "22_46_A1",
+    ]
+    # name or reference sequence description substring, case insensitive
+    assert search(name="pCW") == ["22_47_A1", "22_46_A3"]
+    assert search(name="pcw") == ["22_47_A1", "22_46_A3"]
+    assert search(name="Z78533") == ["22_47_A1"]
+    assert search(name="ZIP_TEST") == ["22_46_A4", "22_46_A3", "22_46_A2"]
+    assert search(name="_p") == ["22_47_A1", "22_46_A4", "22_46_A3", "22_46_A2"]
+    assert search(name='"x') == []
+    assert search(name="%") == []
+    # combined filters
+    assert search(name="ZIP_TEST", has_results="false") == ["22_46_A4", "22_46_A3"]
+    assert search(name="ZIP_TEST", page_size=1) == ["22_46_A4"]
+
+
+def test_admin_metrics_invalid(client):
+    # no auth header
+    response = client.get("/api/admin/metrics")
+    assert response.status_code == 401
+    # valid non-admin user auth header
+    headers = _get_auth_headers(client)
+    response = client.get("/api/admin/metrics", headers=headers)
+    assert response.status_code == 401
+
+
+def test_admin_metrics_valid(client):
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.get("/api/admin/metrics", headers=headers)
+    assert response.status_code == 200
+    password_hashing = response.json["password_hashing"]
+    assert password_hashing["max_workers"] == 4
+    assert password_hashing["completed"] >= 1
+    assert password_hashing["queued"] == 0
+    assert response.json["email_outbox"] == {
+        "queued": 0,
+        "failed": 0,
+        "oldest_queued_age": 0,
+    }
+
+
 def test_admin_token_invalid(client):
     # no auth header
     response = client.get("/api/admin/token")
@@ -468,6 +1318,38 @@ def test_admin_users_valid(client):
     assert "users" in response.json
 
 
+def test_admin_export_invalid(client):
+    # no auth header
+    response = client.get("/api/admin/export/samples")
+    assert response.status_code == 401
+    # valid non-admin user auth header
+    headers = _get_auth_headers(client)
+    response = client.get("/api/admin/export/samples", headers=headers)
+    assert response.status_code == 401
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.get("/api/admin/export/settings", headers=headers)
+    assert response.status_code == 401
+    assert response.json == "Unknown table settings"
+    response = client.get("/api/admin/export/samples?format=csv", headers=headers)
+    assert response.status_code == 401
+    assert response.json == "Unknown export format csv"
+
+
+def test_admin_export_valid(client):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.get("/api/admin/export/samples", headers=headers)
+    assert response.status_code == 200
+    assert "samples.parquet" in response.headers["Content-Disposition"]
+    table = parquet.read_table(io.BytesIO(response.data))
+    assert table.column("primary_key").to_pylist() == [
+        "22_46_A1",
+        "22_46_A2",
+        "22_46_A3",
+        "22_46_A4",
+    ]
+
+
 def test_admin_zipsamples_invalid(client):
     # no auth header
     response = client.post("/api/admin/zipsamples")
@@ -476,6 +1358,54 @@ def test_admin_zipsamples_invalid(client):
     headers = _get_auth_headers(client)
     response = client.post("/api/admin/zipsamples", headers=headers)
     assert response.status_code == 401
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    for json in [
+        {"year": 2022, "week": 60},
+        {"start_date": "2022-11-21"},
+        {"start_date": "2022-11-21", "end_date": "2022-11-20"},
+        # at most 366 days can be exported at once
+        {"start_date": "2020-01-01", "end_date": "2022-11-20"},
+    ]:
+        response = client.post("/api/admin/zipsamples", json=json, headers=headers)
+        assert response.status_code == 401
+        assert "Invalid date range" in response.json
+
+
+def test_admin_zipsamples_date_range(client):
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    # the test samples are in week 46 of 2022
+    for data in [
+        {"year": "2022", "week": "46"},
+        {"start_date": "2022-11-14", "end_date": "2022-11-20"},
+    ]:
+        response = client.post("/api/admin/zipsamples", data=data, headers=headers)
+        assert response.status_code == 200
+        assert (
+            "samples_2022-11-14_2022-11-20.zip"
+            in response.headers["Content-Disposition"]
+        )
+        zip_file = zipfile.ZipFile(io.BytesIO(response.data))
+        assert zip_file.namelist() == ["references/", "samples.tsv"]
+        tsv_lines = zip_file.read("samples.tsv").splitlines()
+        assert [line.split(b"\t")[1] for line in tsv_lines[1:]] == [
+            b"22_46_A1",
+            b"22_46_A2",
+            b"22_46_A3",
+            b"22_46_A4",
+        ]
+    response = client.post(
+        "/api/admin/zipsamples",
+        json={"start_date": "2022-11-14", "end_date": "2022-11-27"},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    zip_file = zipfile.ZipFile(io.BytesIO(response.data))
+    assert zip_file.namelist() == [
+        "2022_46/references/",
+        "2022_46/samples.tsv",
+        "2022_47/references/",
+        "2022_47/samples.tsv",
+    ]
 
 
 @freeze_time("2022-11-21")
@@ -508,10 +1438,531 @@ def test_admin_zipsamples_valid(client, ref_seq_fasta):
         tsv_lines[0] == b"date\tprimary_key\temail\tname\trunning_option\tconcentration"
     )
     assert tsv_lines[1] == b"2022-11-21\t22_47_A1\tadmin@embl.de\tabc\tr Q\t97"
+    # the zip file is not sent again if it has not changed
+    etag = response.headers["ETag"]
+    response = client.post(
+        "/api/admin/zipsamples", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    assert response.data == b""
 
 
 def test_admin_result_valid(client, result_zipfiles):
     for result_zipfile in result_zipfiles:
         response = _upload_result(client, result_zipfile)
-        assert response.status_code == 200
+        assert response.status_code == 202
         assert result_zipfile.name in response.json["message"]
+        job = _wait_for_job(client, response.json["job_id"])
+        assert job["kind"] == "result"
+        assert job["status"] == "done"
+        assert job["filename"] == result_zipfile.name
+        assert job["processed"] == job["total"] == 1
+        assert result_zipfile.name in job["message"]
+        assert job["started"] is not None
+        assert job["finished"] is not None
+
+
+def test_admin_jobs_invalid(client, result_zipfiles):
+    response = _upload_result(client, result_zipfiles[0])
+    job_id = response.json["job_id"]
+    # no auth header
+    response = client.get(f"/api/admin/jobs/{job_id}")
+    assert response.status_code == 401
+    # valid non-admin user auth header
+    headers = _get_auth_headers(client)
+    response = client.get(f"/api/admin/jobs/{job_id}", headers=headers)
+    assert response.status_code == 401
+    # unknown job id
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.get(f"/api/admin/jobs/{job_id + 1}", headers=headers)
+    assert response.status_code == 401
+    assert response.json == "Job not found"
+    # results for an unknown sample are rejected before queuing a job
+    response = client.post(
+        "/api/admin/result",
+        data={"file": (io.BytesIO(b"abc"), "22_46_B7_unknown.zip")},
+        headers=headers,
+    )
+    assert response.status_code == 401
+    assert response.json["message"] == "Unknown primary key 22_46_B7"
+
+
+def test_result_jobs_resumed_on_restart(app, result_zipfiles, tmp_path):
+    # queue a job without running it, and a job that was interrupted
+    with app.app_context():
+        for result_zipfile, status in zip(result_zipfiles, ["queued", "running"]):
+            with open(result_zipfile, "rb") as f:
+                job, code = circuit_seq_server.model.create_result_job(
+                    "result",
+                    FileStorage(f, filename=result_zipfile.name),
+                    str(tmp_path),
+                )
+            assert code == 200
+            job.status = status
+            circuit_seq_server.model.db.session.commit()
+    # creating the app for another process, e.g. the email worker, doesn't
+    # process the jobs
+    circuit_seq_server.create_app(data_path=str(tmp_path))
+    with app.app_context():
+        statuses = circuit_seq_server.model.db.session.execute(
+            circuit_seq_server.model.db.select(
+                circuit_seq_server.model.ResultJob.status
+            ).order_by(circuit_seq_server.model.ResultJob.id)
+        ).scalars()
+        assert list(statuses) == ["queued", "running"]
+    # restarting the server processes both jobs
+    app = circuit_seq_server.create_app(data_path=str(tmp_path), start_workers=True)
+    client = app.test_client()
+    for job_id in [1, 2]:
+        job = _wait_for_job(client, job_id)
+        assert job["status"] == "done"
+    assert not (tmp_path / "jobs" / "1").exists()
+    headers = _get_auth_headers(client)
+    samples = client.get("/api/samples", headers=headers).json["previous_samples"]
+    assert [sample["has_results_zip"] for sample in samples] == [
+        False,
+        True,
+        True,
+        False,
+    ]
+
+
+def _plate_zipfile(result_zipfiles) -> io.BytesIO:
+    plate_zip = io.BytesIO()
+    with zipfile.ZipFile(plate_zip, "w") as zip_file:
+        for result_zipfile in result_zipfiles:
+            zip_file.write(result_zipfile, f"plate/{result_zipfile.name}")
+        zip_file.writestr("22_46_A1_no_ref_seq.fasta", ">A1\nACGT\n")
+        zip_file.writestr("22_46_A1_no_ref_seq.txt", "not a result file")
+        zip_file.writestr("22_46_B7_unknown.zip", b"")
+        zip_file.writestr("readme.txt", "invalid filename")
+    plate_zip.seek(0)
+    return plate_zip
+
+
+def test_admin_plate_result_invalid(client, result_zipfiles):
+    # no auth header
+    response = client.post("/api/admin/plate_result")
+    assert response.status_code == 401
+    # valid non-admin user auth header
+    headers = _get_auth_headers(client)
+    response = client.post(
+        "/api/admin/plate_result",
+        data={"file": (_plate_zipfile(result_zipfiles), "plate.zip")},
+        headers=headers,
+    )
+    assert response.status_code == 401
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    # no file
+    response = client.post("/api/admin/plate_result", headers=headers)
+    assert response.status_code == 401
+    # not a zip file
+    response = client.post(
+        "/api/admin/plate_result",
+        data={"file": (io.BytesIO(b"abc"), "plate.zip")},
+        headers=headers,
+    )
+    assert response.status_code == 401
+    assert "Invalid zip file" in response.json["message"]
+
+
+def test_admin_plate_result_zip_limits(app, client, result_zipfiles):
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    # plate zip file rejected before it is queued
+    app.config["CIRCUITSEQ_ZIP_MAX_MEMBERS"] = 3
+    response = client.post(
+        "/api/admin/plate_result",
+        data={"file": (_plate_zipfile(result_zipfiles), "plate.zip")},
+        headers=headers,
+    )
+    assert response.status_code == 401
+    assert "Rejected zip file plate.zip" in response.json["message"]
+    app.config["CIRCUITSEQ_ZIP_MAX_MEMBERS"] = 1000
+    # the plate zip file is within the size limit, but extracting the result zip
+    # files it contains exceeds it: this is reported for the affected samples
+    with zipfile.ZipFile(_plate_zipfile(result_zipfiles)) as zip_file:
+        app.config["CIRCUITSEQ_ZIP_MAX_UNCOMPRESSED_SIZE"] = sum(
+            zip_info.file_size for zip_info in zip_file.infolist()
+        )
+    response = client.post(
+        "/api/admin/plate_result",
+        data={"file": (_plate_zipfile(result_zipfiles), "plate.zip")},
+        headers=headers,
+    )
+    assert response.status_code == 202
+    job = _wait_for_job(client, response.json["job_id"])
+    assert job["status"] == "done"
+    errors = [sample["error"] for sample in job["report"] if sample["error"]]
+    assert any("bytes extracted" in error for error in errors)
+
+
+def test_admin_plate_result_valid(client, result_zipfiles):
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.post(
+        "/api/admin/plate_result",
+        data={"file": (_plate_zipfile(result_zipfiles), "plate.zip")},
+        headers=headers,
+    )
+    assert response.status_code == 202
+    job = _wait_for_job(client, response.json["job_id"])
+    assert job["kind"] == "plate_result"
+    assert job["status"] == "done"
+    # progress is reported for each known sample
+    assert job["processed"] == job["total"] == 4
+    report = {sample["primary_key"]: sample for sample in job["report"]}
+    assert report[None] == {
+        "primary_key": None,
+        "files": [],
+        "ignored": ["readme.txt"],
+        "error": "Invalid filename readme.txt",
+    }
+    assert report["22_46_B7"]["error"] == "Unknown primary key 22_46_B7"
+    assert report["22_46_A1"] == {
+        "primary_key": "22_46_A1",
+        "files": ["22_46_A1_no_ref_seq.fasta"],
+        "ignored": ["22_46_A1_no_ref_seq.txt"],
+        "error": None,
+    }
+    for result_zipfile in result_zipfiles:
+        key = result_zipfile.name[:8]
+        basename = result_zipfile.stem
+        assert report[key] == {
+            "primary_key": key,
+            "files": [f"{basename}.fasta", f"{basename}.gbk", f"{basename}.zip"],
+            "ignored": [],
+            "error": None,
+        }
+    # result flags updated and result emails queued for each sample
+    headers = _get_auth_headers(client)
+    samples = client.get("/api/samples", headers=headers).json["previous_samples"]
+    assert len(samples) == 4
+    for sample in samples:
+        assert sample["has_results_fasta"] is True
+        assert sample["has_results_gbk"] is (sample["primary_key"] != "22_46_A1")
+        assert sample["has_results_zip"] is (sample["primary_key"] != "22_46_A1")
+    with client.application.app_context():
+        assert EmailWorker().send_queued_emails() == 4
+    for filetype in ["fasta", "gbk"]:
+        response = client.post(
+            "/api/result",
+            json={"primary_key": "22_46_A3", "filetype": filetype},
+            headers=headers,
+        )
+        assert response.status_code == 200
+        with zipfile.ZipFile(result_zipfiles[1]) as zip_file:
+            assert response.data == zip_file.read(
+                f"{result_zipfiles[1].stem}/{result_zipfiles[1].stem}.{filetype}"
+            )
+
+
+def _create_upload(client, headers, data: bytes, filename: str, **kwargs):
+    return client.post(
+        "/api/uploads",
+        json={"filename": filename, "length": len(data), **kwargs},
+        headers=headers,
+    )
+
+
+def _upload_chunk(client, headers, upload_id: str, offset: int, chunk: bytes, **kwargs):
+    checksum = base64.b64encode(hashlib.sha256(chunk).digest()).decode()
+    return client.patch(
+        f"/api/uploads/{upload_id}",
+        data=chunk,
+        headers={
+            "Upload-Offset": str(offset),
+            "Upload-Checksum": f"sha256 {checksum}",
+            "Content-Type": "application/offset+octet-stream",
+            **headers,
+            **kwargs,
+        },
+    )
+
+
+def test_uploads_invalid(client):
+    data = b"0123456789"
+    # no auth header
+    response = client.post("/api/uploads", json={"filename": "a.zip", "length": 10})
+    assert response.status_code == 401
+    headers = _get_auth_headers(client)
+    for length in [0, -1, 1024 * 1024 * 1024, "abc"]:
+        response = client.post(
+            "/api/uploads",
+            json={"filename": "a.zip", "length": length},
+            headers=headers,
+        )
+        assert response.status_code == 401
+    response = _create_upload(client, headers, data, "..")
+    assert response.status_code == 401
+    response = _create_upload(client, headers, data, "a.zip")
+    assert response.status_code == 201
+    upload_id = response.json["upload_id"]
+    assert response.headers["Location"] == f"/api/uploads/{upload_id}"
+    # uploads are only visible to the user that created them
+    admin_headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = client.get(f"/api/uploads/{upload_id}", headers=admin_headers)
+    assert response.status_code == 401
+    response = _upload_chunk(client, admin_headers, upload_id, 0, data)
+    assert response.status_code == 401
+    response = client.get("/api/uploads/unknown", headers=headers)
+    assert response.status_code == 401
+    # missing or invalid headers
+    response = client.patch(f"/api/uploads/{upload_id}", data=data, headers=headers)
+    assert response.status_code == 401
+    response = _upload_chunk(
+        client, headers, upload_id, 0, data, **{"Upload-Checksum": "md5 abc"}
+    )
+    assert response.status_code == 401
+    # wrong offset
+    response = _upload_chunk(client, headers, upload_id, 5, data[5:])
+    assert response.status_code == 409
+    assert response.headers["Upload-Offset"] == "0"
+    # wrong chunk checksum
+    response = _upload_chunk(
+        client,
+        headers,
+        upload_id,
+        0,
+        data,
+        **{"Upload-Checksum": f"sha256 {base64.b64encode(b'abc').decode()}"},
+    )
+    assert response.status_code == 401
+    assert response.json["message"] == "Chunk checksum mismatch"
+    assert response.headers["Upload-Offset"] == "0"
+    # chunk too long
+    response = _upload_chunk(client, headers, upload_id, 0, data + b"0")
+    assert response.status_code == 401
+    assert (
+        response.json["message"] == "Chunk is larger than the remaining upload length"
+    )
+    assert response.headers["Upload-Offset"] == "0"
+    # incomplete upload can't be used
+    assert _upload_chunk(client, headers, upload_id, 0, data[:5]).status_code == 204
+    response = client.post(
+        "/api/sample",
+        data={"name": "abc", "running_option": "run1", "upload_id": upload_id},
+        headers=headers,
+    )
+    assert response.status_code == 401
+    assert response.json["message"] == "Upload is not complete"
+    # file checksum mismatch: upload starts again from the beginning
+    response = _create_upload(
+        client, headers, data, "a.zip", sha256=hashlib.sha256(b"abc").hexdigest()
+    )
+    upload_id = response.json["upload_id"]
+    response = _upload_chunk(client, headers, upload_id, 0, data)
+    assert response.status_code == 401
+    assert response.json["message"] == "Upload checksum mismatch"
+    assert response.headers["Upload-Offset"] == "0"
+
+
+class _BlockingStream(io.BytesIO):
+    """Waits for `release` before returning any data after the first `n` bytes"""
+
+    def __init__(self, data: bytes, n: int):
+        super().__init__(data)
+        self.n = n
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def read(self, size=-1):
+        if self.tell() >= self.n:
+            self.started.set()
+            self.release.wait()
+        elif size is None or size < 0 or self.tell() + size > self.n:
+            size = self.n - self.tell()
+        return super().read(size)
+
+
+def test_uploads_concurrent_chunks(client):
+    headers = _get_auth_headers(client)
+    data = b"A" * 8
+    upload_id = _create_upload(client, headers, data, "data.txt").json["upload_id"]
+    stream = _BlockingStream(data, 4)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(
+            client.patch,
+            f"/api/uploads/{upload_id}",
+            input_stream=stream,
+            headers={
+                "Upload-Offset": "0",
+                "Content-Type": "application/offset+octet-stream",
+                **headers,
+            },
+        )
+        try:
+            assert stream.started.wait(timeout=10)
+            # another chunk for the same offset while the first is being written
+            response = client.patch(
+                f"/api/uploads/{upload_id}",
+                data=b"B" * 8,
+                headers={
+                    "Upload-Offset": "0",
+                    "Content-Type": "application/offset+octet-stream",
+                    **headers,
+                },
+            )
+        finally:
+            stream.release.set()
+        assert future.result().status_code == 204
+    assert response.status_code == 409
+    assert response.json["message"] == "Upload is being written by another request"
+    response = client.get(f"/api/uploads/{upload_id}", headers=headers)
+    assert response.json["offset"] == len(data)
+    assert response.json["sha256"] == hashlib.sha256(data).hexdigest()
+    # the rejected chunk was not written to the file
+    with client.application.app_context():
+        upload, upload_file, _ = circuit_seq_server.model.get_completed_upload_file(
+            upload_id, "user@embl.de", client.application.config["CIRCUITSEQ_DATA_PATH"]
+        )
+        assert upload_file.read_bytes() == data
+
+
+def test_uploads_limits(client):
+    headers = _get_auth_headers(client)
+    data_path = pathlib.Path(client.application.config.get("CIRCUITSEQ_DATA_PATH"))
+    client.application.config["CIRCUITSEQ_MAX_OPEN_UPLOAD_BYTES"] = 100
+    # total size of open uploads is limited
+    response = _create_upload(client, headers, b"0" * 101, "a.zip")
+    assert response.status_code == 401
+    assert "maximum of 100 bytes" in response.json["message"]
+    # number of open uploads is limited
+    upload_ids = []
+    for _ in range(4):
+        response = _create_upload(client, headers, b"0" * 10, "a.zip")
+        assert response.status_code == 201
+        upload_ids.append(response.json["upload_id"])
+    response = _create_upload(client, headers, b"0" * 10, "a.zip")
+    assert response.status_code == 401
+    assert "Too many open uploads" in response.json["message"]
+    # other users are not affected
+    admin_headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    response = _create_upload(client, admin_headers, b"0" * 10, "a.zip")
+    assert response.status_code == 201
+    # expired uploads are deleted without waiting for a new upload
+    with freeze_time(datetime.datetime.now() + datetime.timedelta(days=8)):
+        with client.application.app_context():
+            assert circuit_seq_server.model.delete_expired_uploads(str(data_path)) == 5
+    for upload_id in upload_ids:
+        assert not (data_path / "uploads" / upload_id).exists()
+    response = _create_upload(client, headers, b"0" * 10, "a.zip")
+    assert response.status_code == 201
+
+
+def test_uploads_rejected_result_kept(client, result_zipfiles):
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    data = result_zipfiles[0].read_bytes()
+    response = _create_upload(client, headers, data, "22_46_B7_unknown.zip")
+    upload_id = response.json["upload_id"]
+    assert _upload_chunk(client, headers, upload_id, 0, data).status_code == 204
+    response = client.post(
+        "/api/admin/result", json={"upload_id": upload_id}, headers=headers
+    )
+    assert response.status_code == 401
+    assert response.json["message"] == "Unknown primary key 22_46_B7"
+    # the upload is kept, so it can be submitted again once the sample exists
+    response = client.get(f"/api/uploads/{upload_id}", headers=headers)
+    assert response.status_code == 200
+    assert response.json["offset"] == len(data)
+
+
+def test_uploads_resumable_result(client, result_zipfiles):
+    headers = _get_auth_headers(client, "admin@embl.de", "admin")
+    data = result_zipfiles[1].read_bytes()
+    response = _create_upload(
+        client,
+        headers,
+        data,
+        result_zipfiles[1].name,
+        sha256=hashlib.sha256(data).hexdigest(),
+    )
+    assert response.status_code == 201
+    assert response.json["offset"] == 0
+    upload_id = response.json["upload_id"]
+    chunk_size = len(data) // 3 + 1
+    # first chunk
+    response = _upload_chunk(client, headers, upload_id, 0, data[:chunk_size])
+    assert response.status_code == 204
+    assert response.headers["Upload-Offset"] == str(chunk_size)
+    # second chunk is corrupted in transit
+    corrupted_chunk = b"x" + data[chunk_size + 1 : 2 * chunk_size]
+    response = _upload_chunk(
+        client,
+        headers,
+        upload_id,
+        chunk_size,
+        corrupted_chunk,
+        **{
+            "Upload-Checksum": "sha256 "
+            + base64.b64encode(
+                hashlib.sha256(data[chunk_size : 2 * chunk_size]).digest()
+            ).decode()
+        },
+    )
+    assert response.status_code == 401
+    # client gets the current offset and resumes
+    response = client.head(f"/api/uploads/{upload_id}", headers=headers)
+    assert response.status_code == 200
+    offset = int(response.headers["Upload-Offset"])
+    assert offset == chunk_size
+    assert response.headers["Upload-Length"] == str(len(data))
+    # server restart: in-progress hash is recomputed from the file
+    circuit_seq_server.model._upload_hashes.clear()
+    while offset < len(data):
+        response = _upload_chunk(
+            client, headers, upload_id, offset, data[offset : offset + chunk_size]
+        )
+        assert response.status_code == 204
+        offset = int(response.headers["Upload-Offset"])
+    response = client.get(f"/api/uploads/{upload_id}", headers=headers)
+    assert response.json["offset"] == len(data)
+    assert response.json["sha256"] == hashlib.sha256(data).hexdigest()
+    # upload can't be written to once complete
+    response = _upload_chunk(client, headers, upload_id, len(data), b"0")
+    assert response.status_code == 401
+    # use completed upload as result zipfile
+    response = client.post(
+        "/api/admin/result", json={"upload_id": upload_id}, headers=headers
+    )
+    assert response.status_code == 202
+    job = _wait_for_job(client, response.json["job_id"])
+    assert job["status"] == "done"
+    assert job["filename"] == result_zipfiles[1].name
+    data_path = pathlib.Path(client.application.config.get("CIRCUITSEQ_DATA_PATH"))
+    assert (
+        data_path / "2022/46/results" / result_zipfiles[1].name
+    ).read_bytes() == data
+    # upload has been used
+    response = client.get(f"/api/uploads/{upload_id}", headers=headers)
+    assert response.status_code == 401
+    assert not (data_path / "uploads" / upload_id).exists()
+
+
+@freeze_time("2022-11-21")
+def test_uploads_resumable_sample(client, ref_seq_genbank):
+    headers = _get_auth_headers(client)
+    data = ref_seq_genbank.read()
+    response = _create_upload(client, headers, data, "test.gbk")
+    upload_id = response.json["upload_id"]
+    for offset in range(0, len(data), 1000):
+        response = _upload_chunk(
+            client, headers, upload_id, offset, data[offset : offset + 1000]
+        )
+        assert response.status_code == 204
+    response = client.post(
+        "/api/sample",
+        data={
+            "name": "abc",
+            "running_option": "run1",
+            "concentration": 177,
+            "upload_id": upload_id,
+        },
+        headers=headers,
+    )
+    assert response.status_code == 200
+    new_sample = response.json["sample"]
+    assert new_sample["primary_key"] == "22_47_A1"
+    assert new_sample["reference_sequence_description"] == "Z78533.1"
+    data_path = pathlib.Path(client.application.config.get("CIRCUITSEQ_DATA_PATH"))
+    fasta_path = data_path / "2022/47/inputs/references/22_47_A1_abc.fasta"
+    assert fasta_path.is_file()
+    assert not (data_path / "uploads" / upload_id).exists()
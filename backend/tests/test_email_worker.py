@@ -0,0 +1,153 @@
+from __future__ import annotations
+from typing import List
+import datetime
+import socket
+from email.message import EmailMessage
+import pytest
+from aiosmtpd.controller import Controller
+import circuit_seq_server.model as model
+from circuit_seq_server import create_app
+from circuit_seq_server.email_worker import EmailWorker
+
+
+class _Handler:
+    def __init__(self):
+        self.messages: List[bytes] = []
+        self.sessions = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope.content)
+        self.sessions.add(id(session))
+        return "250 OK"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture()
+def smtp_server():
+    handler = _Handler()
+    controller = Controller(handler, hostname="127.0.0.1", port=_free_port())
+    controller.start()
+    yield controller
+    controller.stop()
+
+
+@pytest.fixture()
+def worker_app(monkeypatch, tmp_path):
+    # unlike the `app` fixture, smtplib is not monkeypatched
+    monkeypatch.setenv("JWT_SECRET_KEY", "abcdefghijklmnopqrstuvwxyz")
+    return create_app(data_path=str(tmp_path))
+
+
+def _enqueue_emails(n: int) -> None:
+    for i in range(n):
+        msg = EmailMessage()
+        msg.set_content(f"message {i}")
+        msg["Subject"] = f"subject {i}"
+        msg["From"] = "no-reply@circuitseq.iwr.uni-heidelberg.de"
+        msg["To"] = f"user{i}@embl.de"
+        model.enqueue_email(msg)
+    model.db.session.commit()
+
+
+def test_email_worker_sends_queued_emails(worker_app, smtp_server):
+    with worker_app.app_context():
+        worker = EmailWorker(smtp_host=f"127.0.0.1:{smtp_server.port}")
+        assert worker.send_queued_emails() == 0
+        _enqueue_emails(5)
+        assert model.get_outbox_stats()["queued"] == 5
+        assert worker.send_queued_emails() == 5
+        assert model.get_outbox_stats()["queued"] == 0
+        assert (
+            model.db.session.execute(
+                model.db.select(model.db.func.count(model.OutgoingEmail.id))
+            ).scalar_one()
+            == 0
+        )
+        messages = smtp_server.handler.messages
+        assert len(messages) == 5
+        assert b"Subject: subject 3" in messages[3]
+        assert b"message 3" in messages[3]
+        # a single connection was used for all emails
+        assert len(smtp_server.handler.sessions) == 1
+        # which is kept open for the next emails
+        _enqueue_emails(2)
+        assert worker.send_queued_emails() == 2
+        assert len(smtp_server.handler.sessions) == 1
+        # until it has been idle for too long
+        worker.idle_timeout = 0
+        worker.close_if_idle()
+        _enqueue_emails(1)
+        assert worker.send_queued_emails() == 1
+        assert len(smtp_server.handler.sessions) == 2
+        worker.close()
+
+
+def test_email_worker_reconnects(worker_app):
+    handler = _Handler()
+    port = _free_port()
+    with worker_app.app_context():
+        worker = EmailWorker(smtp_host=f"127.0.0.1:{port}")
+        controller = Controller(handler, hostname="127.0.0.1", port=port)
+        controller.start()
+        _enqueue_emails(1)
+        assert worker.send_queued_emails() == 1
+        # server is restarted, closing the connection
+        controller.stop()
+        controller = Controller(handler, hostname="127.0.0.1", port=port)
+        controller.start()
+        _enqueue_emails(1)
+        assert worker.send_queued_emails() == 1
+        assert len(handler.messages) == 2
+        assert len(handler.sessions) == 2
+        worker.close()
+        controller.stop()
+
+
+def test_email_worker_retry(worker_app):
+    with worker_app.app_context():
+        # no smtp server running on this port
+        worker = EmailWorker(
+            smtp_host=f"127.0.0.1:{_free_port()}", retry_delay=10, max_attempts=3
+        )
+        _enqueue_emails(2)
+        start_time = datetime.datetime.now()
+        assert worker.send_queued_emails() == 0
+        outgoing_email = model.db.session.get(model.OutgoingEmail, 1)
+        assert outgoing_email.attempts == 1
+        assert outgoing_email.last_error
+        assert outgoing_email.next_attempt >= start_time + datetime.timedelta(
+            seconds=10
+        )
+        # worker stops at the first failure
+        assert model.db.session.get(model.OutgoingEmail, 2).attempts == 0
+        # email isn't retried until the retry delay has passed
+        assert worker.send_queued_emails() == 0
+        assert model.db.session.get(model.OutgoingEmail, 1).attempts == 1
+        # retry delay doubles with each failed attempt
+        for attempts, delay in [(2, 20), (3, None)]:
+            outgoing_email.next_attempt = datetime.datetime.now()
+            model.db.session.execute(
+                model.db.update(model.OutgoingEmail)
+                .where(model.OutgoingEmail.id == 2)
+                .values(next_attempt=datetime.datetime.now() + datetime.timedelta(1))
+            )
+            model.db.session.commit()
+            start_time = datetime.datetime.now()
+            assert worker.send_queued_emails() == 0
+            assert outgoing_email.attempts == attempts
+            if delay is None:
+                # gave up after max_attempts
+                assert outgoing_email.next_attempt is None
+            else:
+                assert outgoing_email.next_attempt >= start_time + datetime.timedelta(
+                    seconds=delay
+                )
+        stats = model.get_outbox_stats()
+        assert stats["queued"] == 1
+        assert stats["failed"] == 1
+        assert stats["oldest_queued_age"] > 0
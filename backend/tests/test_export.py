@@ -0,0 +1,91 @@
+from __future__ import annotations
+import datetime
+import io
+import pytest
+from click.testing import CliRunner
+import circuit_seq_server.model as model
+from circuit_seq_server.export import write_export, ExportError
+from circuit_seq_server.main import main
+
+pa = pytest.importorskip("pyarrow")
+import pyarrow.feather
+import pyarrow.parquet
+
+
+def test_write_export_invalid(app):
+    with app.app_context():
+        with pytest.raises(ExportError, match="Unknown table"):
+            write_export("settings", "parquet", io.BytesIO())
+        with pytest.raises(ExportError, match="Unknown export format"):
+            write_export("samples", "csv", io.BytesIO())
+
+
+@pytest.mark.parametrize("export_format", ["parquet", "feather"])
+def test_write_export_samples(app, tmp_path, export_format):
+    output = tmp_path / f"samples.{export_format}"
+    with app.app_context():
+        # one record batch per row
+        assert write_export("samples", export_format, output, batch_size=1) == 4
+        samples = (
+            model.db.session.execute(model.db.select(model.Sample).order_by("id"))
+            .scalars()
+            .all()
+        )
+    if export_format == "parquet":
+        parquet_file = pyarrow.parquet.ParquetFile(output)
+        assert parquet_file.num_row_groups == 4
+        table = parquet_file.read()
+    else:
+        table = pyarrow.feather.read_table(output)
+    assert table.column_names == [
+        "id",
+        "primary_key",
+        "date",
+        "email",
+        "name",
+        "running_option",
+        "concentration",
+        "reference_sequence_description",
+        "has_results_fasta",
+        "has_results_gbk",
+        "has_results_zip",
+    ]
+    assert table.schema.field("date").type == pa.date32()
+    assert table.schema.field("reference_sequence_description").nullable
+    assert table.to_pylist() == [
+        {column: getattr(sample, column) for column in table.column_names}
+        for sample in samples
+    ]
+    assert table.column("date").to_pylist()[0] == datetime.date(2022, 11, 14)
+
+
+def test_write_export_users(app):
+    output = io.BytesIO()
+    with app.app_context():
+        assert write_export("users", "parquet", output) == 2
+    output.seek(0)
+    table = pyarrow.parquet.read_table(output)
+    # password hashes are not exported
+    assert table.to_pylist() == [
+        {"id": 1, "email": "admin@embl.de", "activated": True, "is_admin": True},
+        {"id": 2, "email": "user@embl.de", "activated": True, "is_admin": False},
+    ]
+
+
+def test_export_command(app, tmp_path):
+    output = tmp_path / "export.feather"
+    result = CliRunner().invoke(
+        main,
+        [
+            "export",
+            "--data-path",
+            app.config["CIRCUITSEQ_DATA_PATH"],
+            "--format",
+            "feather",
+            "--output",
+            str(output),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Exported 4 samples" in result.output
+    assert pyarrow.feather.read_table(output).num_rows == 4
@@ -1,9 +1,21 @@
 from __future__ import annotations
+from typing import List, Optional, Tuple
 import circuit_seq_server.model as model
+from circuit_seq_server import create_app
+from circuit_seq_server.email_worker import EmailWorker
 import datetime
+import gzip
+import io
+import multiprocessing
+import os
+import threading
 import pathlib
+import time
+import zipfile
+import pytest
 from freezegun import freeze_time
 from werkzeug.datastructures import FileStorage
+import flask_test_utils as ftu
 
 
 def _count_settings() -> int:
@@ -55,6 +67,37 @@ def test_settings(app, tmp_path):
         assert new_settings["last_submission_day"] == 5
 
 
+def test_settings_cache(app):
+    with app.app_context():
+        settings = model.get_current_settings()
+        settings_id = model.get_current_settings_id()
+        # modifying the returned dict doesn't modify the cached settings
+        settings["plate_n_rows"] = 3
+        assert model.get_current_settings()["plate_n_rows"] == 8
+        # cached settings are used if settings are unchanged
+        cache_key = str(model.db.engine.url)
+        assert model._settings_cache[cache_key][0] == settings_id
+        # settings added to the db by another worker are picked up
+        model.db.session.add(
+            model.Settings(
+                datetime=datetime.datetime.today(),
+                email="other_worker",
+                settings_dict={"plate_n_rows": 5},
+            )
+        )
+        model.db.session.commit()
+        new_settings = model.get_current_settings()
+        assert new_settings["plate_n_rows"] == 5
+        # missing keys use default values
+        assert new_settings["plate_n_cols"] == 12
+        assert model._settings_cache[cache_key][0] == settings_id + 1
+        # setting new settings invalidates the cache
+        new_settings["plate_n_cols"] = 4
+        model.set_current_settings("a@embl.de", new_settings)
+        assert cache_key not in model._settings_cache
+        assert model.get_current_settings()["plate_n_cols"] == 4
+
+
 @freeze_time("2022-11-21")
 def test_add_new_sample_mon(app, tmp_path):
     with app.app_context():
@@ -155,10 +198,471 @@ def test_add_new_sample_full(app, tmp_path):
         assert "samples have been taken this week" in error_message
 
 
+_stress_test_app = None
+
+
+def _init_stress_test_worker(data_path: str):
+    global _stress_test_app
+    _stress_test_app = create_app(data_path=data_path)
+
+
+def _submit_stress_test_sample(n: int) -> Tuple[Optional[str], str, float]:
+    with _stress_test_app.app_context():
+        start_time = time.perf_counter()
+        new_sample, error_message = model.add_new_sample(
+            f"u{n}@embl.de",
+            f"s{n}",
+            "running option",
+            200,
+            None,
+            _stress_test_app.config["CIRCUITSEQ_DATA_PATH"],
+        )
+        duration = time.perf_counter() - start_time
+        if new_sample is None:
+            return None, error_message, duration
+        return new_sample.primary_key, error_message, duration
+
+
+def _percentile(timings: List[float], p: float) -> float:
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(p / 100 * len(timings)))]
+
+
+@freeze_time("2022-11-21 08:00:00", tick=True)
+def test_add_new_sample_concurrent(app):
+    n_processes = 8
+    n_submissions = 400
+    with app.app_context():
+        settings = model.get_current_settings()
+    n_max = settings["plate_n_rows"] * settings["plate_n_cols"]
+    with multiprocessing.get_context("fork").Pool(
+        n_processes,
+        initializer=_init_stress_test_worker,
+        initargs=(app.config["CIRCUITSEQ_DATA_PATH"],),
+    ) as pool:
+        results = pool.map(_submit_stress_test_sample, range(n_submissions))
+    keys = [key for key, error_message, duration in results if key is not None]
+    # each well on the plate was allocated exactly once
+    assert len(keys) == n_max
+    assert len(set(keys)) == n_max
+    assert set(keys) == {
+        f"22_47_{row}{col}" for row in "ABCDEFGH" for col in range(1, 13)
+    }
+    # all remaining submissions were rejected without error
+    for key, error_message, duration in results:
+        if key is None:
+            assert "samples" in error_message
+    # no submission was stuck waiting for the database lock
+    durations = [duration for key, error_message, duration in results]
+    assert _percentile(durations, 99) < 5.0
+    # latency doesn't grow with the number of samples already submitted
+    n_quarter = n_submissions // 4
+    early_p50 = _percentile(durations[:n_quarter], 50)
+    late_p50 = _percentile(durations[-n_quarter:], 50)
+    assert late_p50 < 2 * early_p50 + 0.05
+    with app.app_context():
+        assert model._count_samples_this_week(datetime.date.today()) == n_max
+        assert model.remaining_samples_this_week()["remaining"] == 0
+
+
 def _count_users() -> int:
     return len(model.db.session.execute(model.db.select(model.User)).scalars().all())
 
 
+def test_get_samples_version(app):
+    with app.app_context():
+        max_id = model.get_max_sample_id()
+        assert max_id > 0
+        assert model.get_samples_version() == (max_id, 0, 0, 0, 0)
+        # the max id is found from the primary key index, without a table scan
+        query_plan = model.db.session.execute(
+            model.db.text(
+                "EXPLAIN QUERY PLAN SELECT coalesce(max(sample.id), 0) FROM sample"
+            )
+        ).all()
+        assert all("SCAN" not in row[-1] for row in query_plan)
+        samples = model.db.session.execute(model.db.select(model.Sample)).scalars()
+        sample = next(samples)
+        sample.has_results_fasta = True
+        model.db.session.commit()
+        fasta_version = model.get_samples_version(sample.email)
+        # swapping which results are available changes the version
+        sample.has_results_fasta = False
+        sample.has_results_gbk = True
+        model.db.session.commit()
+        gbk_version = model.get_samples_version(sample.email)
+        assert gbk_version != fasta_version
+        assert gbk_version == (max_id, 0, 1, 0, 0)
+        assert model.get_samples_version("nobody@embl.de") == (0, 0, 0, 0, 0)
+
+
+@freeze_time("2022-11-21")
+def test_stream_samples_zipfile(app, tmp_path):
+    def add_sample(name: str):
+        fasta_file = tmp_path / f"{name}.fasta"
+        fasta_file.write_text(f">{name}\n{'ACGT' * 100}\n")
+        with fasta_file.open("rb") as f:
+            new_sample, error_message = model.add_new_sample(
+                "u1@embl.de", name, "r", 1, FileStorage(f, fasta_file.name), data_path
+            )
+        assert error_message == ""
+
+    with app.app_context():
+        data_path = str(tmp_path)
+        this_week = (datetime.date(2022, 11, 21), datetime.date(2022, 11, 27))
+        references_path = tmp_path / "2022/47/inputs/references"
+        add_sample("s1")
+        add_sample("s2")
+        fingerprint, zip_stream = model.stream_samples_zipfile(data_path, *this_week)
+        chunks = list(zip_stream)
+        assert len(chunks) > 3
+        with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as zip_file:
+            assert zip_file.testzip() is None
+            zip_infos = zip_file.infolist()
+            assert [zip_info.filename for zip_info in zip_infos] == [
+                "references/",
+                "references/22_47_A1_s1.fasta",
+                "references/22_47_A2_s2.fasta",
+                "samples.tsv",
+            ]
+            # references are stored uncompressed
+            assert zip_infos[1].compress_type == zipfile.ZIP_STORED
+            assert zip_infos[3].compress_type == zipfile.ZIP_DEFLATED
+            assert (
+                zip_file.read("references/22_47_A2_s2.fasta")
+                == (references_path / "22_47_A2_s2.fasta").read_bytes()
+            )
+            assert len(zip_file.read("samples.tsv").splitlines()) == 3
+        # no zip file is written to disk
+        assert not (tmp_path / "2022/47/samples.zip").exists()
+        # fingerprint only changes if the samples or references change
+        assert model.stream_samples_zipfile(data_path, *this_week)[0] == fingerprint
+        add_sample("s3")
+        new_fingerprint = model.stream_samples_zipfile(data_path, *this_week)[0]
+        assert new_fingerprint != fingerprint
+        # the number of reference sequences changes
+        sample = model.db.session.execute(
+            model.db.select(model.Sample).filter_by(name="s3")
+        ).scalar_one()
+        sample.reference_sequence_description = None
+        model.db.session.commit()
+        assert model.stream_samples_zipfile(data_path, *this_week)[0] not in [
+            fingerprint,
+            new_fingerprint,
+        ]
+
+
+def test_stream_samples_zipfile_weeks(app, tmp_path, monkeypatch):
+    with app.app_context():
+        data_path = str(tmp_path)
+        for date, name in [
+            ("2022-11-21", "a"),
+            ("2022-11-23", "b"),
+            ("2022-11-28", "c"),
+            ("2022-12-14", "d"),
+        ]:
+            with freeze_time(date):
+                new_sample, error_message = model.add_new_sample(
+                    "u1@embl.de",
+                    name,
+                    "r",
+                    1,
+                    FileStorage(io.BytesIO(f">{name}\nACGT\n".encode()), "ref.fasta"),
+                    data_path,
+                )
+                assert error_message == ""
+        fingerprint, zip_stream = model.stream_samples_zipfile(
+            data_path, datetime.date(2022, 11, 22), datetime.date(2022, 12, 14)
+        )
+        with zipfile.ZipFile(io.BytesIO(b"".join(zip_stream))) as zip_file:
+            assert zip_file.namelist() == [
+                "2022_47/references/",
+                "2022_47/references/22_47_A2_b.fasta",
+                "2022_47/samples.tsv",
+                "2022_48/references/",
+                "2022_48/references/22_48_A1_c.fasta",
+                "2022_48/samples.tsv",
+                "2022_49/references/",
+                "2022_49/samples.tsv",
+                "2022_50/references/",
+                "2022_50/references/22_50_A1_d.fasta",
+                "2022_50/samples.tsv",
+            ]
+            assert zip_file.read("2022_47/samples.tsv").splitlines()[1:] == [
+                b"2022-11-23\t22_47_A2\tu1@embl.de\tb\tr\t1"
+            ]
+            assert len(zip_file.read("2022_49/samples.tsv").splitlines()) == 1
+        # the next week is read from the database while the current week is sent,
+        # the week after that only once the current week has been sent
+        export_week = model._export_week
+        started_weeks = []
+        week_48_started = threading.Event()
+
+        def recorded_export_week(app, data_path, start_date, end_date):
+            started_weeks.append(start_date.isocalendar()[1])
+            if start_date.isocalendar()[1] == 48:
+                week_48_started.set()
+            return export_week(app, data_path, start_date, end_date)
+
+        monkeypatch.setattr(model, "_export_week", recorded_export_week)
+        fingerprint, zip_stream = model.stream_samples_zipfile(
+            data_path, datetime.date(2022, 11, 21), datetime.date(2022, 12, 11)
+        )
+        first_chunk = next(zip_stream)
+        assert week_48_started.wait(timeout=10)
+        assert sorted(started_weeks) == [47, 48]
+        with freeze_time("2022-12-06"):
+            new_sample, error_message = model.add_new_sample(
+                "u1@embl.de", "e", "r", 1, None, data_path
+            )
+        zip_data = first_chunk + b"".join(zip_stream)
+        assert sorted(started_weeks) == [47, 48, 49]
+        with zipfile.ZipFile(io.BytesIO(zip_data)) as zip_file:
+            assert zip_file.read("2022_49/samples.tsv").splitlines()[1:] == [
+                b"2022-12-06\t22_49_A1\tu1@embl.de\te\tr\t1",
+            ]
+
+
+def _wait_for_reference_parse(sample_id: int, timeout: float = 60) -> model.Sample:
+    start_time = time.monotonic()
+    while time.monotonic() - start_time < timeout:
+        model.db.session.expire_all()
+        sample = model.db.session.get(model.Sample, sample_id)
+        if sample.reference_sequence_status != "pending":
+            return sample
+        time.sleep(0.1)
+    raise TimeoutError(f"Reference sequence of sample {sample_id} still pending")
+
+
+@freeze_time("2022-11-21")
+def test_add_new_sample_reference_pending(
+    app, tmp_path, ref_seq_fasta, held_reference_parses
+):
+    ref_dir = tmp_path / "2022/47/inputs/references"
+    with app.app_context():
+        new_sample, error_message = model.add_new_sample(
+            "u1@embl.de",
+            "s1",
+            "running option",
+            234,
+            FileStorage(ref_seq_fasta, "test.fa"),
+            str(tmp_path),
+        )
+        # sample is added immediately with a pending reference sequence
+        assert error_message == ""
+        assert new_sample.primary_key == "22_47_A1"
+        assert new_sample.reference_sequence_status == "pending"
+        assert new_sample.reference_sequence_description is None
+        assert model.get_samples_version("u1@embl.de") == (new_sample.id, 0, 0, 0, 1)
+        assert not (ref_dir / "22_47_A1_s1.fasta").exists()
+        ftu.release_reference_parses(held_reference_parses)
+        sample = _wait_for_reference_parse(new_sample.id)
+        assert sample.reference_sequence_status is None
+        assert sample.reference_sequence_description == "seq0"
+        assert model.get_samples_version("u1@embl.de") == (new_sample.id, 0, 0, 0, 0)
+        assert (
+            model.db.session.execute(model.db.select(model.ReferenceParseJob)).all()
+            == []
+        )
+    fasta_path = ref_dir / "22_47_A1_s1.fasta"
+    assert "seq0" in fasta_path.read_text()
+    gzip_fasta_path = ref_dir / "22_47_A1_s1.fasta.gz"
+    assert gzip.decompress(gzip_fasta_path.read_bytes()) == fasta_path.read_bytes()
+    assert list((tmp_path / "reference_parsing").iterdir()) == []
+
+
+@freeze_time("2022-11-21")
+def test_add_new_sample_reference_pending_failed(app, tmp_path, held_reference_parses):
+    with app.app_context():
+        new_sample, error_message = model.add_new_sample(
+            "u1@embl.de",
+            "s1",
+            "running option",
+            234,
+            FileStorage(io.BytesIO(b"invalid_fasta_contents"), "test.fa"),
+            str(tmp_path),
+        )
+        assert error_message == ""
+        assert new_sample.reference_sequence_status == "pending"
+        # the sample is kept but the reference sequence is marked as failed
+        ftu.release_reference_parses(held_reference_parses)
+        sample = _wait_for_reference_parse(new_sample.id)
+        assert sample.reference_sequence_status == "failed"
+        assert sample.reference_sequence_description is None
+    assert not (tmp_path / "2022/47/inputs/references/22_47_A1_s1.fasta").exists()
+    assert list((tmp_path / "reference_parsing").iterdir()) == []
+
+
+@freeze_time("2022-11-21")
+def test_add_new_sample_reference_timeout(app, tmp_path, ref_seq_fasta):
+    app.config["CIRCUITSEQ_REFERENCE_PARSE_INLINE_WAIT"] = 0
+    app.config["CIRCUITSEQ_REFERENCE_PARSE_TIMEOUT"] = 0
+    reference_sequence = ref_seq_fasta.read()
+    with app.app_context():
+        # more parses than there are parsing processes, which all time out
+        samples, error_message = model.add_new_samples(
+            "u1@embl.de",
+            [
+                {
+                    "name": f"s{n}",
+                    "running_option": "running option",
+                    "concentration": 234,
+                    "reference_sequence_file": FileStorage(
+                        io.BytesIO(reference_sequence), "test.fa"
+                    ),
+                }
+                for n in range(4)
+            ],
+            str(tmp_path),
+        )
+        assert error_message == ""
+        for new_sample in samples:
+            sample = _wait_for_reference_parse(new_sample.id)
+            assert sample.reference_sequence_status == "failed"
+            assert sample.reference_sequence_description is None
+        # the processes that timed out have been killed
+        assert multiprocessing.active_children() == []
+        # and later parses are not held up by them
+        app.config["CIRCUITSEQ_REFERENCE_PARSE_TIMEOUT"] = 60
+        new_sample, error_message = model.add_new_sample(
+            "u1@embl.de",
+            "s4",
+            "running option",
+            234,
+            FileStorage(io.BytesIO(reference_sequence), "test.fa"),
+            str(tmp_path),
+        )
+        sample = _wait_for_reference_parse(new_sample.id)
+        assert sample.reference_sequence_status is None
+        assert sample.reference_sequence_description == "seq0"
+    references_path = tmp_path / "2022/47/inputs/references"
+    assert not (references_path / "22_47_A1_s0.fasta").exists()
+    assert (references_path / "22_47_A5_s4.fasta").is_file()
+
+
+@freeze_time("2022-11-21")
+def test_add_new_samples_failure_stops_parses(app, tmp_path):
+    app.config["CIRCUITSEQ_REFERENCE_PARSE_INLINE_WAIT"] = 1
+    # reading from a fifo that is never written to blocks the parsing process
+    blocking_file = tmp_path / "blocking.fa"
+    os.mkfifo(blocking_file)
+    with app.app_context():
+        samples, error_message = model.add_new_samples(
+            "u1@embl.de",
+            [
+                {
+                    "name": name,
+                    "running_option": "running option",
+                    "concentration": 234,
+                    "reference_sequence_file": reference_sequence_file,
+                }
+                for name, reference_sequence_file in [
+                    ("s0", FileStorage(io.BytesIO(b"invalid"), "test.fa")),
+                    ("s1", blocking_file),
+                ]
+            ],
+            str(tmp_path),
+        )
+        assert samples == []
+        assert error_message == "Failed to parse reference sequence file for sample s0."
+        assert model.remaining_samples_this_week()["remaining"] == 96
+    # the blocked parsing process was killed before its files were removed
+    assert multiprocessing.active_children() == []
+    assert list((tmp_path / "reference_parsing").iterdir()) == []
+
+
+@freeze_time("2022-11-21")
+def test_add_new_samples_commit_failure(app, tmp_path, ref_seq_fasta, monkeypatch):
+    with app.app_context():
+        model.get_current_settings()
+
+        def failing_commit():
+            raise RuntimeError("commit failed")
+
+        monkeypatch.setattr(model.db.session, "commit", failing_commit)
+        with pytest.raises(RuntimeError):
+            model.add_new_sample(
+                "u1@embl.de",
+                "s1",
+                "running option",
+                234,
+                FileStorage(ref_seq_fasta, "test.fa"),
+                str(tmp_path),
+            )
+        monkeypatch.undo()
+        assert model.remaining_samples_this_week()["remaining"] == 96
+    # the parsed reference sequence that was moved into place is removed
+    assert list((tmp_path / "2022/47/inputs/references").iterdir()) == []
+    assert list((tmp_path / "reference_parsing").iterdir()) == []
+
+
+@freeze_time("2022-11-21")
+def test_resume_reference_parse_jobs(app, tmp_path, ref_seq_fasta):
+    with app.app_context():
+        # reference sequences that were pending when the server stopped
+        samples = [
+            model.Sample(
+                email="u1@embl.de",
+                primary_key=f"22_47_A{n}",
+                name=f"s{n}",
+                running_option="running option",
+                concentration=10,
+                reference_sequence_status="pending",
+                date=datetime.date.today(),
+                has_results_zip=False,
+                has_results_fasta=False,
+                has_results_gbk=False,
+            )
+            for n in [1, 2]
+        ]
+        model.db.session.add_all(samples)
+        model.db.session.flush()
+        for sample in samples:
+            model.db.session.add(
+                model.ReferenceParseJob(
+                    sample_id=sample.id,
+                    directory=sample.name,
+                    original_filename="test.fa",
+                    created=datetime.datetime.now(),
+                )
+            )
+        model.db.session.commit()
+        sample_ids = [sample.id for sample in samples]
+    parse_dir = tmp_path / "reference_parsing" / "s1"
+    parse_dir.mkdir(parents=True)
+    (parse_dir / "input").write_bytes(ref_seq_fasta.read())
+    model.resume_reference_parse_jobs(app)
+    with app.app_context():
+        sample = _wait_for_reference_parse(sample_ids[0])
+        assert sample.reference_sequence_status is None
+        assert sample.reference_sequence_description == "seq0"
+        # the input file of the second sample is missing
+        sample = _wait_for_reference_parse(sample_ids[1])
+        assert sample.reference_sequence_status == "failed"
+    assert (tmp_path / "2022/47/inputs/references/22_47_A1_s1.fasta").is_file()
+
+
+def test_create_missing_columns(app):
+    with app.app_context():
+        with model.db.engine.begin() as connection:
+            connection.execute(
+                model.db.text(
+                    "ALTER TABLE sample DROP COLUMN reference_sequence_status"
+                )
+            )
+        model.create_missing_columns()
+        columns = model.db.inspect(model.db.engine).get_columns("sample")
+        assert "reference_sequence_status" in [column["name"] for column in columns]
+        assert (
+            model.db.session.execute(
+                model.db.select(model.Sample.reference_sequence_status)
+            )
+            .scalars()
+            .all()
+            == [None] * 4
+        )
+
+
 def test_add_new_user_invalid(app):
     password_valid = "abcABC123"
     email_valid = "joe.bloggs@embl.de"
@@ -197,6 +701,9 @@ def test_add_new_user_valid(app):
         assert user.email == email
         assert user.is_admin is False
         assert user.activated is False
+        # activation email is queued and then sent by the email worker
+        assert app.config.get("TESTING_ONLY_LAST_SMTP_MESSAGE") is None
+        assert EmailWorker().send_queued_emails() == 1
         email_msg = app.config["TESTING_ONLY_LAST_SMTP_MESSAGE"]
         assert email_msg["To"] == email
         # extract activation token from email contents
@@ -220,6 +727,161 @@ def test_add_new_user_valid(app):
         assert user.activated is True
 
 
+def test_get_user_cache(app):
+    with app.app_context():
+        user = model.get_user(2)
+        assert user.email == "user@embl.de"
+        assert user.is_admin is False
+        assert user.activated is True
+        # cached user doesn't include password hash
+        assert user.password_hash is None
+        assert model.get_user(2) is user
+        assert model.get_user(99) is None
+        # direct changes to the db are not seen until the cached user is invalidated
+        db_user = model.db.session.get(model.User, 2)
+        db_user.is_admin = True
+        model.db.session.commit()
+        assert model.get_user(2).is_admin is False
+        model._invalidate_cached_user(2)
+        assert model.get_user(2).is_admin is True
+        # changing password invalidates the cached user
+        assert db_user.set_password("user", "newPassword1") is True
+        assert model.get_user(2) is not user
+
+
+def test_process_result_attachment_budget(app, result_zipfiles, tmp_path):
+    with app.app_context():
+        result_zipfile = result_zipfiles[0]
+        results_dir = tmp_path / "2022/46/results"
+        fasta_file = results_dir / pathlib.Path(result_zipfile.name).with_suffix(
+            ".fasta"
+        )
+        gbk_file = fasta_file.with_suffix(".gbk")
+        for budget, attached, linked in [
+            (10 * 1024 * 1024, [fasta_file, gbk_file], []),
+            (1000, [fasta_file], [gbk_file]),
+            (10, [], [fasta_file, gbk_file]),
+        ]:
+            app.config["CIRCUITSEQ_EMAIL_ATTACHMENT_BUDGET"] = budget
+            with open(result_zipfile, "rb") as f:
+                message, code = model.process_result(FileStorage(f), str(tmp_path))
+            assert code == 200
+            assert EmailWorker().send_queued_emails() == 1
+            email_msg = app.config.get("TESTING_ONLY_LAST_SMTP_MESSAGE")
+            email_attachments = [
+                attachment.get_filename() for attachment in email_msg.iter_attachments()
+            ]
+            assert email_attachments == [f"{f.name}.gz" for f in attached]
+            body = email_msg.get_body().get_content()
+            assert ("too large" in body) == (len(linked) > 0)
+            for f in linked:
+                assert (
+                    f"{f.name}: https://circuitseq.iwr.uni-heidelberg.de/api/result/"
+                    in body
+                )
+
+
+def test_process_result_zip_limits(app, result_zipfiles, tmp_path):
+    with app.app_context():
+        result_zipfile = result_zipfiles[0]
+        app.config["CIRCUITSEQ_ZIP_MAX_MEMBERS"] = 2
+        with open(result_zipfile, "rb") as f:
+            message, code = model.process_result(FileStorage(f), str(tmp_path))
+        assert code == 401
+        assert "Rejected zip file" in message
+        assert "members" in message
+        app.config["CIRCUITSEQ_ZIP_MAX_MEMBERS"] = 1000
+        # extraction stops once more than the maximum size has been written
+        app.config["CIRCUITSEQ_ZIP_MAX_UNCOMPRESSED_SIZE"] = 100
+        with open(result_zipfile, "rb") as f:
+            message, code = model.process_result(FileStorage(f), str(tmp_path))
+        assert code == 401
+        assert "Rejected zip file" in message
+        results_dir = tmp_path / "2022/46/results"
+        assert list(results_dir.iterdir()) == []
+        assert EmailWorker().send_queued_emails() == 0
+        sample = model.db.session.execute(
+            model.db.select(model.Sample).filter_by(primary_key=result_zipfile.name[:8])
+        ).scalar_one()
+        assert sample.has_results_zip is False
+
+
+def test_process_result_rejected_keeps_results(app, result_zipfiles, tmp_path):
+    result_zipfile = result_zipfiles[0]
+    results_dir = tmp_path / "2022/46/results"
+    with app.app_context():
+        # the fasta file fits in the budget, but the gbk file doesn't
+        app.config["CIRCUITSEQ_ZIP_MAX_UNCOMPRESSED_SIZE"] = 3000
+        with open(result_zipfile, "rb") as f:
+            message, code = model.process_result(FileStorage(f), str(tmp_path))
+        assert code == 401
+        # the fasta file that was extracted before the limit was reached is removed
+        assert list(results_dir.iterdir()) == []
+        app.config["CIRCUITSEQ_ZIP_MAX_UNCOMPRESSED_SIZE"] = 1024 * 1024
+        with open(result_zipfile, "rb") as f:
+            message, code = model.process_result(FileStorage(f), str(tmp_path))
+        assert code == 200
+        results = {
+            path.name: path.read_bytes() for path in sorted(results_dir.iterdir())
+        }
+        assert len(results) == 5
+        # uploading a rejected zip file for the sample leaves its results unchanged
+        app.config["CIRCUITSEQ_ZIP_MAX_UNCOMPRESSED_SIZE"] = 3000
+        with open(result_zipfile, "rb") as f:
+            message, code = model.process_result(FileStorage(f), str(tmp_path))
+        assert code == 401
+        assert {
+            path.name: path.read_bytes() for path in sorted(results_dir.iterdir())
+        } == results
+        sample = model.db.session.execute(
+            model.db.select(model.Sample).filter_by(primary_key=result_zipfile.name[:8])
+        ).scalar_one()
+        assert sample.has_results_zip is True
+
+
+def test_process_plate_result_rejected_keeps_results(app, result_zipfiles, tmp_path):
+    result_zipfile = result_zipfiles[0]
+    results_dir = tmp_path / "2022/46/results"
+
+    def plate_zipfile(fasta: Optional[str] = None) -> FileStorage:
+        plate_zip = io.BytesIO()
+        with zipfile.ZipFile(plate_zip, "w") as zip_file:
+            if fasta is not None:
+                zip_file.writestr(f"{result_zipfile.stem}.fasta", fasta)
+            zip_file.write(result_zipfile, result_zipfile.name)
+        plate_zip.seek(0)
+        return FileStorage(plate_zip, "plate.zip")
+
+    with app.app_context():
+        report, code = model.process_plate_result(plate_zipfile(), str(tmp_path))
+        assert code == 200
+        assert report[0]["error"] is None
+        results = {
+            path.name: path.read_bytes() for path in sorted(results_dir.iterdir())
+        }
+        assert len(results) == 5
+        # the fasta member and the result zip fit in the budget, but the files
+        # in the result zip don't
+        app.config["CIRCUITSEQ_ZIP_MAX_UNCOMPRESSED_SIZE"] = (
+            result_zipfile.stat().st_size + 3000
+        )
+        report, code = model.process_plate_result(
+            plate_zipfile(">A2\nACGT\n"), str(tmp_path)
+        )
+        assert code == 200
+        assert "Failed to process results" in report[0]["error"]
+        # the existing results are left unchanged
+        assert {
+            path.name: path.read_bytes() for path in sorted(results_dir.iterdir())
+        } == results
+        sample = model.db.session.execute(
+            model.db.select(model.Sample).filter_by(primary_key=result_zipfile.name[:8])
+        ).scalar_one()
+        assert sample.has_results_zip is True
+        assert sample.has_results_fasta is True
+        assert sample.has_results_gbk is True
+
+
 def test_process_result_valid(app, result_zipfiles, tmp_path):
     with app.app_context():
         last_email_msg = app.config.get("TESTING_ONLY_LAST_SMTP_MESSAGE")
@@ -236,12 +898,18 @@ def test_process_result_valid(app, result_zipfiles, tmp_path):
             assert zip_path_on_server.is_file()
             assert zip_path_on_server.with_suffix(".fasta").is_file()
             assert zip_path_on_server.with_suffix(".gbk").is_file()
+            assert EmailWorker().send_queued_emails() == 1
             last_email_msg = app.config.get("TESTING_ONLY_LAST_SMTP_MESSAGE")
             assert last_email_msg is not None
             assert zip_file_path.stem in str(last_email_msg.get_body())
-            email_attachments = [
-                attachment.get_filename()
+            email_attachments = {
+                attachment.get_filename(): attachment.get_content()
                 for attachment in last_email_msg.iter_attachments()
-            ]
-            assert str(zip_file_path.with_suffix(".fasta")) in email_attachments
-            assert str(zip_file_path.with_suffix(".gbk")) in email_attachments
+            }
+            # result files are attached gzip-compressed
+            for suffix in [".fasta", ".gbk"]:
+                result_file = zip_path_on_server.with_suffix(suffix)
+                assert (
+                    gzip.decompress(email_attachments[f"{result_file.name}.gz"])
+                    == result_file.read_bytes()
+                )
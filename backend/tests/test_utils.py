@@ -1,7 +1,25 @@
 from __future__ import annotations
+import os
+import time
 from circuit_seq_server.utils import get_primary_key
 import datetime
 from circuit_seq_server.utils import get_start_of_week
+from circuit_seq_server.utils import get_date_range
+from circuit_seq_server.utils import TTLCache
+from circuit_seq_server.utils import MeteredThreadPool, PoolFullError
+from circuit_seq_server.utils import gzip_file
+from circuit_seq_server.utils import write_gzip_sibling
+from circuit_seq_server.utils import encode_result_download_token
+from circuit_seq_server.utils import decode_result_download_token
+from circuit_seq_server.utils import ZipLimits, ZipLimitError, ByteBudget
+from circuit_seq_server.utils import check_zip_limits, extract_zip_member
+from circuit_seq_server.utils import list_zip_members, open_zip_member
+import zipfile
+import pytest
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from freezegun import freeze_time
 
 
 def test_get_start_of_week():
@@ -30,6 +48,31 @@ def test_get_start_of_week():
         assert day == 1
 
 
+@freeze_time("2022-11-23")
+def test_get_date_range():
+    this_week = (datetime.date(2022, 11, 21), datetime.date(2022, 11, 27))
+    assert get_date_range() == this_week
+    assert get_date_range(year="2022", week="47") == this_week
+    assert get_date_range(year="2020", week="53") == (
+        datetime.date(2020, 12, 28),
+        datetime.date(2021, 1, 3),
+    )
+    assert get_date_range(start_date="2022-01-31", end_date="2022-11-23") == (
+        datetime.date(2022, 1, 31),
+        datetime.date(2022, 11, 23),
+    )
+    for args in [
+        {"year": "2022"},
+        {"year": "2022", "week": "54"},
+        {"year": "x", "week": "1"},
+        {"start_date": "2022-01-31"},
+        {"start_date": "2022-01-31", "end_date": "2022-01-30"},
+        {"start_date": "2022-13-01", "end_date": "2022-14-01"},
+    ]:
+        with pytest.raises(ValueError):
+            get_date_range(**args)
+
+
 def test_primary_key_8_12():
     rows = 8
     cols = 12
@@ -38,3 +81,221 @@ def test_primary_key_8_12():
     assert get_primary_key(year, 1, 1, rows, cols) == "22_01_A2"
     assert get_primary_key(year, 1, 95, rows, cols) == "22_01_H12"
     assert get_primary_key(year, 1, 96, rows, cols) is None
+
+
+def test_ttl_cache():
+    with freeze_time("2022-11-21 12:00:00") as frozen_time:
+        cache = TTLCache(maxsize=2, ttl=60)
+        assert cache.get("a") is None
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        assert cache.get("b") == 2
+        assert len(cache) == 2
+        # least recently used entry is removed when full
+        cache.get("a")
+        cache.set("c", 3)
+        assert len(cache) == 2
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        cache.pop("c")
+        assert cache.get("c") is None
+        cache.pop("c")
+        # entries expire after ttl
+        frozen_time.tick(59)
+        assert cache.get("a") == 1
+        frozen_time.tick(2)
+        assert cache.get("a") is None
+        assert len(cache) == 0
+        cache.set("d", 4)
+        cache.clear()
+        assert cache.get("d") is None
+
+
+def test_metered_thread_pool():
+    pool = MeteredThreadPool(max_workers=2)
+    assert pool.stats()["completed"] == 0
+    assert pool.stats()["mean_wait_time"] == 0
+    assert pool.run(sum, [1, 2, 3]) == 6
+    n_concurrent = 0
+    max_n_concurrent = 0
+    lock = threading.Lock()
+
+    def slow_func(x):
+        nonlocal n_concurrent, max_n_concurrent
+        with lock:
+            n_concurrent += 1
+            max_n_concurrent = max(max_n_concurrent, n_concurrent)
+        time.sleep(0.05)
+        with lock:
+            n_concurrent -= 1
+        return x * 2
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda x: pool.run(slow_func, x), range(8)))
+    assert results == [2 * x for x in range(8)]
+    # at most 2 functions ran at the same time, the rest were queued
+    assert max_n_concurrent == 2
+    stats = pool.stats()
+    assert stats["max_workers"] == 2
+    assert stats["queued"] == 0
+    assert stats["active"] == 0
+    assert stats["completed"] == 9
+    assert stats["max_wait_time"] >= 0.1
+    assert 0 < stats["mean_wait_time"] < stats["max_wait_time"]
+    pool.shutdown()
+
+
+def test_metered_thread_pool_max_queued():
+    pool = MeteredThreadPool(max_workers=1, max_queued=1)
+    assert pool.stats()["max_queued"] == 1
+    release = threading.Event()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        # one call runs, one waits in the queue
+        futures = [executor.submit(pool.run, release.wait) for _ in range(2)]
+        while pool.stats()["queued"] + pool.stats()["active"] < 2:
+            time.sleep(0.01)
+        # the queue is full: further calls are rejected without waiting
+        with pytest.raises(PoolFullError):
+            pool.run(sum, [1, 2, 3])
+        assert pool.stats()["rejected"] == 1
+        release.set()
+        assert [future.result() for future in futures] == [True, True]
+    assert pool.run(sum, [1, 2, 3]) == 6
+    stats = pool.stats()
+    assert stats["completed"] == 3
+    assert stats["rejected"] == 1
+    pool.shutdown()
+
+
+def test_gzip_file(tmp_path):
+    data = b"ACGT" * 100000
+    filename = str(tmp_path / "file.fasta")
+    with open(filename, "wb") as f:
+        f.write(data)
+    compressed = gzip_file(filename, max_size=len(data))
+    assert compressed is not None
+    assert len(compressed) < len(data) / 10
+    assert gzip.decompress(compressed) == data
+    # smaller chunks give the same result
+    assert gzip_file(filename, max_size=len(data), chunk_size=1000) == compressed
+    assert gzip_file(filename, max_size=len(compressed)) == compressed
+    # compressed data larger than max_size
+    assert gzip_file(filename, max_size=len(compressed) - 1) is None
+    assert gzip_file(filename, max_size=0, chunk_size=1000) is None
+
+
+def test_write_gzip_sibling(tmp_path):
+    data = b"ACGT" * 100000
+    filename = tmp_path / "file.fasta"
+    filename.write_bytes(data)
+    gzip_filename = write_gzip_sibling(filename, chunk_size=1000)
+    assert gzip_filename == tmp_path / "file.fasta.gz"
+    assert gzip.decompress(gzip_filename.read_bytes()) == data
+    # overwrites an existing copy
+    filename.write_bytes(b"ACGT")
+    assert gzip.decompress(write_gzip_sibling(filename).read_bytes()) == b"ACGT"
+    assert sorted(f.name for f in tmp_path.iterdir()) == [
+        "file.fasta",
+        "file.fasta.gz",
+    ]
+    # concurrent copies of the same file don't interfere with each other
+    filename.write_bytes(data)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        gzip_filenames = list(
+            executor.map(
+                lambda _: write_gzip_sibling(filename, chunk_size=1000), range(16)
+            )
+        )
+    assert gzip_filenames == [tmp_path / "file.fasta.gz"] * 16
+    assert gzip.decompress(gzip_filenames[0].read_bytes()) == data
+    assert sorted(f.name for f in tmp_path.iterdir()) == [
+        "file.fasta",
+        "file.fasta.gz",
+    ]
+
+
+def test_result_download_token():
+    token = encode_result_download_token("22_46_A1", "gbk", "secret_key")
+    assert decode_result_download_token(token, "secret_key", 60) == (
+        "22_46_A1",
+        "gbk",
+    )
+    assert decode_result_download_token(token, "wrong_key", 60) is None
+    assert decode_result_download_token(token[:-2], "secret_key", 60) is None
+    with freeze_time(datetime.datetime.now() + datetime.timedelta(seconds=61)):
+        assert decode_result_download_token(token, "secret_key", 60) is None
+
+
+def test_check_zip_limits(tmp_path):
+    zip_path = tmp_path / "test.zip"
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("random.txt", os.urandom(1000))
+        zip_file.writestr("zeros.txt", bytes(2 * 1024 * 1024))
+    with zipfile.ZipFile(zip_path) as zip_file:
+        check_zip_limits(zip_file, ZipLimits(2, 3 * 1024 * 1024, 10000))
+        with pytest.raises(ZipLimitError, match="members"):
+            check_zip_limits(zip_file, ZipLimits(1, 3 * 1024 * 1024, 10000))
+        with pytest.raises(ZipLimitError, match="uncompressed size"):
+            check_zip_limits(zip_file, ZipLimits(2, 2 * 1024 * 1024, 10000))
+        with pytest.raises(ZipLimitError, match="zeros.txt"):
+            check_zip_limits(zip_file, ZipLimits(2, 3 * 1024 * 1024, 100))
+
+
+def test_byte_budget():
+    budget = ByteBudget(1000)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(budget.consume, [10] * 100))
+    with pytest.raises(ZipLimitError):
+        budget.consume(1)
+
+
+def test_extract_zip_member(tmp_path):
+    data = b"ACGT" * 1000
+    zip_path = tmp_path / "test.zip"
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("dir/file.fasta", data)
+    output_file = tmp_path / "file.fasta"
+    with zipfile.ZipFile(zip_path) as zip_file:
+        extract_zip_member(
+            zip_file, "dir/file.fasta", output_file, ByteBudget(len(data)), 100
+        )
+        assert output_file.read_bytes() == data
+        output_file.unlink()
+        # the partially extracted file is removed if the budget is exceeded
+        with pytest.raises(ZipLimitError):
+            extract_zip_member(
+                zip_file, "dir/file.fasta", output_file, ByteBudget(len(data) - 1), 100
+            )
+        assert not output_file.exists()
+
+
+def test_list_zip_members(tmp_path):
+    zip_path = tmp_path / "test.zip"
+    with zipfile.ZipFile(zip_path, "w") as zip_file:
+        zip_file.writestr("dir/", b"")
+        zip_file.writestr("dir/a.txt", b"abc")
+    assert list_zip_members(zip_path) == [
+        {"name": "dir/a.txt", "size": 3, "compressed_size": 3}
+    ]
+    # cached members are re-read if the zip file is modified
+    with zipfile.ZipFile(zip_path, "a") as zip_file:
+        zip_file.writestr("b.txt", b"defg")
+    assert [member["name"] for member in list_zip_members(zip_path)] == [
+        "dir/a.txt",
+        "b.txt",
+    ]
+
+
+def test_open_zip_member(tmp_path):
+    zip_path = tmp_path / "test.zip"
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("dir/", b"")
+        zip_file.writestr("dir/a.txt", b"abc" * 1000)
+    assert open_zip_member(zip_path, "missing.txt") is None
+    assert open_zip_member(zip_path, "dir/") is None
+    member_file, size = open_zip_member(zip_path, "dir/a.txt")
+    assert size == 3000
+    with member_file:
+        assert member_file.read() == b"abc" * 1000
@@ -5,5 +5,6 @@ import { defineStore } from "pinia";
 export const useUserStore = defineStore("user", () => {
   const user = ref(null as User | null);
   const token = ref("");
-  return { user, token };
+  const refresh_token = ref("");
+  return { user, token, refresh_token };
 });
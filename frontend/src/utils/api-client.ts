@@ -1,6 +1,7 @@
 import axios from "axios";
-import type { AxiosInstance } from "axios";
+import type { AxiosInstance, AxiosRequestConfig } from "axios";
 import { useUserStore } from "@/stores/user";
+import type { ZipMember } from "@/utils/types";
 
 const apiClient: AxiosInstance = axios.create({
   baseURL: import.meta.env.VITE_REST_API_LOCATION,
@@ -11,10 +12,110 @@ const apiClient: AxiosInstance = axios.create({
 
 apiClient.interceptors.request.use(function (config) {
   const user = useUserStore();
-  config.headers.Authorization = `Bearer ${user.token}`;
+  if (config.headers.Authorization === undefined) {
+    config.headers.Authorization = `Bearer ${user.token}`;
+  }
   return config;
 });
 
+// if the access token has expired, get a new one using the refresh token
+// and retry the request once. Other 401 responses are application errors,
+// which are not retried.
+apiClient.interceptors.response.use(
+  (response) => response,
+  async (error) => {
+    const user = useUserStore();
+    const config = error.config as AxiosRequestConfig & { _retry?: boolean };
+    if (
+      error.response?.status !== 401 ||
+      error.response?.data?.msg !== "Token has expired" ||
+      config._retry ||
+      user.refresh_token === "" ||
+      config.url === "refresh" ||
+      config.url === "login"
+    ) {
+      return Promise.reject(error);
+    }
+    config._retry = true;
+    try {
+      const response = await apiClient.post("refresh", null, {
+        headers: { Authorization: `Bearer ${user.refresh_token}` },
+      });
+      user.user = response.data.user;
+      user.token = response.data.access_token;
+    } catch {
+      user.user = null;
+      user.token = "";
+      user.refresh_token = "";
+      return Promise.reject(error);
+    }
+    if (config.headers) {
+      config.headers.Authorization = `Bearer ${user.token}`;
+    }
+    return apiClient(config);
+  }
+);
+
+function logout() {
+  const user = useUserStore();
+  if (user.refresh_token !== "") {
+    apiClient
+      .post("logout", null, {
+        headers: { Authorization: `Bearer ${user.refresh_token}` },
+      })
+      .catch(() => {});
+  }
+  user.user = null;
+  user.token = "";
+  user.refresh_token = "";
+}
+
+async function sha256_base64(data: ArrayBuffer): Promise<string> {
+  const digest = new Uint8Array(await crypto.subtle.digest("SHA-256", data));
+  return btoa(String.fromCharCode(...digest));
+}
+
+// upload a file in chunks, resuming from the last chunk received by the server
+// if a chunk fails. Returns the upload id, which can then be used in place of the file.
+async function upload_file_resumable(
+  file: File,
+  on_progress: (offset: number, length: number) => void = () => {},
+  chunk_size = 4 * 1024 * 1024,
+  max_retries = 5
+): Promise<string> {
+  const response = await apiClient.post("uploads", {
+    filename: file.name,
+    length: file.size,
+  });
+  const upload_id = response.data.upload_id as string;
+  let offset = 0;
+  let retries = 0;
+  while (offset < file.size) {
+    const chunk = await file.slice(offset, offset + chunk_size).arrayBuffer();
+    try {
+      const chunk_response = await apiClient.patch(`uploads/${upload_id}`, chunk, {
+        headers: {
+          "Content-Type": "application/offset+octet-stream",
+          "Upload-Offset": `${offset}`,
+          "Upload-Checksum": `sha256 ${await sha256_base64(chunk)}`,
+        },
+      });
+      offset = parseInt(chunk_response.headers["upload-offset"]);
+      retries = 0;
+    } catch (error) {
+      retries += 1;
+      if (retries > max_retries) {
+        throw error;
+      }
+      // get the current offset from the server and try again
+      const head_response = await apiClient.head(`uploads/${upload_id}`);
+      offset = parseInt(head_response.headers["upload-offset"]);
+    }
+    on_progress(offset, file.size);
+  }
+  return upload_id;
+}
+
 function download_file_from_endpoint(
   endpoint: string,
   json: object,
@@ -53,13 +154,49 @@ function download_result(primary_key: string, filetype: string) {
   );
 }
 
-function download_zipsamples() {
-  download_file_from_endpoint("admin/zipsamples", {}, "samples.zip");
+function list_result_zip_members(primary_key: string) {
+  return apiClient
+    .post("result_zip_members", { primary_key: primary_key })
+    .then((response) => response.data as Array<ZipMember>);
+}
+
+function download_result_zip_member(primary_key: string, member: string) {
+  download_file_from_endpoint(
+    "result_zip_member",
+    { primary_key: primary_key, member: member },
+    member.split("/").pop() as string
+  );
+}
+
+function download_zipsamples(start_date?: string, end_date?: string) {
+  if (start_date && end_date) {
+    download_file_from_endpoint(
+      "admin/zipsamples",
+      { start_date: start_date, end_date: end_date },
+      `samples_${start_date}_${end_date}.zip`
+    );
+  } else {
+    download_file_from_endpoint("admin/zipsamples", {}, "samples.zip");
+  }
+}
+
+// EventSource can't set headers: the stream is opened with a short-lived
+// token which can only be used for this, so a new one is needed to reconnect
+async function open_event_source(): Promise<EventSource> {
+  const response = await apiClient.post("events/token");
+  return new EventSource(
+    `${import.meta.env.VITE_REST_API_LOCATION}/events?token=${response.data.token}`
+  );
 }
 
 export {
   apiClient,
+  open_event_source,
+  logout,
+  upload_file_resumable,
   download_zipsamples,
   download_reference_sequence,
   download_result,
+  list_result_zip_members,
+  download_result_zip_member,
 };
@@ -6,6 +6,7 @@ export type Sample = {
   running_option: string;
   concentration: number;
   reference_sequence_description: string | null;
+  reference_sequence_status: string | null;
   date: string;
   has_results_zip: boolean;
   has_results_fasta: boolean;
@@ -27,3 +28,9 @@ export type Settings = {
 };
 
 export type RunningOptions = Array<string>;
+
+export type ZipMember = {
+  name: string;
+  size: number;
+  compressed_size: number;
+};